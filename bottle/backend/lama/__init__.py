@@ -1,4 +1,6 @@
 import logging
+import os
 
-logging.basicConfig(filename="debug.log", encoding="utf-8", level=logging.DEBUG)
+log_path = os.environ.get("LAMA_LOG_PATH") or "debug.log"
+logging.basicConfig(filename=log_path, encoding="utf-8", level=logging.DEBUG)
 # logging.basicConfig(filename="error.log", level=logging.ERROR)
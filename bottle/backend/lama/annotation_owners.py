@@ -0,0 +1,50 @@
+"""The clips, elements, layers and segments of the annotations in an index
+that follows the event log (lama.date_index, lama.quote_index, the
+annotation references in lama.query_blocks), so the annotations deleted with
+one of them (ANNOTATIONS_DELETED_EVENTS) are found without comparing the
+whole index with MongoDB."""
+
+from typing import Dict, Optional, Set, Tuple
+
+from lama.events import ANNOTATION_OWNER_FIELDS
+from lama.truth.commands_events import Events
+
+# the annotation fields, for projections
+OWNER_FIELDS = tuple(ANNOTATION_OWNER_FIELDS.values())
+
+
+class AnnotationOwnersMixin:
+    """For EventLogFollowers with _remove(annotation_id); they keep the
+    owners up to date with _set_owners."""
+
+    def _clear_owners(self):
+        # (field, owner id) -> ids of the annotations in the index
+        self._annotations_by_owner: Dict[Tuple[str, str], Set[str]] = {}
+        self._owner_keys: Dict[str, Tuple] = {}  # annotation id -> keys
+
+    def _set_owners(self, annotation_id: str, annotation: Optional[Dict]):
+        """annotation: None if it's no longer in the index"""
+        for key in self._owner_keys.pop(annotation_id, ()):
+            annotation_ids = self._annotations_by_owner[key]
+            annotation_ids.discard(annotation_id)
+            if len(annotation_ids) == 0:
+                del self._annotations_by_owner[key]
+        if annotation is None:
+            return
+        keys = tuple(
+            (field, owner_id)
+            for field in OWNER_FIELDS
+            if (owner_id := annotation.get(field)) is not None
+        )
+        self._owner_keys[annotation_id] = keys
+        for key in keys:
+            self._annotations_by_owner.setdefault(key, set()).add(
+                annotation_id
+            )
+
+    def _remove_deleted(self, event):
+        # the annotations deleted with the subject of the event
+        field = ANNOTATION_OWNER_FIELDS[Events[event.event_name]]
+        key = (field, event.data["_id"])
+        for annotation_id in list(self._annotations_by_owner.get(key, ())):
+            self._remove(annotation_id)
@@ -1,10 +1,13 @@
 """functions related to clips (get_clips, get_basic_clip_by_id, etc.)"""
 
 from collections import defaultdict, OrderedDict
-from typing import Dict, List
+from typing import Dict, Iterable, List
 
-from lama.database import db, ASC
+from pymongo import UpdateOne
+
+from lama.database import db, ASC, DERIVED_FIELDS
 from lama.errors import IdNotFoundError  # , ValidationError
+from lama.pagination import get_page
 from lama.truth.relations import (
     Elements,
     Relations,
@@ -12,12 +15,14 @@ from lama.truth.relations import (
 )
 
 
-def get_clips(
+def _clip_list_steps(
     filter_created_by=None,
     filter_clip_ids=None,
     sort_by=[],
     favorite_ids=[],
-) -> List[Dict]:
+):
+    # filter steps, steps adding computed sort keys, complete sort key,
+    # steps for the output
     filter_steps = []
     if filter_clip_ids is not None:
         filter_steps.append(
@@ -48,80 +53,167 @@ def get_clips(
             "updated": {"$ifNull": ["$updated", "$created"]},
         }
     }
-    count_assoc_date_steps = [
-        {
-            "$lookup": {
-                "from": "annotations",
-                "let": {"clipId": "$_id"},
-                "pipeline": [
-                    {"$match": {"$expr": {"$eq": ["$$clipId", "$clip"]}}},
-                ],
-                "as": "__clipAnnots",
-            }
-        },
-        {
-            "$addFields": {
-                "annotationCount": {"$size": "$__clipAnnots"},
-                "__creationAnnot": {
-                    "$first": {
-                        "$filter": {
-                            "input": "$__clipAnnots",
-                            "as": "annot",
-                            "cond": {
-                                "$eq": ["$$annot.relation", "RAssociatedDate"]
-                            },
-                        }
-                    }
-                },
-            }
-        },
-        {
-            "$addFields": {
-                "associatedDate": "$__creationAnnot.date",
-            }
-        },
-        {
-            "$addFields": {
-                # "missing" or "string"
-                "__associatedDateType": {"$type": "$associatedDate"},
-            }
-        },
-    ]
+    sort_by = list(sort_by)
     for i, (field, _) in enumerate(sort_by):
         if field == "associatedDate":
-            sort_by.insert(i, ("__associatedDateType", -1))
+            # clips with a date first
+            sort_by.insert(i, ("hasAssociatedDate", -1))
             break
-    sorting_step = {
-        "$sort": OrderedDict(
-            (
-                *sort_by,
-                ("_id", 1),
-            ),
-        )
-    }
-    cleanup_step = {
-        "$project": {
-            "__clipAnnots": 0,
-            "__creationAnnot": 0,
-            "__associatedDateType": 0,
-        }
-    }
+    cleanup_step = {"$project": {"hasAssociatedDate": 0}}
+    # sort first (using the indexes) unless sorting by a computed field
+    if any(field == "labelTitle" for field, _ in sort_by):
+        sort_key_steps = [label_or_title_step]
+        output_steps = []
+    else:
+        sort_key_steps = []
+        output_steps = [label_or_title_step]
+    return (
+        filter_steps,
+        sort_key_steps,
+        [*sort_by, ("_id", 1)],
+        [*output_steps, favorite_step, updated_created_step, cleanup_step],
+    )
+
+
+def get_clips(
+    filter_created_by=None,
+    filter_clip_ids=None,
+    sort_by=[],
+    favorite_ids=[],
+) -> List[Dict]:
+    filter_steps, sort_key_steps, sort_by, output_steps = _clip_list_steps(
+        filter_created_by, filter_clip_ids, sort_by, favorite_ids
+    )
     return list(
         db.clips.aggregate(
             [
                 *filter_steps,
-                label_or_title_step,
-                favorite_step,
-                updated_created_step,
-                *count_assoc_date_steps,
-                sorting_step,
-                cleanup_step,
+                *sort_key_steps,
+                {"$sort": OrderedDict(sort_by)},
+                *output_steps,
             ],
             # collation={"locale": "de", "strength": 1},
         )
     )
 
 
+def get_clips_page(
+    page_size,
+    page_after=None,
+    page_before=None,
+    filter_created_by=None,
+    filter_clip_ids=None,
+    sort_by=[],
+    favorite_ids=[],
+) -> Dict:
+    """One page of get_clips (see lama.pagination.get_page)."""
+    filter_steps, sort_key_steps, sort_by, output_steps = _clip_list_steps(
+        filter_created_by, filter_clip_ids, sort_by, favorite_ids
+    )
+    return get_page(
+        db.clips,
+        filter_steps,
+        sort_key_steps,
+        sort_by,
+        output_steps,
+        page_size,
+        page_after,
+        page_before,
+    )
+
+
+def get_clip_labels(clip_ids) -> Dict[str, Dict]:
+    """{_id, labelTitle} of the clips, by id (for showing references)."""
+    return {
+        clip["_id"]: clip
+        for clip in db.clips.aggregate(
+            [
+                {"$match": {"_id": {"$in": clip_ids}}},
+                {
+                    "$project": {
+                        "labelTitle": {"$ifNull": ["$label", "$title"]}
+                    }
+                },
+            ]
+        )
+    }
+
+
+# Kept on the clip documents by the annotation event handlers (see
+# lama.events), instead of looking up all annotations for every list.
+CLIP_ANNOTATION_FIELDS = DERIVED_FIELDS["clips"]
+ASSOCIATED_DATE_RELATION = Relations.RAssociatedDate.name
+# the oldest date annotation of a clip gives its date
+_DATE_ANNOTATION_ORDER = [("created", ASC), ("_id", ASC)]
+
+
+def _clip_annotation_fields_update(clip_id, count, date_annotation):
+    date = (date_annotation or {}).get("date")
+    fields = {"annotationCount": count, "hasAssociatedDate": date is not None}
+    return UpdateOne(
+        {"_id": clip_id},
+        {"$set": {**fields, "associatedDate": date}}
+        if date is not None
+        else {"$set": fields, "$unset": {"associatedDate": ""}},
+    )
+
+
+def update_clip_annotation_fields(clip_ids: Iterable[str]) -> None:
+    ops = [
+        _clip_annotation_fields_update(
+            clip_id,
+            db.annotations.count_documents({"clip": clip_id}),
+            db.annotations.find_one(
+                {"clip": clip_id, "relation": ASSOCIATED_DATE_RELATION},
+                {"date": 1},
+                sort=_DATE_ANNOTATION_ORDER,
+            ),
+        )
+        for clip_id in set(clip_ids)
+        if clip_id is not None
+    ]
+    if len(ops) > 0:
+        db.clips.bulk_write(ops, ordered=False)
+
+
+def update_all_clip_annotation_fields() -> None:
+    """Set the annotation fields of all clips (e.g. after replaying)."""
+    counts = {
+        doc["_id"]: doc["count"]
+        for doc in db.annotations.aggregate(
+            [{"$group": {"_id": "$clip", "count": {"$sum": 1}}}],
+            allowDiskUse=True,
+        )
+    }
+    date_annotations = {
+        doc["_id"]: doc["annotation"]
+        for doc in db.annotations.aggregate(
+            [
+                {"$match": {"relation": ASSOCIATED_DATE_RELATION}},
+                {"$sort": OrderedDict(_DATE_ANNOTATION_ORDER)},
+                {"$project": {"clip": 1, "date": 1}},
+                {
+                    "$group": {
+                        "_id": "$clip",
+                        "annotation": {"$first": "$$ROOT"},
+                    }
+                },
+            ],
+            allowDiskUse=True,
+        )
+    }
+    ops = [
+        _clip_annotation_fields_update(
+            clip["_id"],
+            counts.get(clip["_id"], 0),
+            date_annotations.get(clip["_id"]),
+        )
+        for clip in db.clips.find({}, {"_id": 1})
+    ]
+    if len(ops) > 0:
+        db.clips.bulk_write(ops, ordered=False)
+
+
 def get_basic_clip_by_id(clip_id):
     results = get_clips(filter_clip_ids=[clip_id])
     if len(results) < 1:
@@ -131,7 +223,9 @@ def get_basic_clip_by_id(clip_id):
 
 
 def get_clip_by_id(clip_id):
-    clip = db.clips.find_one({"_id": clip_id})
+    clip = db.clips.find_one(
+        {"_id": clip_id}, {f: 0 for f in CLIP_ANNOTATION_FIELDS}
+    )
     if clip is None:
         raise IdNotFoundError(f'no result for id "{clip_id}"')
     annots = list(
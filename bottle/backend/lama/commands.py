@@ -4,7 +4,7 @@ import re
 from typing import Dict
 from uuid import uuid4
 
-from lama.database import get_document_by_id, id_exists
+from lama.database import allocate_id_suffix, get_document_by_id, id_exists
 from lama.events import handle_event
 from lama.schemas import validate_event
 from lama.types_errors import Event
@@ -25,13 +25,13 @@ def slugify(s):
 
 def create_human_id(data: Dict):
     mangled_label = slugify(data["label"])
-    new_id = f'_{data["type"]}_{mangled_label}'
-    counter = 0
-    suffix = ""
-    while id_exists(new_id + suffix):
-        counter += 1
-        suffix = f"_{counter}"
-    return new_id + suffix
+    base_id = f'_{data["type"]}_{mangled_label}'
+    while True:
+        counter = allocate_id_suffix(base_id)
+        new_id = base_id if counter == 0 else f"{base_id}_{counter}"
+        # e.g. a merge target created outside of this counter
+        if not id_exists(new_id):
+            return new_id
 
 
 def create_random_id(data: Dict):
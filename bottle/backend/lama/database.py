@@ -7,15 +7,21 @@ elements: Music, Speech, etc.
 segments
 clips: clip basic data
 annotations
+id_routes: collection of ids whose prefix doesn't say their collection
+id_counters: next suffix number for human ids
+entity_postings: entity/clip pairs, the clips referencing an entity
 """
 
-from typing import Dict, Union
+import re
+from typing import Dict, Iterable, Tuple, Union
 
 from bson import json_util
-from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo import MongoClient, ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
 from lama.config import db_name, mongo_host, mongo_port
 from lama.errors import IdNotFoundError
+from lama.schemas import elts, ets0, layers
 from lama.util import get_timestamp
 
 ASC = ASCENDING
@@ -43,9 +49,55 @@ def get_mongo_data():
     )
 
 
+# fields the event handlers keep up to date (from other documents); they
+# are kept when a document is updated (see lama.clips for the clip fields)
+DERIVED_FIELDS = {
+    "clips": ["annotationCount", "associatedDate", "hasAssociatedDate"],
+}
+
+
+def _create_clip_sort_indexes():
+    for ordering in [ASC, DESC]:
+        db.clips.create_index([("annotationCount", ordering), ("_id", ASC)])
+        db.clips.create_index(
+            [
+                ("hasAssociatedDate", DESC),
+                ("associatedDate", ordering),
+                ("_id", ASC),
+            ]
+        )
+
+
+def _create_entity_postings_indexes():
+    db.entity_postings.create_index(
+        [("entity", ASC), ("clip", ASC)], unique=True
+    )
+    db.entity_postings.create_index("clip")
+
+
 def init_db(reset=False):
     if db.db_state.find_one({}) is not None and not reset:
         print("Found existing mongo data.")
+        if db.db_state.find_one({"idRoutesBuilt": True}) is None:
+            print("Building id routes...")
+            rebuild_id_routes()
+            db.db_state.update_one({}, {"$set": {"idRoutesBuilt": True}})
+        if db.db_state.find_one({"clipAnnotationFieldsBuilt": True}) is None:
+            from lama.clips import update_all_clip_annotation_fields
+
+            print("Setting clip annotation fields...")
+            _create_clip_sort_indexes()
+            update_all_clip_annotation_fields()
+            db.db_state.update_one(
+                {}, {"$set": {"clipAnnotationFieldsBuilt": True}}
+            )
+        if db.db_state.find_one({"entityPostingsBuilt": True}) is None:
+            from lama.entity_postings import rebuild_entity_postings
+
+            print("Building entity postings...")
+            _create_entity_postings_indexes()
+            rebuild_entity_postings()
+            db.db_state.update_one({}, {"$set": {"entityPostingsBuilt": True}})
         return
     print("Initializing mongo...")
     for coll in db.list_collection_names():
@@ -81,44 +133,215 @@ def init_db(reset=False):
     db.clips.create_index("platform")
     db.clips.create_index("collections")
     db.clips.create_index("effectiveId")
+    _create_clip_sort_indexes()
     # db.clips.create_index(
     #     [("label", "text"), ("title", "text"), ("description", "text")],
     #     default_language="none",
     #     language_override="mongo_language",
     # )
     db.users.create_index("favoriteClips")
+    _create_entity_postings_indexes()
+
+    db.db_state.insert_one(
+        {
+            "initialized": get_timestamp(),
+            "idRoutesBuilt": True,
+            "clipAnnotationFieldsBuilt": True,
+            "entityPostingsBuilt": True,
+        }
+    )
+
+
+# While replaying, lama.replay installs a buffer here that collects the
+# document writes below into bulk_write batches and answers reads by id from
+# the documents it has seen (see lama.replay.BulkWriteBuffer).
+_write_buffer = None
+
+
+def set_write_buffer(write_buffer) -> None:
+    global _write_buffer
+    _write_buffer = write_buffer
+
+
+def _find_by_id(collection_name: str, id_: str) -> Union[Dict, None]:
+    if _write_buffer is not None:
+        return _write_buffer.find_by_id(collection_name, id_)
+    return db[collection_name].find_one({"_id": id_})
+
+
+def _insert(collection_name: str, document: Dict) -> None:
+    if _write_buffer is not None:
+        _write_buffer.insert(collection_name, document)
+    else:
+        db[collection_name].insert_one(document)
+
+
+def _replace(collection_name: str, document: Dict) -> bool:
+    if _write_buffer is not None:
+        return _write_buffer.replace(collection_name, document)
+    result = db[collection_name].replace_one(
+        {"_id": document["_id"]},
+        document,
+    )
+    return result.matched_count > 0
+
+
+def _set_fields(collection_name: str, id_: str, fields: Dict) -> None:
+    if _write_buffer is not None:
+        _write_buffer.set_fields(collection_name, id_, fields)
+    else:
+        db[collection_name].update_one({"_id": id_}, {"$set": fields})
 
-    db.db_state.insert_one({"initialized": get_timestamp()})
+
+def _delete(collection_name: str, id_: str) -> None:
+    if _write_buffer is not None:
+        _write_buffer.delete(collection_name, id_)
+    else:
+        db[collection_name].delete_one({"_id": id_})
+
+
+# Ids are "_<type>_...", and the type says the collection. Ids that don't
+# follow this (e.g. from old imports or merges) are registered in id_routes.
+# The ids of the other collections (users etc.) are looked up in each one.
+PREFIX_COLLECTIONS = {
+    "Clip": "clips",
+    "Annotation": "annotations",
+    "Segment": "segments",
+    **{t: "elements" for t in elts},
+    **{t: "layers" for t in layers},
+    **{t: "entities" for t in ets0},
+}
+ROUTED_COLLECTIONS = sorted(set(PREFIX_COLLECTIONS.values()))
+# their _ids are ids of other documents
+ID_BOOKKEEPING_COLLECTIONS = ["id_routes", "id_counters"]
+
+
+def _prefix_collection(id_: str) -> Union[str, None]:
+    parts = id_.split("_", 2)
+    if len(parts) < 3 or parts[0] != "":
+        return None
+    return PREFIX_COLLECTIONS.get(parts[1])
+
+
+def _register_id(id_: str, collection_name: str) -> None:
+    if _prefix_collection(id_) != collection_name:
+        _insert("id_routes", {"_id": id_, "collection": collection_name})
+
+
+def _unregister_id(id_: str, collection_name: str) -> None:
+    if _prefix_collection(id_) != collection_name:
+        _delete("id_routes", id_)
+
+
+def register_ids(ids: Iterable[str], collection_name: str) -> None:
+    """For documents not written with create_document."""
+    for id_ in ids:
+        if _prefix_collection(id_) != collection_name:
+            db.id_routes.replace_one(
+                {"_id": id_},
+                {"_id": id_, "collection": collection_name},
+                upsert=True,
+            )
+
+
+def unregister_ids(ids: Iterable[str], collection_name: str) -> None:
+    """For documents not deleted with delete_document."""
+    unrouted = [i for i in ids if _prefix_collection(i) != collection_name]
+    if len(unrouted) > 0:
+        db.id_routes.delete_many({"_id": {"$in": unrouted}})
+
+
+def rebuild_id_routes() -> None:
+    """Register all unrouted ids, e.g. after loading a whole mongo state."""
+    db.id_routes.delete_many({})
+    for coll in ROUTED_COLLECTIONS:
+        register_ids((d["_id"] for d in db[coll].find({}, {"_id": 1})), coll)
+
+
+def _locate(id_: str) -> Tuple[Union[str, None], Union[Dict, None]]:
+    # collection name and document, or (None, None)
+    collection_name = _prefix_collection(id_)
+    if collection_name is not None:
+        document = _find_by_id(collection_name, id_)
+        if document is not None:
+            return collection_name, document
+    route = _find_by_id("id_routes", id_)
+    if route is not None:
+        document = _find_by_id(route["collection"], id_)
+        if document is not None:
+            return route["collection"], document
+    # the documents of the other collections (e.g. users) aren't routed
+    for collection_name in db.list_collection_names():
+        if (
+            collection_name not in ROUTED_COLLECTIONS
+            and collection_name not in ID_BOOKKEEPING_COLLECTIONS
+        ):
+            document = db[collection_name].find_one({"_id": id_})
+            if document is not None:
+                return collection_name, document
+    return None, None
 
 
 def get_collection_name(id_: str) -> Union[str, None]:
-    for coll in db.list_collection_names():
-        if db[coll].find_one({"_id": id_}) is not None:
-            return coll
-    return None
+    return _locate(id_)[0]
 
 
 def id_exists(id_: str) -> bool:
     return get_collection_name(id_) is not None
 
 
+def _highest_id_suffix(base_id: str) -> int:
+    # 0 if only base_id exists, -1 if neither it nor "<base_id>_<n>" exist,
+    # in the collection of the prefix or (routed) in another one; the
+    # anchored regex is a prefix scan on the _id index
+    pattern = re.compile(f"^{re.escape(base_id)}(_[0-9]+)?$")
+    collection_names = ["id_routes"]
+    if _prefix_collection(base_id) is not None:
+        collection_names.append(_prefix_collection(base_id))
+    suffixes = [
+        int(d["_id"][len(base_id) + 1 :] or 0)
+        for collection_name in collection_names
+        for d in db[collection_name].find({"_id": pattern}, {"_id": 1})
+    ]
+    return max(suffixes, default=-1)
+
+
+def allocate_id_suffix(base_id: str) -> int:
+    """Atomically allocate the next suffix number for ids "<base_id>_<n>"
+    (0 meaning base_id itself), concurrent callers get different numbers."""
+    while True:
+        counter = db.id_counters.find_one_and_update(
+            {"_id": base_id},
+            {"$inc": {"next": 1}},
+            return_document=ReturnDocument.BEFORE,
+        )
+        if counter is not None:
+            return counter["next"]
+        # first use: continue after the existing ids
+        suffix = _highest_id_suffix(base_id) + 1
+        try:
+            db.id_counters.insert_one({"_id": base_id, "next": suffix + 1})
+            return suffix
+        except DuplicateKeyError:
+            continue  # someone else was first, $inc theirs
+
+
 def set_clip_updated(clip_id: str, timestamp: str, user_id: str) -> None:
-    db.clips.update_one(
-        {"_id": clip_id},
+    _set_fields(
+        "clips",
+        clip_id,
         {
-            "$set": {
-                "updatedAny": timestamp,
-                "updatedAnyBy": user_id,
-            }
+            "updatedAny": timestamp,
+            "updatedAnyBy": user_id,
         },
     )
 
 
 def get_document_by_id(id_: str) -> Dict:
-    collection_name = get_collection_name(id_)
-    if collection_name is None:
+    _, document = _locate(id_)
+    if document is None:
         raise IdNotFoundError(f"no result for id {id_}")
-    return db[collection_name].find_one({"_id": id_})
+    return document
 
 
 def create_document(document_id, document, collection_name, timestamp, user_id):
@@ -130,7 +353,8 @@ def create_document(document_id, document, collection_name, timestamp, user_id):
             ("createdBy", user_id),
         ]
     )
-    db[collection_name].insert_one(actual_data)
+    _insert(collection_name, actual_data)
+    _register_id(document_id, collection_name)
     if document["type"] == "Clip" or document.get("clip") is not None:
         if document["type"] == "Clip":
             set_clip_updated(actual_data["_id"], timestamp, user_id)
@@ -140,18 +364,21 @@ def create_document(document_id, document, collection_name, timestamp, user_id):
 
 def update_document(document, timestamp, user_id):
     document_id = document["_id"]
-    collection_name = get_collection_name(document_id)
-    existing = db[collection_name].find_one(
-        {"_id": document_id},
-    )
+    collection_name, existing = _locate(document_id)
     if existing is None:
         raise IdNotFoundError(f'no result for id "{document_id}"')
     existing_without_updated = {
         k: v for k, v in existing.items() if k not in ["updated", "updatedBy"]
     }
+    derived = DERIVED_FIELDS.get(collection_name, [])
     new_without_updated = {
-        k: v for k, v in document.items() if k not in ["updated", "updatedBy"]
+        k: v
+        for k, v in document.items()
+        if k not in ["updated", "updatedBy", *derived]
     }
+    new_without_updated.update(
+        (k, existing[k]) for k in derived if k in existing
+    )
     if existing_without_updated == new_without_updated:
         # print("attempted update without changes... ignoring")
         return
@@ -162,11 +389,7 @@ def update_document(document, timestamp, user_id):
             "updatedBy": user_id,
         },
     )
-    result = db[collection_name].replace_one(
-        {"_id": document_id},
-        actual_data,
-    )
-    if result.matched_count < 1:
+    if not _replace(collection_name, actual_data):
         raise IdNotFoundError(f'no result for id "{document_id}"')
     if document["type"] == "Clip" or document.get("clip") is not None:
         if document["type"] == "Clip":
@@ -176,11 +399,12 @@ def update_document(document, timestamp, user_id):
 
 
 def delete_document(collection, document_id, timestamp, user_id):
-    document = db[collection].find_one({"_id": document_id})
+    document = _find_by_id(collection, document_id)
     if not document:
         raise IdNotFoundError(f'no result for id "{document_id}"')
     clip_id = document.get("clip")
-    db[collection].delete_one({"_id": document_id})
+    _delete(collection, document_id)
+    _unregister_id(document_id, collection)
     if clip_id is not None:
         set_clip_updated(clip_id, timestamp, user_id)
 
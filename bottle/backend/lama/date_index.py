@@ -0,0 +1,305 @@
+"""Index of the annotation dates for the date filter of the clip list
+(matchDate): the distinct date strings with the clips they annotate, with a
+trigram index over them for substring matches, and an interval tree over
+their parsed EDTF intervals, for matching overlapping dates. The index
+follows the event log: annotation events are applied as they come (a date
+is parsed when it first appears), events deleting many annotations remove
+the deleted ones, and only loading a MongoDB state or adding one of the
+fields it is built from rebuilds it."""
+
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from math import isfinite
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from lama.annotation_owners import OWNER_FIELDS, AnnotationOwnersMixin
+from lama.database import db
+from lama.edtf_dates import parse_edtf
+from lama.events import ANNOTATION_EVENTS, ANNOTATIONS_DELETED_EVENTS
+import lama.eventstore as eventstore
+from lama.fuzzy import TrigramIndex
+from lama.fuzzy_indexes import FIELD_EVENTS
+from lama.truth.commands_events import Events
+
+# the annotation fields the index is built from (the owners include the clip)
+DATE_FIELDS = ("date", *OWNER_FIELDS)
+# number of dates added since the trigram index was built before it is
+# rebuilt (they are searched one by one until then)
+MAX_NEW_DATES = 1000
+# number of inserted and removed intervals before the interval tree is
+# rebalanced, at least (or as many as it was built with)
+MIN_TREE_CHANGES = 64
+
+
+def _sorted_by(intervals, position):
+    ordered = sorted(intervals, key=lambda interval: interval[position])
+    return [i[position] for i in ordered], [i[2] for i in ordered]
+
+
+class _Node:
+    __slots__ = (
+        "center",
+        "starts",
+        "by_start",
+        "ends",
+        "by_end",
+        "left",
+        "right",
+    )
+
+    def __init__(self, center: float, containing, left, right):
+        self.center = center
+        # of the intervals containing center, sorted
+        self.starts, self.by_start = _sorted_by(containing, 0)
+        self.ends, self.by_end = _sorted_by(containing, 1)
+        self.left: Optional[_Node] = left
+        self.right: Optional[_Node] = right
+
+    def insert(self, start: float, end: float, value) -> None:
+        i = bisect_right(self.starts, start)
+        self.starts.insert(i, start)
+        self.by_start.insert(i, value)
+        i = bisect_right(self.ends, end)
+        self.ends.insert(i, end)
+        self.by_end.insert(i, value)
+
+    def remove(self, start: float, end: float, value) -> None:
+        i = self.by_start.index(
+            value,
+            bisect_left(self.starts, start),
+            bisect_right(self.starts, start),
+        )
+        del self.starts[i], self.by_start[i]
+        i = self.by_end.index(
+            value, bisect_left(self.ends, end), bisect_right(self.ends, end)
+        )
+        del self.ends[i], self.by_end[i]
+
+
+def _build_tree(intervals) -> Optional[_Node]:
+    if len(intervals) == 0:
+        return None
+    endpoints = sorted(
+        p for start, end, _ in intervals for p in (start, end) if isfinite(p)
+    )
+    center = endpoints[len(endpoints) // 2]
+    left = [i for i in intervals if i[1] < center]
+    right = [i for i in intervals if i[0] > center]
+    containing = [i for i in intervals if i[0] <= center <= i[1]]
+    return _Node(center, containing, _build_tree(left), _build_tree(right))
+
+
+class IntervalTree:
+    """Centered interval tree over (start, end, value) triples with at least
+    one finite end and unique values. Intervals are inserted and removed in
+    place; the tree is rebuilt from them once there were as many changes as
+    it was built with, which keeps it balanced."""
+
+    def __init__(self, intervals: Iterable[Tuple[float, float, object]] = ()):
+        self._intervals = {
+            value: (start, end) for start, end, value in intervals
+        }
+        self._build()
+
+    def __len__(self):
+        return len(self._intervals)
+
+    def _build(self):
+        self._root = _build_tree(
+            [(start, end, v) for v, (start, end) in self._intervals.items()]
+        )
+        self._changes = 0
+        self._max_changes = max(len(self._intervals), MIN_TREE_CHANGES)
+
+    def _changed(self):
+        self._changes += 1
+        if self._changes > self._max_changes:
+            self._build()
+
+    def insert(self, start: float, end: float, value) -> None:
+        self._intervals[value] = (start, end)
+        parent, node = None, self._root
+        while node is not None:
+            if end < node.center:
+                parent, node = node, node.left
+            elif start > node.center:
+                parent, node = node, node.right
+            else:
+                node.insert(start, end, value)
+                break
+        else:
+            center = start if isfinite(start) else end
+            leaf = _Node(center, [(start, end, value)], None, None)
+            if parent is None:
+                self._root = leaf
+            elif end < parent.center:
+                parent.left = leaf
+            else:
+                parent.right = leaf
+        self._changed()
+
+    def remove(self, value) -> None:
+        """Remove the interval of value, if there is one."""
+        interval = self._intervals.pop(value, None)
+        if interval is None:
+            return
+        start, end = interval
+        node = self._root  # the path it was inserted on
+        while end < node.center or start > node.center:
+            node = node.left if end < node.center else node.right
+        node.remove(start, end, value)  # empty nodes stay until rebuilt
+        self._changed()
+
+    def overlapping(self, start: float, end: float) -> List:
+        """Values of the intervals overlapping [start, end]."""
+        values = []
+        nodes = [self._root]
+        while nodes:
+            node = nodes.pop()
+            if node is None:
+                continue
+            if end < node.center:  # intervals that start before end
+                values.extend(node.by_start[: bisect_right(node.starts, end)])
+                nodes.append(node.left)
+            elif start > node.center:  # intervals that end after start
+                values.extend(node.by_end[bisect_left(node.ends, start) :])
+                nodes.append(node.right)
+            else:
+                values.extend(node.by_start)
+                nodes.extend([node.left, node.right])
+        return values
+
+
+class DateIndex(AnnotationOwnersMixin, eventstore.EventLogFollower):
+    def __init__(self):
+        super().__init__()
+        # request threads query while another one syncs
+        self._lock = threading.RLock()
+        self._dates: Dict[str, Tuple[str, str]] = {}  # id -> (clip, date)
+        self._clips_by_date: Dict[str, Counter] = {}  # clip -> annotations
+        self._date_strings = TrigramIndex([])  # of the dates, see containing
+        self._new_dates = []  # not in _date_strings yet
+        self._tree = IntervalTree()
+        self._clear_owners()
+
+    def __len__(self):
+        return len(self._dates)
+
+    def _clear(self):
+        self._dates.clear()
+        self._clips_by_date.clear()
+        self._date_strings = TrigramIndex([])
+        self._new_dates = []
+        self._tree = IntervalTree()
+        self._clear_owners()
+
+    def _add(self, annotation_id: str, clip_id: str, date: str):
+        self._dates[annotation_id] = (clip_id, date)
+        clips = self._clips_by_date.get(date)
+        if clips is None:
+            clips = self._clips_by_date[date] = Counter()
+            self._new_dates.append(date)
+            interval = parse_edtf(date)
+            if interval is not None:
+                self._tree.insert(*interval, date)
+        clips[clip_id] += 1
+
+    def _remove(self, annotation_id: str):
+        clip_id, date = self._dates.pop(annotation_id, (None, None))
+        if date is None:
+            return
+        self._set_owners(annotation_id, None)
+        clips = self._clips_by_date[date]
+        clips[clip_id] -= 1
+        if clips[clip_id] == 0:
+            del clips[clip_id]
+        if len(clips) == 0:
+            # its string stays in _date_strings until that is rebuilt
+            del self._clips_by_date[date]
+            self._tree.remove(date)
+
+    def _set_annotation(self, annotation_id: str, annotation: Optional[Dict]):
+        # annotation: None if deleted
+        self._remove(annotation_id)
+        date = (annotation or {}).get("date")
+        if isinstance(date, str) and date != "":
+            self._add(annotation_id, annotation.get("clip"), date)
+            self._set_owners(annotation_id, annotation)
+
+    def _rebuild(self):
+        self._clear()
+        for a in db.annotations.find(
+            {"date": {"$type": "string", "$ne": ""}}, DATE_FIELDS
+        ):
+            self._add(a["_id"], a.get("clip"), a["date"])
+            self._set_owners(a["_id"], a)
+        self._date_strings = TrigramIndex(self._new_dates)
+        self._new_dates = []
+
+    def _apply(self, event) -> bool:
+        # False if the event can't be applied (rebuild instead)
+        event_type = Events[event.event_name]
+        if event_type in FIELD_EVENTS:
+            if (
+                event.data["collection"] != "annotations"
+                or event.data["field"] not in DATE_FIELDS
+            ):
+                return True
+            if event_type == Events.FieldAdded:
+                return False  # set on all annotations
+            annotation_id = event.data["_id"]
+            self._set_annotation(
+                annotation_id,
+                db.annotations.find_one({"_id": annotation_id}, DATE_FIELDS),
+            )
+        elif event_type == Events.MongoStateLoaded:
+            return False
+        elif event_type in ANNOTATIONS_DELETED_EVENTS:
+            self._remove_deleted(event)
+        elif event_type in ANNOTATION_EVENTS:
+            self._set_annotation(
+                event.subject_id,
+                event.data if event_type != Events.AnnotationDeleted else None,
+            )
+        return True
+
+    def sync(self):
+        with self._lock:
+            super().sync()
+
+    def _clips(self, dates: Iterable[str]) -> Set[str]:
+        return set().union(*(self._clips_by_date[d] for d in dates))
+
+    def _dates_containing(self, date_str: str) -> List[str]:
+        if len(date_str) < 3:  # no trigrams
+            return [d for d in self._clips_by_date if date_str in d]
+        if len(self._new_dates) > MAX_NEW_DATES:
+            # without the dates no longer annotated
+            self._date_strings = TrigramIndex(list(self._clips_by_date))
+            self._new_dates = []
+        dates = [
+            *self._date_strings.containing(date_str),
+            *(d for d in self._new_dates if date_str in d),
+        ]
+        # a removed date can be in both, or added again
+        return [d for d in dict.fromkeys(dates) if d in self._clips_by_date]
+
+    def containing(self, date_str: str) -> Set[str]:
+        """Clips with a date containing date_str (e.g. "1950-05")."""
+        with self._lock:
+            self.sync()
+            return self._clips(self._dates_containing(date_str))
+
+    def overlapping(self, date_str: str) -> Set[str]:
+        """Clips with a date overlapping the EDTF date or interval date_str
+        (e.g. "1950" matches 1950-05-01, 1949/1951 and 195X)."""
+        interval = parse_edtf(date_str)
+        if interval is None:
+            raise ValueError(f"not an EDTF (level 1) date: {date_str}")
+        with self._lock:
+            self.sync()
+            return self._clips(self._tree.overlapping(*interval))
+
+
+annotation_date_index = DateIndex()
@@ -0,0 +1,84 @@
+"""EDTF (level 1) dates as day intervals, for the date filter of the clip list.
+
+Days are numbered as if every month had 31 days, so the numbers are ordered
+like the dates, which is all the interval comparisons need. Qualifiers
+(?, ~, %) are ignored, unspecified digits (X) widen the interval, seasons
+(21-24) span three months and unknown or open interval ends are unbounded.
+"""
+
+import re
+from typing import Optional, Tuple
+
+MIN_DAY = float("-inf")
+MAX_DAY = float("inf")
+SEASONS = {"21": (3, 5), "22": (6, 8), "23": (9, 11), "24": (12, 14)}
+_OPEN_ENDS = {"", ".."}
+_QUALIFIERS = "?~%"
+
+_date_re = re.compile(
+    r"^(?P<year>Y-?\d+|-?[\dX]{4})"
+    r"(?:-(?P<month>[\dX]{2})(?:-(?P<day>[\dX]{2}))?)?"
+    r"(?:T\d{2}:\d{2}:\d{2}(?:Z|[+-]\d{2}(?::\d{2})?)?)?$"
+)
+
+
+def _day(year: int, month: int, day: int) -> int:
+    return (year * 12 + month - 1) * 31 + day - 1
+
+
+def _digit_range(digits: str, lowest=None, highest=None):
+    # range of the numbers digits with unspecified digits (X) can stand for
+    negative = digits.startswith("-")
+    digits = digits.lstrip("-")
+    low, high = int(digits.replace("X", "0")), int(digits.replace("X", "9"))
+    if negative:
+        low, high = -high, -low
+    if lowest is not None:
+        low, high = max(low, lowest), min(high, highest)
+    return (low, high) if low <= high else None
+
+
+def _date_interval(value: str) -> Optional[Tuple[int, int]]:
+    match = _date_re.match(value.rstrip(_QUALIFIERS))
+    if match is None:
+        return None
+    years = _digit_range(match["year"].lstrip("Y"))
+    month, day = match["month"], match["day"]
+    if month is None:
+        months = (1, 12)
+    elif month in SEASONS:
+        months = SEASONS[month] if day is None else None
+    else:
+        months = _digit_range(month, 1, 12)
+    days = (1, 31) if day is None else _digit_range(day, 1, 31)
+    if months is None or days is None:
+        return None
+    return (
+        _day(years[0], months[0], days[0]),
+        _day(years[1], months[1], days[1]),
+    )
+
+
+def parse_edtf(value: str) -> Optional[Tuple[float, float]]:
+    """The first and last day of an EDTF date or interval, None if value
+    isn't one."""
+    value = value.strip()
+    if "/" not in value:
+        return _date_interval(value)
+    parts = value.split("/")
+    if len(parts) != 2 or all(part in _OPEN_ENDS for part in parts):
+        return None
+    start_part, end_part = parts
+    start = (
+        (MIN_DAY, MIN_DAY)
+        if start_part in _OPEN_ENDS
+        else _date_interval(start_part)
+    )
+    end = (
+        (MAX_DAY, MAX_DAY)
+        if end_part in _OPEN_ENDS
+        else _date_interval(end_part)
+    )
+    if start is None or end is None or start[0] > end[1]:
+        return None
+    return (start[0], end[1])
@@ -6,6 +6,7 @@ from io import StringIO
 
 from lama.database import db
 from lama.errors import IdNotFoundError
+from lama.pagination import get_page
 from lama.truth.entitytypes import entity_type_info
 
 sorted_entity_types = [
@@ -17,14 +18,16 @@ sorted_entity_types = [
 ]
 
 
-def get_entities(
+def _entity_list_steps(
     filter_cats=None,
     filter_types=None,
     sort_by=[],
-    limit=None,
     filter_associated_with=None,
     match_all=False,
+    filter_entity_ids=None,
 ):
+    # filter steps, steps adding computed sort keys, complete sort key,
+    # steps for the output
     filter_steps = []
     if filter_cats is not None:
         filter_steps.append({"analysisCategories": {"$in": filter_cats}})
@@ -35,6 +38,8 @@ def get_entities(
         filter_steps.append(
             {"attributes.associatedWith": {all_in: filter_associated_with}}
         )
+    if filter_entity_ids is not None:
+        filter_steps.append({"_id": {"$in": filter_entity_ids}})
     filter_step = {
         "$match": {"$and": filter_steps} if len(filter_steps) > 0 else {}
     }
@@ -49,25 +54,49 @@ def get_entities(
         }
     }
     print(sort_by)
-    sorting_step = {
-        "$sort": OrderedDict(
-            (
-                *((f.replace("type", "__typeOrder"), o) for f, o in sort_by),
-                ("_id", 1),
-            ),
-        )
-    }
+    sort_fields = {f for f, _ in sort_by}
+    # the computed fields before sorting, if sorted by them; updated is
+    # also shown, the type order only sorted by
+    sort_key_steps = []
+    output_steps = []
+    if "updated" in sort_fields:
+        sort_key_steps.append(updated_created_step)
+    else:
+        output_steps.append(updated_created_step)
+    if "type" in sort_fields:
+        sort_key_steps.append(entity_type_sorting_step)
+        output_steps.append({"$project": {"__typeOrder": 0}})
+    return (
+        [filter_step],
+        sort_key_steps,
+        [
+            *((f.replace("type", "__typeOrder"), o) for f, o in sort_by),
+            ("_id", 1),
+        ],
+        output_steps,
+    )
+
+
+def get_entities(
+    filter_cats=None,
+    filter_types=None,
+    sort_by=[],
+    limit=None,
+    filter_associated_with=None,
+    match_all=False,
+):
+    filter_steps, sort_key_steps, sort_by, output_steps = _entity_list_steps(
+        filter_cats, filter_types, sort_by, filter_associated_with, match_all
+    )
     limit_steps = [{"$limit": limit}] if limit is not None else []
-    cleanup_step = {"$project": {"__typeOrder": 0}}
     result = list(
         db.entities.aggregate(
             [
-                filter_step,
-                updated_created_step,
-                entity_type_sorting_step,
-                sorting_step,
+                *filter_steps,
+                *sort_key_steps,
+                {"$sort": OrderedDict(sort_by)},
                 *limit_steps,
-                cleanup_step,
+                *output_steps,
             ],
             # collation={"locale": "de", "strength": 1},
         )
@@ -75,6 +104,38 @@ def get_entities(
     return result
 
 
+def get_entities_page(
+    page_size,
+    page_after=None,
+    page_before=None,
+    filter_cats=None,
+    filter_types=None,
+    sort_by=[],
+    filter_associated_with=None,
+    match_all=False,
+    filter_entity_ids=None,
+):
+    """One page of get_entities (see lama.pagination.get_page)."""
+    filter_steps, sort_key_steps, sort_by, output_steps = _entity_list_steps(
+        filter_cats,
+        filter_types,
+        sort_by,
+        filter_associated_with,
+        match_all,
+        filter_entity_ids,
+    )
+    return get_page(
+        db.entities,
+        filter_steps,
+        sort_key_steps,
+        sort_by,
+        output_steps,
+        page_size,
+        page_after,
+        page_before,
+    )
+
+
 def get_entities_by_id(entity_ids):
     result = list(db.entities.find({"_id": {"$in": entity_ids}}))
     if len(result) < len(entity_ids):
@@ -0,0 +1,258 @@
+"""Compact on-disk copy of the EntityZoo lookup data (ids, labels, normalized
+labels, types, has-cats flags and usage counts, in usage count order), so a
+new process doesn't have to load all entities from MongoDB and normalize all
+labels before answering the first autocomplete request. It also holds the
+trigram index over the normalized labels, which the first fuzzy match uses
+instead of computing the trigrams of all labels again.
+
+The file is tagged with the event log position it reflects; the reader
+catches up with the events stored since then (see lama.entity_zoo).
+
+The reader maps the file into memory and reads it in place: entities are
+decoded when accessed, and the postings of the trigram index are arrays
+over the mapped file.
+
+Layout (little endian):
+    magic, header length, header (JSON: event info, type names, count n)
+    n x int64 usage count, n x uint16 type index, n x uint8 has-cats flag,
+    3n x uint32 string lengths (id, label, normalized label per entity),
+    UTF-8 strings,
+    optionally (header: label count m, trigram count t) the trigram index:
+    m x uint32 lengths and UTF-8 normalized labels (by position),
+    t x uint32 lengths and UTF-8 trigrams, t x uint32 posting lengths,
+    int32 postings (label positions)
+"""
+
+from array import array
+from collections import Counter
+from collections.abc import Sequence
+import json
+import mmap
+import os
+import struct
+import sys
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+import lama.eventstore as eventstore
+from lama.fuzzy import TrigramIndex
+
+index_path = os.path.join(
+    os.path.dirname(os.path.abspath(eventstore.db_path)), "entity_zoo.idx"
+)
+MAGIC = b"LAMAZOO2"
+_header_length = struct.Struct("<I")
+
+
+class IndexedEntity(NamedTuple):
+    id: str
+    label: str
+    label_str: str  # basic_chars_only(label)
+    type: str
+    has_cats: bool
+    usage_count: int
+
+
+class StoredTrigrams(NamedTuple):
+    """The trigram index section, decoded on first use (load_trigram_index)"""
+
+    label_count: int
+    trigram_count: int
+    data: memoryview  # of the mapped file
+
+
+class IndexedEntities(Sequence):
+    """The entities of the index file, decoded from the mapped file when
+    accessed."""
+
+    def __init__(self, data: memoryview, header: Dict, pos: int):
+        n = header["count"]
+        self._n = n
+        self._types = header["types"]
+        self._usage_counts = np.frombuffer(data, "<i8", n, pos)
+        pos += 8 * n
+        self._type_indexes = np.frombuffer(data, "<u2", n, pos)
+        pos += 2 * n
+        self._has_cats = np.frombuffer(data, "u1", n, pos)
+        pos += n
+        self._data = data
+        # string k is data[offsets[k] : offsets[k + 1]]
+        self._offsets = _string_offsets(data, pos, 3 * n)
+
+    @property
+    def end(self) -> int:
+        """Position after the entities in the file"""
+        return int(self._offsets[-1])
+
+    def __len__(self) -> int:
+        return self._n
+
+    def __getitem__(self, i: int) -> IndexedEntity:
+        if not -self._n <= i < self._n:
+            raise IndexError("entity index out of range")
+        i %= self._n
+        return IndexedEntity(
+            self._string(3 * i),
+            self._string(3 * i + 1),
+            self._string(3 * i + 2),
+            self._types[self._type_indexes[i]],
+            bool(self._has_cats[i]),
+            int(self._usage_counts[i]),
+        )
+
+    def _string(self, k: int) -> str:
+        return _decode(self._data, self._offsets, k)
+
+
+def _little_endian(values: array) -> bytes:
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _write_strings(f, strings: List[str]) -> None:
+    encoded = [s.encode("utf-8") for s in strings]
+    f.write(_little_endian(array("I", (len(s) for s in encoded))))
+    for s in encoded:
+        f.write(s)
+
+
+def _write_trigram_index(f, trigram_index: TrigramIndex) -> None:
+    _write_strings(f, trigram_index.strings)
+    trigrams = list(trigram_index.postings)
+    _write_strings(f, trigrams)
+    postings = [trigram_index.postings[t] for t in trigrams]
+    f.write(_little_endian(array("I", (len(p) for p in postings))))
+    if len(postings) > 0:
+        f.write(np.concatenate(postings).astype("<i4").tobytes())
+
+
+def write_index(
+    entities: List[IndexedEntity],
+    last_event_id: int,
+    last_event_timestamp,
+    trigram_index: Optional[TrigramIndex] = None,
+) -> None:
+    """trigram_index: over the label strs of the entities, without removed
+    strings (see TrigramIndex.compacted)"""
+    types = sorted({e.type for e in entities})
+    type_indexes = {t: i for i, t in enumerate(types)}
+    strings = [s for e in entities for s in (e.id, e.label, e.label_str)]
+    header = {
+        "lastEventId": last_event_id,
+        "lastEventTimestamp": last_event_timestamp,
+        "types": types,
+        "count": len(entities),
+    }
+    if trigram_index is not None:
+        header["labelCount"] = len(trigram_index.strings)
+        header["trigramCount"] = len(trigram_index.postings)
+    header = json.dumps(header).encode("utf-8")
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(_header_length.pack(len(header)))
+        f.write(header)
+        f.write(_little_endian(array("q", (e.usage_count for e in entities))))
+        f.write(
+            _little_endian(array("H", (type_indexes[e.type] for e in entities)))
+        )
+        f.write(bytes(e.has_cats for e in entities))
+        _write_strings(f, strings)
+        if trigram_index is not None:
+            _write_trigram_index(f, trigram_index)
+    os.replace(tmp_path, index_path)  # readers never see a partial file
+
+
+def read_index() -> Optional[Dict]:
+    """Header and entities (IndexedEntities) of the index file, None if
+    there is none (or it can't be read). "trigrams" is a StoredTrigrams, or
+    None. The file stays mapped while these are in use."""
+    try:
+        with open(index_path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return _parse(memoryview(data))
+    except (OSError, ValueError, KeyError, IndexError, struct.error) as err:
+        if os.path.exists(index_path):
+            print(f"Ignoring unreadable entity index: {err!r}")
+        return None
+
+
+def _string_offsets(data: memoryview, pos: int, n: int) -> np.ndarray:
+    # start offsets of the n strings at pos (after their lengths), and the
+    # end of the last one
+    lengths = np.frombuffer(data, "<u4", n, pos)
+    offsets = np.empty(n + 1, dtype=np.int64)
+    offsets[0] = pos + 4 * n
+    np.cumsum(lengths, out=offsets[1:])
+    offsets[1:] += offsets[0]
+    if offsets[-1] > len(data):
+        raise ValueError("truncated entity index file")
+    return offsets
+
+
+def _decode(data: memoryview, offsets: np.ndarray, k: int) -> str:
+    return str(data[offsets[k] : offsets[k + 1]], "utf-8")
+
+
+def _read_strings(data: memoryview, pos: int, n: int) -> Tuple[List, int]:
+    # (strings, position after them)
+    offsets = _string_offsets(data, pos, n)
+    ends = offsets.tolist()
+    strings = [
+        str(data[start:end], "utf-8") for start, end in zip(ends, ends[1:])
+    ]
+    return strings, ends[-1]
+
+
+def _parse(data: memoryview) -> Dict:
+    if data[: len(MAGIC)] != MAGIC:
+        raise ValueError("not an entity index file")
+    pos = len(MAGIC)
+    (header_length,) = _header_length.unpack_from(data, pos)
+    pos += _header_length.size
+    header = json.loads(str(data[pos : pos + header_length], "utf-8"))
+    pos += header_length
+    entities = IndexedEntities(data, header, pos)
+    header["entities"] = entities
+    header["trigrams"] = (
+        StoredTrigrams(
+            header["labelCount"], header["trigramCount"], data[entities.end :]
+        )
+        if "labelCount" in header
+        else None
+    )
+    return header
+
+
+def load_trigram_index(
+    stored: StoredTrigrams, stats: Optional[Counter] = None
+) -> TrigramIndex:
+    """Raises ValueError if the section is damaged. The postings are arrays
+    over the mapped file."""
+    data = stored.data
+    label_strs, pos = _read_strings(data, 0, stored.label_count)
+    trigrams, pos = _read_strings(data, pos, stored.trigram_count)
+    lengths = np.frombuffer(data, "<u4", len(trigrams), pos)
+    pos += 4 * len(trigrams)
+    positions = np.frombuffer(data, "<i4", int(lengths.sum()), pos)
+    if pos + 4 * len(positions) != len(data):
+        raise ValueError("damaged trigram index in the entity index file")
+    positions = positions.astype(np.intc, copy=False)  # no copy (same type)
+    ends = np.cumsum(lengths).tolist()
+    starts = [0, *ends[:-1]]
+    return TrigramIndex(
+        label_strs,
+        stats,
+        {
+            trigram: positions[start:end]
+            for trigram, start, end in zip(trigrams, starts, ends)
+        },
+    )
+
+
+def clear_index() -> None:
+    if os.path.exists(index_path):
+        os.remove(index_path)
@@ -0,0 +1,141 @@
+"""Entity-to-clip postings: which clips reference an entity, in the clip's
+fields or in one of its annotations, with the number of references.
+
+Kept up to date by the clip and annotation event handlers (like the usage
+counts, with the difference between the references before and after an
+event), and rebuilt after replaying. The entity filters of the clip list
+are set operations on these posting lists."""
+
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set
+
+from pymongo import UpdateOne
+
+from lama.database import db
+
+CLIP_POSTING_FIELDS = ["platform", "clipType", "language", "collections"]
+ANNOTATION_POSTING_FIELDS = ["target", "role", "instrument"]
+
+
+def _values(document, field):
+    value = document.get(field)
+    values = value if isinstance(value, list) else [value]
+    return [v for v in values if v]
+
+
+def clip_postings(clip: Optional[Dict]) -> Counter:
+    if not clip:
+        return Counter()
+    return Counter(
+        (entity_id, clip["_id"])
+        for field in CLIP_POSTING_FIELDS
+        for entity_id in _values(clip, field)
+    )
+
+
+def annotation_postings(annotation: Optional[Dict]) -> Counter:
+    if not annotation or not annotation.get("clip"):
+        return Counter()
+    return Counter(
+        (entity_id, annotation["clip"])
+        for field in ANNOTATION_POSTING_FIELDS
+        for entity_id in _values(annotation, field)
+    )
+
+
+def apply_posting_deltas(old_postings: Counter, new_postings: Counter):
+    deltas = Counter(new_postings)
+    deltas.subtract(old_postings)
+    ops = [
+        UpdateOne(
+            {"entity": entity_id, "clip": clip_id},
+            {"$inc": {"count": delta}},
+            upsert=True,
+        )
+        for (entity_id, clip_id), delta in deltas.items()
+        if delta != 0
+    ]
+    if len(ops) == 0:
+        return
+    db.entity_postings.bulk_write(ops, ordered=False)
+    removed = [e for (e, _), delta in deltas.items() if delta < 0]
+    db.entity_postings.delete_many(
+        {"entity": {"$in": removed}, "count": {"$lte": 0}}
+    )
+
+
+def remove_clip_postings(clip_id: str) -> None:
+    db.entity_postings.delete_many({"clip": clip_id})
+
+
+def _add_postings(postings: Counter) -> None:
+    if len(postings) > 0:
+        db.entity_postings.insert_many(
+            [
+                {"entity": entity_id, "clip": clip_id, "count": count}
+                for (entity_id, clip_id), count in postings.items()
+            ]
+        )
+
+
+def _projection(fields):
+    return {field: 1 for field in fields}
+
+
+def refresh_clip_postings(clip_ids: Iterable[str]) -> None:
+    """Recount the postings of the given clips (e.g. after a merge)."""
+    clip_ids = list(set(clip_ids))
+    db.entity_postings.delete_many({"clip": {"$in": clip_ids}})
+    postings = Counter()
+    for clip in db.clips.find(
+        {"_id": {"$in": clip_ids}}, _projection(CLIP_POSTING_FIELDS)
+    ):
+        postings.update(clip_postings(clip))
+    for annotation in db.annotations.find(
+        {"clip": {"$in": clip_ids}},
+        _projection(["clip", *ANNOTATION_POSTING_FIELDS]),
+    ):
+        postings.update(annotation_postings(annotation))
+    _add_postings(postings)
+
+
+def rebuild_entity_postings() -> None:
+    """Recount all postings (e.g. after replaying)."""
+    db.entity_postings.delete_many({})
+    postings = Counter()
+    for clip in db.clips.find({}, _projection(CLIP_POSTING_FIELDS)):
+        postings.update(clip_postings(clip))
+    for annotation in db.annotations.find(
+        {}, _projection(["clip", *ANNOTATION_POSTING_FIELDS])
+    ):
+        postings.update(annotation_postings(annotation))
+    _add_postings(postings)
+
+
+def clips_of_entity(entity_id: str) -> Set[str]:
+    return set(db.entity_postings.distinct("clip", {"entity": entity_id}))
+
+
+def clips_with_entities(
+    entity_ids: Iterable[str], match_all: bool = False
+) -> List[str]:
+    """Clips referencing any (or all) of the entities."""
+    entity_ids = list(set(entity_ids))
+    if not match_all:
+        return db.entity_postings.distinct(
+            "clip", {"entity": {"$in": entity_ids}}
+        )
+    posting_lists = sorted(map(clips_of_entity, entity_ids), key=len)
+    if len(posting_lists) == 0:
+        return []
+    return list(set.intersection(*posting_lists))
+
+
+def clips_without_entities(entity_ids: Iterable[str]) -> List[str]:
+    """Clips referencing none of the entities."""
+    excluded = set(clips_with_entities(entity_ids))
+    return [
+        c["_id"]
+        for c in db.clips.find({}, {"_id": 1})
+        if c["_id"] not in excluded
+    ]
@@ -1,9 +1,10 @@
 """Functions for managing relations between entities"""
 
 from collections import defaultdict
+from itertools import islice
 import json
 
-from lama.eventstore import get_events_by_type
+from lama.eventstore import DEFAULT_BATCH_SIZE, iter_events_by_type
 from lama.triplestore import import_n_triples, sparql_query
 from lama.truth.commands_events import Events
 
@@ -102,8 +103,13 @@ def add_relation(entity_id, relation, target_id):
 
 
 def set_entity_relations_from_events():
-    events = get_events_by_type(
+    events = iter_events_by_type(
         [Events.EntityRelationAdded.name, Events.EntityRelationRemoved.name]
     )
-    n_triples = "\n".join(map(_triple_from_event, events))
-    import_n_triples(n_triples)
+    triples = map(_triple_from_event, events)
+    # in batches, not the whole log as one string
+    while True:
+        batch = list(islice(triples, DEFAULT_BATCH_SIZE))
+        if len(batch) == 0:
+            break
+        import_n_triples("\n".join(batch))
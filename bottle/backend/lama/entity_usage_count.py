@@ -1,5 +1,11 @@
 """Functions for getting the usage count of entities"""
 
+from collections import Counter
+import threading
+from typing import Dict, List, Optional
+
+from pymongo import UpdateOne
+
 from lama.database import db
 from lama.errors import IdNotFoundError
 from lama.truth.entitytypes import EntityTypes as T
@@ -74,13 +80,181 @@ def get_usage_count(entity_id):
     return total_usage_count
 
 
+def _count_all_references() -> Counter:
+    """Number of references for every entity, keyed by (kind, entity id),
+    in one pass over annotations and clips."""
+    pipeline = [
+        {
+            "$project": {
+                # [{k: "target", v: <id>}, {k: "role", v: <id>}]
+                "refs": {
+                    "$objectToArray": {"target": "$target", "role": "$role"}
+                }
+            }
+        },
+        {"$unwind": "$refs"},
+        {"$match": {"refs.v": {"$nin": [None, ""]}}},
+        {
+            "$group": {
+                "_id": {"kind": "$refs.k", "id": "$refs.v"},
+                "count": {"$sum": 1},
+            }
+        },
+        {
+            "$unionWith": {
+                "coll": "clips",
+                "pipeline": [
+                    {
+                        # a clip counts once per entity
+                        "$project": {
+                            "ids": {
+                                "$setUnion": [
+                                    [{"$ifNull": ["$platform", None]}],
+                                    {"$ifNull": ["$language", []]},
+                                    {"$ifNull": ["$collections", []]},
+                                ]
+                            }
+                        }
+                    },
+                    {"$unwind": "$ids"},
+                    {"$match": {"ids": {"$nin": [None, ""]}}},
+                    {
+                        "$group": {
+                            "_id": {"kind": "clip", "id": "$ids"},
+                            "count": {"$sum": 1},
+                        }
+                    },
+                ],
+            }
+        },
+    ]
+    return Counter(
+        {
+            (doc["_id"]["kind"], doc["_id"]["id"]): doc["count"]
+            for doc in db.annotations.aggregate(pipeline, allowDiskUse=True)
+        }
+    )
+
+
+def _total_usage_count(entity, refs: Counter) -> int:
+    # same rules as get_usage_count
+    entity_id = entity["_id"]
+    entity_type = entity["type"]
+    total_usage_count = 0
+    if not any(entity_type == t.name for t in CLIP_ONLY_TYPES):
+        total_usage_count += refs[("target", entity_id)]
+    if any(entity_type == t.name for t in CLIP_ONLY_TYPES):
+        total_usage_count += refs[("clip", entity_id)]
+    if any(entity_type == t.name for t in ROLE_TYPES):
+        total_usage_count += refs[("role", entity_id)]
+    return total_usage_count
+
+
 def update_all_usage_counts():
-    for entity in db.entities.find({}):
-        entity_id = entity["_id"]
-        usage_count = get_usage_count(entity_id)
-        db.entities.update_one(
-            {"_id": entity_id}, {"$set": {"usageCount": usage_count}}
+    refs = _count_all_references()
+    ops = []
+    for entity in db.entities.find({}, {"type": 1, "usageCount": 1}):
+        usage_count = _total_usage_count(entity, refs)
+        if entity.get("usageCount") != usage_count:
+            ops.append(
+                UpdateOne(
+                    {"_id": entity["_id"]},
+                    {"$set": {"usageCount": usage_count}},
+                )
+            )
+    if len(ops) > 0:
+        db.entities.bulk_write(ops, ordered=False)
+
+
+# Incremental updates: the references of an annotation or clip are counted
+# as (kind, entity id) pairs; the difference between the references before
+# and after an event is applied with $inc. The type conditions mirror
+# get_usage_count, so no entity has to be read.
+_DELTA_FILTERS = {
+    "target": {"type": {"$nin": [t.name for t in CLIP_ONLY_TYPES]}},
+    "role": {"type": {"$in": [t.name for t in ROLE_TYPES]}},
+    "clip": {"type": {"$in": [t.name for t in CLIP_ONLY_TYPES]}},
+}
+
+
+def annotation_refs(annotation: Optional[Dict]) -> Counter:
+    refs = Counter()
+    for field in ["target", "role"]:
+        if annotation and annotation.get(field):
+            refs[(field, annotation[field])] += 1
+    return refs
+
+
+def clip_refs(clip: Optional[Dict]) -> Counter:
+    if not clip:
+        return Counter()
+    # a clip counts once per entity, no matter in how many fields it's used
+    entity_ids = {
+        clip.get("platform"),
+        *clip.get("language", []),
+        *clip.get("collections", []),
+    }
+    return Counter(("clip", e) for e in entity_ids if e)
+
+
+def apply_usage_count_deltas(
+    old_refs: Counter, new_refs: Counter
+) -> List[str]:
+    """Returns the ids of the entities whose count may have changed."""
+    deltas = Counter(new_refs)
+    deltas.subtract(old_refs)
+    ops = [
+        UpdateOne(
+            {"_id": entity_id, **_DELTA_FILTERS[kind]},
+            {"$inc": {"usageCount": delta}},
+        )
+        for (kind, entity_id), delta in deltas.items()
+        if delta != 0
+    ]
+    if len(ops) > 0:
+        db.entities.bulk_write(ops, ordered=False)
+    return [entity_id for (_, entity_id), delta in deltas.items() if delta]
+
+
+def reconcile_usage_counts() -> int:
+    """Recount all entities and fix counts that drifted (e.g. because of
+    concurrent edits), returns the number of fixed entities."""
+    # read the stored counts first: a count that changes while counting
+    # is not overwritten below
+    entities = list(db.entities.find({}, {"type": 1, "usageCount": 1}))
+    refs = _count_all_references()
+    ops = [
+        UpdateOne(
+            {"_id": entity["_id"], "usageCount": entity.get("usageCount")},
+            {"$set": {"usageCount": _total_usage_count(entity, refs)}},
         )
+        for entity in entities
+        if entity.get("usageCount") != _total_usage_count(entity, refs)
+    ]
+    if len(ops) == 0:
+        return 0
+    result = db.entities.bulk_write(ops, ordered=False)
+    if result.modified_count > 0:
+        print(f"fixed {result.modified_count} entity usage counts")
+    return result.modified_count
+
+
+def start_usage_count_verifier(interval: float) -> threading.Thread:
+    """Run reconcile_usage_counts every `interval` seconds in the background."""
+
+    def _run():
+        stopped = threading.Event()
+        while not stopped.wait(interval):
+            try:
+                reconcile_usage_counts()
+            except Exception as err:  # keep verifying, e.g. after a timeout
+                print(f"usage count verification failed: {err!r}")
+
+    thread = threading.Thread(
+        target=_run, name="usage-count-verifier", daemon=True
+    )
+    thread.start()
+    return thread
 
 
 if __name__ == "__main__":
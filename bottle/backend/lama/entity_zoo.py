@@ -1,16 +1,43 @@
 """Fuzzy search for entities, with caching for improving performance. See
-server.py for example usage."""
+server.py for example usage.
 
-from collections import defaultdict, OrderedDict
-from itertools import islice
+Every process (e.g. bottle worker) has its own cache. Before each use, the
+cache catches up with the events stored since it was last synced, which
+also covers the events handled by other processes.
 
+A new process starts from the index file (see lama.entity_index_file)
+instead of loading all entities, and fetches the full documents only for
+the entities it returns. Its first fuzzy match takes the trigram index
+from the file too, patched with the labels changed since it was written.
+
+Entity changes are patched into the fuzzy lookup structures; usage count
+changes only reorder their candidates. Recent fuzzy_match_entities results
+are kept for the requests sent while typing, except those a changed label
+could be part of."""
+
+from abc import ABCMeta
+from collections import Counter, defaultdict, OrderedDict
+from itertools import count, islice
+
+import numpy as np
 from rapidfuzz import fuzz, process
 
 from lama.database import db, DESC
-from lama.util import basic_chars_only
+from lama.entity_index_file import (
+    IndexedEntity,
+    load_trigram_index,
+    read_index,
+    write_index,
+)
+from lama.entity_usage_count import annotation_refs, clip_refs
+from lama.events import ANNOTATION_EVENTS, ANNOTATIONS_DELETED_EVENTS
+from lama.fuzzy import CandidateSet, TrigramIndex
+import lama.eventstore as eventstore
+from lama.truth.commands_events import Events
+from lama.util import basic_chars_only, basic_chars_only_all
 
 
-class Singleton(type):
+class Singleton(ABCMeta):  # for the EventLogFollower ABC
     _instances = {}
 
     def __call__(cls, *args, **kwargs):
@@ -28,20 +55,123 @@ def _without_duplicates(seq):
     return [x for x in seq if not (x in seen or seen_add(x))]
 
 
+# rewrite the index file when it's this many events behind
+INDEX_FILE_MAX_LAG = 1000
+# number of cached fuzzy_match_entities results
+MATCH_CACHE_SIZE = 1024
+
+
+class _StubEntity(dict):
+    """Entity from the index file, only with the fields the cache needs."""
+
+    def __init__(self, indexed: IndexedEntity):
+        super().__init__(
+            _id=indexed.id,
+            label=indexed.label,
+            type=indexed.type,
+            usageCount=indexed.usage_count,
+        )
+        self.has_cats = indexed.has_cats
+
+
 def _entity_has_cats(e):
+    if isinstance(e, _StubEntity):
+        return e.has_cats
     return (cats := e.get("analysisCategories")) is not None and len(cats) > 0
 
 
-class EntityZoo(metaclass=Singleton):
+def _usage_count(e):
+    return e.get("usageCount", 0)
+
+
+def _bitmask(indexes, n):
+    bits = bytearray((n + 7) // 8)
+    for i in indexes:
+        bits[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(bits, "little")
+
+
+def _bitmask_indexes(mask, n):
+    bits = mask.to_bytes((n + 7) // 8, "little")
+    return [
+        i
+        for byte_index, byte in enumerate(bits)
+        if byte
+        for i in range(byte_index * 8, byte_index * 8 + 8)
+        if byte >> (i & 7) & 1
+    ]
+
+
+ENTITY_EVENTS = {
+    Events.EntityCreated,
+    Events.EntityUpdated,
+    Events.EntityDeleted,
+}
+CLIP_EVENTS = {Events.ClipCreated, Events.ClipUpdated}
+
+
+def _changed_entity_ids(event):
+    """Ids of the entities (or usage counts) the event changed, None if
+    that's unknown."""
+    event_type = Events[event.event_name]
+    if event_type in ENTITY_EVENTS:
+        return [event.subject_id]
+    if event_type in ANNOTATION_EVENTS:
+        refs = annotation_refs(event.data) + annotation_refs(event.prev_data)
+    elif event_type in CLIP_EVENTS:
+        refs = clip_refs(event.data) + clip_refs(event.prev_data)
+    elif event_type == Events.EntityRenamedMerged:
+        return [event.data["old"], event.data["new"]]
+    elif event_type == Events.AnalysisCatsAttributesSet:
+        return list(event.data)
+    elif event_type == Events.FieldValueSet:
+        entities = event.data["collection"] == "entities"
+        return [event.data["_id"]] if entities else []
+    elif event_type == Events.FieldAdded:
+        return None if event.data["collection"] == "entities" else []
+    elif event_type == Events.MongoStateLoaded:
+        return None
+    else:
+        return []
+    return [entity_id for _, entity_id in refs]
+
+
+class EntityZoo(eventstore.EventLogFollower, metaclass=Singleton):
     def _initialize_caches(self):
         self._entities_map = None
+        self._event_log_version = None  # last event reflected in the cache
+        # changes of the events applied by sync, applied after it
+        self._pending_entity_ids = set()
+        self._pending_usage_counts = False
+        self._index_file_version = None  # None: not written by this cache
+        # StoredTrigrams of the loaded index file, until the first fuzzy match
+        self._index_file_trigrams = None
+        self._is_sorted = True  # _entities_map by usage count
+        self._label_strs = {}  # id -> basic_chars_only(label), kept on updates
+        self._initialize_fuzzy_index()
+
+    def _initialize_fuzzy_index(self):
         self._fuzzy_entity_id_to_label_str = None
-        self._fuzzy_label_str_to_entity_ids = None
-        self._fuzzy_label_str_to_entity_types = None
+        self._fuzzy_label_str_to_entity_ids = None  # as in _entities_map
+        self._fuzzy_label_str_to_entity_types = None  # type -> count
         self._fuzzy_label_str_to_has_cats = None
-        self._fuzzy_ordered_label_strs = None
+        # over the label strs; updated in place, so positions of removed
+        # labels stay unused
+        self._fuzzy_trigram_index = None
+        # candidates (positions) by type, as bitmasks for combining them
+        self._fuzzy_type_masks = None
+        self._fuzzy_cats_mask = None
+        # candidate order (by usage count), outdated after usage changes
+        self._fuzzy_order_stale = True
+        self._fuzzy_all_choices = None
+        self._fuzzy_choices_cache = None  # (types, cats_only) -> candidates
+        # (query, cutoff, types, cats_only, version) -> (match, score) pairs
+        self._fuzzy_match_cache = OrderedDict()
+        self._fuzzy_index_version = next(self._fuzzy_index_versions)
 
     def __init__(self):
+        self._fuzzy_index_versions = count()
+        self._fuzzy_stats = Counter()  # hits, misses, narrowed
         self._initialize_caches()
 
     @classmethod
@@ -49,39 +179,423 @@ class EntityZoo(metaclass=Singleton):
         new_instance = cls()
         return new_instance
 
+    def _resume(self, last_event_id):
+        self._initialize_caches()
+        if self._load_index_file(last_event_id):
+            return self._event_log_version
+        return None
+
+    def _rebuild(self):
+        self._initialize_caches()  # built from MongoDB on next use
+
+    def _apply(self, event):
+        changed = _changed_entity_ids(event)
+        if changed is None:
+            print("Invalidating entity cache...")
+            return False
+        self._pending_entity_ids.update(changed)
+        if Events[event.event_name] in ANNOTATIONS_DELETED_EVENTS:
+            self._pending_usage_counts = True
+        return True
+
+    def _sync_with_event_log(self):
+        self.sync()
+        # once for all the events applied
+        entity_ids = self._pending_entity_ids
+        refresh_usage_counts = self._pending_usage_counts
+        self._pending_entity_ids = set()
+        self._pending_usage_counts = False
+        if self._entities_map is None:
+            return  # built on next use anyway
+        self.update_entities(entity_ids)
+        if refresh_usage_counts:
+            self._refresh_usage_counts()
+
+    def _load_index_file(self, last_event_id):
+        index = read_index()
+        if index is None:
+            return False
+        version = index["lastEventId"]
+        event = (
+            eventstore.get_event(version)
+            if 0 < version <= last_event_id
+            else None
+        )
+        if event is None or event.timestamp != index["lastEventTimestamp"]:
+            return False  # written for another event log
+        print("Loading entity index file...")
+        self._entities_map = OrderedDict()
+        for e in index["entities"]:  # decoded from the file one by one
+            self._entities_map[e.id] = _StubEntity(e)
+            self._label_strs[e.id] = e.label_str
+        self._index_file_trigrams = index["trigrams"]
+        self._is_sorted = True
+        self._event_log_version = version
+        self._index_file_version = version
+        return True
+
+    def _write_index_file(self):
+        version = self._event_log_version
+        event = eventstore.get_event(version) if version else None
+        if event is None:
+            return
+        entities = [
+            IndexedEntity(
+                e["_id"],
+                e["label"],
+                self._label_strs[e["_id"]],
+                e["type"],
+                _entity_has_cats(e),
+                _usage_count(e),
+            )
+            for e in self._entities_map.values()
+        ]
+        trigram_index = self._fuzzy_trigram_index
+        try:
+            write_index(
+                entities,
+                version,
+                event.timestamp,
+                trigram_index.compacted() if trigram_index else None,
+            )
+        except OSError as err:
+            print(f"Could not write entity index: {err!r}")
+        self._index_file_version = version
+
+    def _with_documents(self, entities):
+        # full documents instead of the stubs from the index file
+        stub_ids = [e["_id"] for e in entities if isinstance(e, _StubEntity)]
+        if len(stub_ids) > 0:
+            for doc in db.entities.find({"_id": {"$in": stub_ids}}):
+                cached = self._entities_map.get(doc["_id"])
+                if cached is not None:
+                    if _usage_count(cached) != _usage_count(doc):
+                        self._is_sorted = False
+                    self._entities_map[doc["_id"]] = doc
+        return [
+            self._entities_map[e["_id"]]
+            for e in entities
+            if not isinstance(
+                self._entities_map.get(e["_id"], e), _StubEntity
+            )
+        ]
+
+    def _refresh_usage_counts(self):
+        for e in db.entities.find({}, {"usageCount": 1}):
+            cached = self._entities_map.get(e["_id"])
+            if cached is not None and _usage_count(cached) != _usage_count(e):
+                cached["usageCount"] = _usage_count(e)
+                self._is_sorted = False
+
     def _ensure_entities_map(self):
+        self._sync_with_event_log()
         if self._entities_map is None:
             print("Building entities map...")
             self._entities_map = OrderedDict(
                 (e["_id"], e)
                 for e in db.entities.find({}).sort([("usageCount", DESC)])
             )
+            self._is_sorted = True
+            self._index_file_version = None
+        elif not self._is_sorted:
+            # stable, so ties keep their order
+            self._entities_map = OrderedDict(
+                sorted(
+                    self._entities_map.items(),
+                    key=lambda item: _usage_count(item[1]),
+                    reverse=True,
+                )
+            )
+            self._is_sorted = True
+            self._fuzzy_order_stale = True
+        if self._fuzzy_trigram_index is not None and self._index_file_lags():
+            self._write_index_file()
+
+    def _label_str(self, entity):
+        label_str = self._label_strs.get(entity["_id"])
+        if label_str is None:
+            label_str = basic_chars_only(entity["label"])
+            self._label_strs[entity["_id"]] = label_str
+        return label_str
+
+    def _index_file_lags(self):
+        return (
+            self._index_file_version is None
+            or self._event_log_version - self._index_file_version
+            >= INDEX_FILE_MAX_LAG
+        )
+
+    def _stored_trigram_index(self, label_strs):
+        # the trigram index of the loaded index file, with label_strs
+        stored = self._index_file_trigrams
+        self._index_file_trigrams = None
+        if stored is None:
+            return None
+        try:
+            trigram_index = load_trigram_index(stored, self._fuzzy_stats)
+        except (ValueError, UnicodeDecodeError) as err:
+            print(f"Ignoring trigram index of the entity index: {err!r}")
+            return None
+        # labels changed by the events since the file was written
+        for s in set(trigram_index.strings).difference(label_strs):
+            trigram_index.remove(s)
+        for s in label_strs:
+            if trigram_index.position(s) is None:
+                trigram_index.add(s)
+        return trigram_index
 
     def _ensure_fuzzy_index(self):
-        print("Building fuzzy lookup structures...")
-        entities = self.get_entities()
-        self._fuzzy_entity_id_to_label_str = OrderedDict(
-            (e["_id"], basic_chars_only(e["label"])) for e in entities
+        self._ensure_entities_map()
+        entities = self._entities_map.values()
+        missing = [e for e in entities if e["_id"] not in self._label_strs]
+        label_strs = basic_chars_only_all(e["label"] for e in missing)
+        for e, label_str in zip(missing, label_strs):
+            self._label_strs[e["_id"]] = label_str
+        self._fuzzy_entity_id_to_label_str = {
+            e["_id"]: self._label_str(e) for e in entities
+        }
+        self._fuzzy_label_str_to_entity_types = defaultdict(Counter)
+        self._fuzzy_label_str_to_has_cats = defaultdict(bool)
+        for e in entities:
+            label_str = self._fuzzy_entity_id_to_label_str[e["_id"]]
+            self._fuzzy_label_str_to_entity_types[label_str][e["type"]] += 1
+            if _entity_has_cats(e):
+                self._fuzzy_label_str_to_has_cats[label_str] = True
+        label_strs = _without_duplicates(
+            self._fuzzy_entity_id_to_label_str.values()
         )
-        self._fuzzy_label_str_to_entity_ids = defaultdict(list)
-        self._fuzzy_label_str_to_entity_types = defaultdict(list)
-        self._fuzzy_label_str_to_has_cats = dict()
-        for k, v in self._fuzzy_entity_id_to_label_str.items():
-            self._fuzzy_label_str_to_entity_ids[v].append(k)
-            self._fuzzy_label_str_to_entity_types[v].append(
-                self._entities_map[k]["type"]
-            )
-            self._fuzzy_label_str_to_has_cats[v] = _entity_has_cats(
-                self._entities_map[k]
+        self._fuzzy_trigram_index = self._stored_trigram_index(label_strs)
+        if self._fuzzy_trigram_index is None:
+            print("Building fuzzy lookup structures...")
+            self._fuzzy_trigram_index = TrigramIndex(
+                label_strs, stats=self._fuzzy_stats
             )
-        self._fuzzy_ordered_label_strs = _without_duplicates(
-            self._fuzzy_entity_id_to_label_str.values()
+        self._order_fuzzy_candidates()
+        self._build_fuzzy_masks()
+        if self._index_file_lags():
+            self._write_index_file()
+
+    def _build_fuzzy_masks(self):
+        label_strs = self._fuzzy_trigram_index.strings
+        n = len(label_strs)
+        type_candidates = defaultdict(list)
+        cats_candidates = []
+        for i, s in enumerate(label_strs):
+            for t in self._fuzzy_label_str_to_entity_types[s]:
+                type_candidates[t].append(i)
+            if self._fuzzy_label_str_to_has_cats[s]:
+                cats_candidates.append(i)
+        self._fuzzy_type_masks = {
+            t: _bitmask(indexes, n) for t, indexes in type_candidates.items()
+        }
+        self._fuzzy_cats_mask = _bitmask(cats_candidates, n)
+
+    def _order_fuzzy_candidates(self):
+        # label strs (and their entities) in the order of _entities_map
+        label_strs = self._fuzzy_entity_id_to_label_str
+        ids = defaultdict(list)
+        for entity_id in self._entities_map:
+            ids[label_strs[entity_id]].append(entity_id)
+        self._fuzzy_label_str_to_entity_ids = ids
+        trigram_index = self._fuzzy_trigram_index
+        positions = np.array(
+            [trigram_index.position(s) for s in ids], dtype=np.intc
+        )
+        rank = np.full(len(trigram_index.strings), len(positions))
+        rank[positions] = np.arange(len(positions))
+        trigram_index.rank = rank
+        self._fuzzy_all_choices = CandidateSet(list(ids), None)
+        self._fuzzy_choices_cache = {}
+        self._fuzzy_order_stale = False
+
+    def _update_fuzzy_label(self, label_str):
+        # after the entities with label_str changed
+        trigram_index = self._fuzzy_trigram_index
+        position = trigram_index.position(label_str)
+        entity_ids = self._fuzzy_label_str_to_entity_ids.get(label_str)
+        if not entity_ids:
+            self._fuzzy_label_str_to_entity_ids.pop(label_str, None)
+            self._fuzzy_label_str_to_entity_types.pop(label_str, None)
+            self._fuzzy_label_str_to_has_cats.pop(label_str, None)
+            if position is not None:
+                trigram_index.remove(label_str)
+                self._set_fuzzy_mask_bits(position, set(), False)
+            return
+        if position is None:
+            position = trigram_index.add(label_str)
+        self._fuzzy_label_str_to_has_cats[label_str] = any(
+            _entity_has_cats(self._entities_map[k]) for k in entity_ids
+        )
+        self._set_fuzzy_mask_bits(
+            position,
+            set(self._fuzzy_label_str_to_entity_types[label_str]),
+            self._fuzzy_label_str_to_has_cats[label_str],
         )
 
+    def _set_fuzzy_mask_bits(self, position, types, has_cats):
+        bit = 1 << position
+        for t in set(self._fuzzy_type_masks) | types:
+            mask = self._fuzzy_type_masks.get(t, 0)
+            mask = mask | bit if t in types else mask & ~bit
+            self._fuzzy_type_masks[t] = mask
+        if has_cats:
+            self._fuzzy_cats_mask |= bit
+        else:
+            self._fuzzy_cats_mask &= ~bit
+
+    def _forget_fuzzy_matches(self, label_strs):
+        # the cached results with one of the label strs, or that would have
+        # them now
+        cache = self._fuzzy_match_cache
+        choices = list(label_strs)
+        for key, result in list(cache.items()):
+            query, cutoff = key[0], key[1]
+            if any(s in label_strs for s, _ in result) or (
+                process.extractOne(
+                    query,
+                    choices,
+                    scorer=fuzz.partial_ratio,
+                    processor=None,
+                    score_cutoff=cutoff,
+                )
+                is not None
+            ):
+                del cache[key]
+
+    def _fuzzy_choices(self, types, cats_only):
+        if self._fuzzy_order_stale:
+            self._order_fuzzy_candidates()
+        if types is None and not cats_only:
+            return self._fuzzy_all_choices
+        key = (None if types is None else frozenset(types), cats_only)
+        choices = self._fuzzy_choices_cache.get(key)
+        if choices is not None:
+            return choices
+        trigram_index = self._fuzzy_trigram_index
+        if types is None:
+            mask = self._fuzzy_cats_mask
+        else:
+            mask = 0
+            for t in key[0]:
+                mask |= self._fuzzy_type_masks.get(t, 0)
+            if cats_only:
+                mask &= self._fuzzy_cats_mask
+        positions = np.array(
+            _bitmask_indexes(mask, len(trigram_index.strings)), dtype=np.intc
+        )
+        positions = positions[
+            np.argsort(trigram_index.rank[positions], kind="stable")
+        ]
+        choices = trigram_index.subset(positions.tolist())
+        self._fuzzy_choices_cache[key] = choices
+        return choices
+
+    def _cached_fuzzy_match(self, query, cutoff, limit, types, cats_only):
+        key = (
+            query,
+            cutoff,
+            None if types is None else frozenset(types),
+            cats_only,
+            self._fuzzy_index_version,
+        )
+        cache = self._fuzzy_match_cache
+        result = cache.get(key)
+        if result is not None:
+            self._fuzzy_stats["hits"] += 1
+            cache.move_to_end(key)
+            return result
+        self._fuzzy_stats["misses"] += 1
+        result = self._fuzzy_trigram_index.extract(
+            query,
+            self._fuzzy_choices(types, cats_only),
+            limit=limit,
+            score_cutoff=cutoff,
+        )
+        cache[key] = result
+        if len(cache) > MATCH_CACHE_SIZE:
+            cache.popitem(last=False)
+        return result
+
+    def get_cache_stats(self):
+        """Autocomplete cache counters of this process: result cache hits
+        and misses, and queries narrowed down from a cached shorter one."""
+        hits = self._fuzzy_stats["hits"]
+        misses = self._fuzzy_stats["misses"]
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hitRate": hits / (hits + misses) if hits + misses else None,
+            "narrowed": self._fuzzy_stats["narrowed"],
+            "size": len(self._fuzzy_match_cache),
+            "version": self._fuzzy_index_version,
+        }
+
     def invalidate_cache(self):
         print("Invalidating entity cache...")
         self._initialize_caches()
 
+    def update_entities(self, entity_ids):
+        """Apply created, updated, deleted entities and changed usage counts
+        to the cache. The fuzzy lookup structures are patched for the
+        entities whose label, type or categories changed; usage count
+        changes only reorder the candidates."""
+        if self._entities_map is None or len(entity_ids) == 0:
+            return  # built on next use anyway
+        entity_ids = set(entity_ids)
+        current = {
+            e["_id"]: e
+            for e in db.entities.find({"_id": {"$in": list(entity_ids)}})
+        }
+        changed_label_strs = set()
+        for entity_id in entity_ids:
+            old = self._entities_map.get(entity_id)
+            new = current.get(entity_id)
+            if new is None:
+                self._entities_map.pop(entity_id, None)
+            elif old is None or _usage_count(old) != _usage_count(new):
+                self._is_sorted = False
+            if old is None or new is None or old["label"] != new["label"]:
+                self._label_strs.pop(entity_id, None)
+            if new is not None:
+                self._entities_map[entity_id] = new  # new ones at the end
+            if self._fuzzy_trigram_index is not None and (
+                old is None
+                or new is None
+                or old["label"] != new["label"]
+                or old["type"] != new["type"]
+                or _entity_has_cats(old) != _entity_has_cats(new)
+            ):
+                changed_label_strs.update(self._move_fuzzy_entity(old, new))
+        for label_str in changed_label_strs:
+            self._update_fuzzy_label(label_str)
+        if len(changed_label_strs) > 0:
+            self._forget_fuzzy_matches(changed_label_strs)
+            self._fuzzy_order_stale = True
+
+    def _move_fuzzy_entity(self, old, new):
+        # from the label str of old to that of new, returns both
+        entity_id = (old or new)["_id"]
+        label_strs = set()
+        old_label_str = self._fuzzy_entity_id_to_label_str.pop(entity_id, None)
+        if old_label_str is not None:
+            label_strs.add(old_label_str)
+            ids = self._fuzzy_label_str_to_entity_ids[old_label_str]
+            ids.remove(entity_id)
+            types = self._fuzzy_label_str_to_entity_types[old_label_str]
+            types[old["type"]] -= 1
+            if types[old["type"]] == 0:
+                del types[old["type"]]
+        if new is not None:
+            new_label_str = self._label_str(new)
+            self._fuzzy_entity_id_to_label_str[entity_id] = new_label_str
+            label_strs.add(new_label_str)
+            # at the end until the candidates are reordered
+            ids = self._fuzzy_label_str_to_entity_ids[new_label_str]
+            ids.append(entity_id)
+            types = self._fuzzy_label_str_to_entity_types[new_label_str]
+            types[new["type"]] += 1
+        return label_strs
+
     def get_entities(self, types=None, cats_only=False, limit=None):
         self._ensure_entities_map()
         result = self._entities_map.values()
@@ -91,7 +605,7 @@ class EntityZoo(metaclass=Singleton):
             result = (e for e in result if _entity_has_cats(e))
         if limit is not None:
             result = islice(result, limit)
-        return result
+        return self._with_documents(list(result))
 
     def fuzzy_match_entities(self, query, types=None, cats_only=False):
         self._ensure_entities_map()
@@ -99,30 +613,12 @@ class EntityZoo(metaclass=Singleton):
             self._ensure_fuzzy_index()
         cutoff = 100 if len(query) < 3 else 66
         limit = 50
-        choices = self._fuzzy_ordered_label_strs
-        if types is not None:
-            choices = [
-                s
-                for s in choices
-                if any(
-                    t in self._fuzzy_label_str_to_entity_types[s] for t in types
-                )
-            ]
-        if cats_only:
-            choices = [
-                s for s in choices if self._fuzzy_label_str_to_has_cats[s]
-            ]
-        fuzzy_match_result = process.extract(
-            basic_chars_only(query),
-            choices,
-            limit=limit,
-            processor=None,
-            scorer=fuzz.partial_ratio,
-            score_cutoff=cutoff,
-        )  # (id, match, score)
+        fuzzy_match_result = self._cached_fuzzy_match(
+            basic_chars_only(query), cutoff, limit, types, cats_only
+        )  # (match, score)
         fuzzy_scores = {
             k: score
-            for matched_str, score, _ in fuzzy_match_result
+            for matched_str, score in fuzzy_match_result
             for k in self._fuzzy_label_str_to_entity_ids[matched_str]
         }
         relevant_entities = (
@@ -146,4 +642,4 @@ class EntityZoo(metaclass=Singleton):
             ),
             reverse=True,
         )
-        return sorted_result
+        return self._with_documents(sorted_result)
@@ -12,3 +12,7 @@ class ValidationError(Exception):
 
 class MissingInfoError(Exception):
     pass
+
+
+class ReplayError(Exception):
+    pass
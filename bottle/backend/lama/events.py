@@ -1,8 +1,9 @@
 """Implementation of various events, i.e. what should actually happen in
 MongoDB for a given event."""
 
+from collections import Counter
 from functools import wraps
-from typing import Dict
+from typing import Dict, Set, Tuple
 
 from lama.database import (
     db,
@@ -11,16 +12,56 @@ from lama.database import (
     update_document,
     delete_document,
     get_document_by_id,
+    rebuild_id_routes,
+    register_ids,
+    unregister_ids,
 )
 from lama.types_errors import Event
+from lama.clips import (
+    ASSOCIATED_DATE_RELATION,
+    update_all_clip_annotation_fields,
+    update_clip_annotation_fields,
+)
 from lama.platform_effective_ids import effective_id_from_url
 from lama.truth.commands_events import Events
 from lama.entity_relations import add_relation
-from lama.entity_usage_count import get_usage_count, update_all_usage_counts
+from lama.entity_postings import (
+    annotation_postings,
+    apply_posting_deltas,
+    clip_postings,
+    rebuild_entity_postings,
+    refresh_clip_postings,
+    remove_clip_postings,
+)
+from lama.entity_usage_count import (
+    annotation_refs,
+    apply_usage_count_deltas,
+    clip_refs,
+    get_usage_count,
+)
 from lama.errors import IdNotFoundError
-from lama.entity_zoo import EntityZoo
 
 
+# Version of the MongoDB projection the handlers produce. Bump it whenever
+# they change what they write (e.g. a new derived field), so that snapshots
+# written by older code are not restored (see lama.snapshots).
+PROJECTION_VERSION = 1
+
+ANNOTATION_EVENTS = {
+    Events.AnnotationCreated,
+    Events.AnnotationUpdated,
+    Events.AnnotationDeleted,
+}
+# delete annotations without saying which: those of a clip, element etc.,
+# with the field of the annotations holding its id
+ANNOTATION_OWNER_FIELDS = {
+    Events.ClipDeleted: "clip",
+    Events.ElementDeleted: "element",
+    Events.LayerDeleted: "layer",
+    Events.SegmentDeleted: "segment",
+}
+ANNOTATIONS_DELETED_EVENTS = set(ANNOTATION_OWNER_FIELDS)
+
 PRESERVE_EMPTY = ["description"]
 
 
@@ -106,55 +147,61 @@ def _update_entity_usage_counts(entity_ids):
 
 
 def _with_updated_entity_count(func):
-    # update entity usage count when creating, editing, deleting annotations
+    # update entity usage count and postings when creating, editing,
+    # deleting annotations (not while replaying, they are set afterwards)
     @wraps(func)
     def _handler(event: Event, is_replaying=False) -> Dict:
         result = func(event, is_replaying)
         if is_replaying:
             return result
-        entity_ids = list(
-            set(
-                e
-                for e in [
-                    event.data.get("target"),
-                    event.data.get("role"),
-                    (event.prev_data or {}).get("target"),
-                    (event.prev_data or {}).get("role"),
-                ]
-                if e
-            )
+        is_deleted = Events[event.event_name] == Events.AnnotationDeleted
+        apply_usage_count_deltas(
+            annotation_refs(event.prev_data),
+            Counter() if is_deleted else annotation_refs(event.data),
+        )
+        apply_posting_deltas(
+            annotation_postings(event.prev_data),
+            Counter() if is_deleted else annotation_postings(event.data),
         )
-        _update_entity_usage_counts(entity_ids)
         return result
 
     return _handler
 
 
 def _with_updated_entity_count_clip(func):
-    # update entity usage count when creating, editing, deleting clips
+    # update entity usage count and postings when creating, editing clips
     @wraps(func)
     def _handler(event: Event, is_replaying=False) -> Dict:
         result = func(event, is_replaying)
         if is_replaying:
             return result
-        multi_fields = ["clipType", "collections", "language"]
-        solo_fields = ["platform"]
-        data = event.data
-        prev_data = event.prev_data or {}
-        # collect all entity ids used in any of the above fields
-        entity_ids = [
-            e
-            for e in set(
-                (
-                    *(v for f in multi_fields for v in data.get(f, [])),
-                    *(data.get(f) for f in solo_fields),
-                    *(v for f in multi_fields for v in prev_data.get(f, [])),
-                    *(prev_data.get(f) for f in solo_fields),
-                )
-            )
-            if e
-        ]
-        _update_entity_usage_counts(entity_ids)
+        apply_usage_count_deltas(
+            clip_refs(event.prev_data), clip_refs(event.data)
+        )
+        apply_posting_deltas(
+            clip_postings(event.prev_data),
+            clip_postings({**event.data, "_id": event.subject_id}),
+        )
+        return result
+
+    return _handler
+
+
+def _event_clip_ids(event: Event):
+    if Events[event.event_name] == Events.ClipCreated:
+        return [event.subject_id]
+    # the annotation's clip before and after
+    return [(event.prev_data or {}).get("clip"), event.data.get("clip")]
+
+
+def _with_updated_clip_annotation_fields(func):
+    # annotationCount and associatedDate of new clips and of the clips of
+    # annotations (not while replaying, they are set after replaying)
+    @wraps(func)
+    def _handler(event: Event, is_replaying=False) -> Dict:
+        result = func(event, is_replaying)
+        if not is_replaying:
+            update_clip_annotation_fields(_event_clip_ids(event))
         return result
 
     return _handler
@@ -206,12 +253,23 @@ def handle_segment_annots_update(event: Event, is_replaying=False) -> Dict:
     return {"id": event.subject_id}
 
 
+def _update_derived_data(collection: str, is_replaying: bool) -> None:
+    # after changing any field of clips or annotations, e.g. moving one
+    if is_replaying:
+        return
+    if collection == "annotations":
+        update_all_clip_annotation_fields()
+    if collection in ["annotations", "clips"]:
+        rebuild_entity_postings()
+
+
 # data has collection name, field name, default value
 def handle_add_field(event: Event, is_replaying=False) -> None:
     db[event.data["collection"]].update_many(
         {},
         {"$set": {event.data["field"]: event.data["default"]}},
     )
+    _update_derived_data(event.data["collection"], is_replaying)
 
 
 def handle_set_field(event: Event, is_replaying=False) -> None:
@@ -219,6 +277,7 @@ def handle_set_field(event: Event, is_replaying=False) -> None:
         {"_id": event.data["_id"]},
         {"$set": {event.data["field"]: event.data["value"]}},
     )
+    _update_derived_data(event.data["collection"], is_replaying)
 
 
 # data has format { "old": "ROld", "new": "RNew" }
@@ -227,6 +286,9 @@ def handle_rename_relation(event: Event, is_replaying=False) -> None:
         {"relation": event.data["old"]},
         {"$set": {"relation": event.data["new"]}},
     )
+    renamed = [event.data["old"], event.data["new"]]
+    if ASSOCIATED_DATE_RELATION in renamed and not is_replaying:
+        update_all_clip_annotation_fields()
 
 
 # data has format { "old": "_OldID", "new": "_NewID" }
@@ -254,7 +316,13 @@ def handle_rename_merge_entity(event: Event, is_replaying=False) -> None:
         original_entity = db.entities.find_one({"_id": old})
         with_new_id = dict([*original_entity.items(), ("_id", new)])
         db.entities.insert_one(with_new_id)
+        register_ids([new], "entities")
     delete_document("entities", old, event.timestamp, event.user_id)
+    if not is_replaying:
+        refresh_clip_postings(
+            db.entity_postings.distinct("clip", {"entity": old})
+        )
+        _update_entity_usage_counts([new])
 
 
 # def handle_add_clips_effective_id(event: Event, is_replaying=False):
@@ -277,48 +345,82 @@ def handle_set_favorite(event: Event, is_replaying=False):
     )
 
 
+def _delete_annotations(
+    query, update_postings: bool
+) -> Tuple[Counter, Set[str]]:
+    # returns the entity references and the clips of the deleted annotations
+    annotations = list(
+        db.annotations.find(
+            query, {"target": 1, "role": 1, "instrument": 1, "clip": 1}
+        )
+    )
+    annotation_ids = [a["_id"] for a in annotations]
+    db.annotations.delete_many({"_id": {"$in": annotation_ids}})
+    unregister_ids(annotation_ids, "annotations")
+    if update_postings:
+        apply_posting_deltas(
+            sum(map(annotation_postings, annotations), Counter()), Counter()
+        )
+    clip_ids = {a.get("clip") for a in annotations}
+    return sum(map(annotation_refs, annotations), Counter()), clip_ids
+
+
 # data: { _id: <id> }
 def handle_delete_clip(event: Event, is_replaying=False):
     clip_id = event.data["_id"]
+    clip = db.clips.find_one({"_id": clip_id})
     element_ids = [e["_id"] for e in db.elements.find({"clip": clip_id})]
     layer_ids = [layer["_id"] for layer in db.layers.find({"clip": clip_id})]
     segment_ids = [s["_id"] for s in db.segments.find({"clip": clip_id})]
-    annotation_ids = [a["_id"] for a in db.annotations.find({"clip": clip_id})]
-    db.annotations.delete_many({"_id": {"$in": annotation_ids}})
+    deleted_refs, _ = _delete_annotations(
+        {"clip": clip_id}, update_postings=False  # removed with the clip
+    )
     db.segments.delete_many({"_id": {"$in": segment_ids}})
     db.layers.delete_many({"_id": {"$in": layer_ids}})
     db.elements.delete_many({"_id": {"$in": element_ids}})
     db.clips.delete_one({"_id": clip_id})
+    unregister_ids(segment_ids, "segments")
+    unregister_ids(layer_ids, "layers")
+    unregister_ids(element_ids, "elements")
+    unregister_ids([clip_id], "clips")
     db.users.update_many({}, {"$pull": {"favoriteClips": clip_id}})
-    update_all_usage_counts()  # because annotations also get deleted
+    if not is_replaying:
+        apply_usage_count_deltas(deleted_refs + clip_refs(clip), Counter())
+        remove_clip_postings(clip_id)
 
 
 # data: { _id: <id> }
 def handle_delete_element(event: Event, is_replaying=False):
     element_id = event.data["_id"]
-    annotation_ids = [
-        a["_id"] for a in db.annotations.find({"element": element_id})
-    ]
-    db.annotations.delete_many({"_id": {"$in": annotation_ids}})
+    deleted_refs, clip_ids = _delete_annotations(
+        {"element": element_id}, not is_replaying
+    )
     delete_document("elements", element_id, event.timestamp, event.user_id)
+    if not is_replaying:
+        apply_usage_count_deltas(deleted_refs, Counter())
+        update_clip_annotation_fields(clip_ids)
 
 
 def handle_delete_layer(event: Event, is_replaying=False):
     layer_id = event.data["_id"]
-    annotation_ids = [
-        a["_id"] for a in db.annotations.find({"layer": layer_id})
-    ]
-    db.annotations.delete_many({"_id": {"$in": annotation_ids}})
+    deleted_refs, clip_ids = _delete_annotations(
+        {"layer": layer_id}, not is_replaying
+    )
     delete_document("layers", layer_id, event.timestamp, event.user_id)
+    if not is_replaying:
+        apply_usage_count_deltas(deleted_refs, Counter())
+        update_clip_annotation_fields(clip_ids)
 
 
 def handle_delete_segments(event: Event, is_replaying=False):
     segment_id = event.data["_id"]
-    interpret_annot_ids = [
-        a["_id"] for a in db.annotations.find({"segment": segment_id})
-    ]
-    db.annotations.delete_many({"_id": {"$in": interpret_annot_ids}})
+    deleted_refs, clip_ids = _delete_annotations(
+        {"segment": segment_id}, not is_replaying
+    )
     delete_document("segments", segment_id, event.timestamp, event.user_id)
+    if not is_replaying:
+        apply_usage_count_deltas(deleted_refs, Counter())
+        update_clip_annotation_fields(clip_ids)
 
 
 # def handle_migrate_timecodes(_event, is_replaying=False):
@@ -374,34 +476,23 @@ def handle_load_mongo_state(event: Event, is_replaying=False):
     data = json_util.loads(json_util.dumps(event.data))
     init_db(reset=True)
     for coll_name, docs in data.items():
-        if coll_name != "db_state":
+        if coll_name not in ["db_state", "id_routes", "entity_postings"]:
             db[coll_name].insert_many(docs)
-
-
-def _with_invalidating_entity_cache(func):
-    # invalidate cache used for autocomplete
-    @wraps(func)
-    def _handler(event: Event, is_replaying=False) -> Dict:
-        result = func(event, is_replaying)
-        if not is_replaying:
-            ez = EntityZoo.get_instance()
-            ez.invalidate_cache()
-        return result
-
-    return _handler
+    rebuild_id_routes()
+    if not is_replaying:
+        update_all_clip_annotation_fields()  # maybe from an older version
+        rebuild_entity_postings()
 
 
 EVENTS = {
-    Events.EntityCreated: _with_invalidating_entity_cache(
-        handle_create("entities")
-    ),
-    Events.EntityUpdated: _with_invalidating_entity_cache(handle_update),
-    Events.EntityDeleted: _with_invalidating_entity_cache(
-        handle_delete("entities")
-    ),
+    Events.EntityCreated: handle_create("entities"),
+    Events.EntityUpdated: handle_update,
+    Events.EntityDeleted: handle_delete("entities"),
     Events.EntityRelationAdded: handle_add_entity_relation,
     Events.ClipCreated: _with_updated_entity_count_clip(
-        _with_effective_id(handle_create("clips"))
+        _with_updated_clip_annotation_fields(
+            _with_effective_id(handle_create("clips"))
+        )
     ),
     Events.ClipUpdated: _with_updated_entity_count_clip(
         _with_effective_id(handle_update)
@@ -409,11 +500,13 @@ EVENTS = {
     Events.ClipDeleted: handle_delete_clip,  # privileged
     Events.ClipFavoriteStatusSet: handle_set_favorite,
     Events.AnnotationCreated: _with_updated_entity_count(
-        handle_create("annotations")
+        _with_updated_clip_annotation_fields(handle_create("annotations"))
+    ),
+    Events.AnnotationUpdated: _with_updated_entity_count(
+        _with_updated_clip_annotation_fields(handle_update)
     ),
-    Events.AnnotationUpdated: _with_updated_entity_count(handle_update),
     Events.AnnotationDeleted: _with_updated_entity_count(
-        handle_delete("annotations")
+        _with_updated_clip_annotation_fields(handle_delete("annotations"))
     ),
     Events.ElementCreated: _with_timecode_v2(handle_create("elements")),
     Events.ElementUpdated: _with_timecode_v2(handle_update),
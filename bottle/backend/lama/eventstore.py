@@ -1,10 +1,11 @@
 """All the interaction with the event log database (SQLite) happens here."""
 
+from abc import ABC, abstractmethod
 import json
 import os
 
 import sqlite3
-from typing import Dict, Iterable, List, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 from lama.types_errors import Event
 
@@ -34,6 +35,36 @@ except sqlite3.OperationalError as oe:
     else:
         raise
 
+# schema migrations, applied in order; PRAGMA user_version stores how many
+# of them have already been applied to the database file
+MIGRATIONS = [
+    [
+        "CREATE INDEX IF NOT EXISTS events_timestamp ON events (timestamp)",
+        "CREATE INDEX IF NOT EXISTS events_name_timestamp "
+        "ON events (event_name, timestamp)",
+        "CREATE INDEX IF NOT EXISTS events_subject_timestamp "
+        "ON events (subject_id, timestamp)",
+    ],
+]
+
+
+def _migrate() -> None:
+    c = conn.cursor()
+    (schema_version,) = c.execute("PRAGMA user_version").fetchone()
+    for version, statements in enumerate(
+        MIGRATIONS[schema_version:], start=schema_version + 1
+    ):
+        for statement in statements:
+            c.execute(statement)
+        # PRAGMA does not accept parameters
+        c.execute(f"PRAGMA user_version = {version:d}")
+        conn.commit()
+
+
+_migrate()
+
+DEFAULT_BATCH_SIZE = 1000
+
 
 def _row_as_dict(colnames, row) -> Dict:
     return {key: value for key, value in zip(colnames, row)}
@@ -45,11 +76,40 @@ def clear_events() -> None:
     conn.commit()
 
 
-def get_events_as_dicts() -> List[Dict]:
+def _iter_rows(sql, params, batch_size) -> Iterator[Tuple]:
     c = conn.cursor()
-    result = c.execute("SELECT * FROM events ORDER BY timestamp")
-    columns = [d[0] for d in c.description]
-    return [{k: v for k, v in zip(columns, row)} for row in result.fetchall()]
+    c.execute(sql, params)
+    while True:
+        rows = c.fetchmany(batch_size)
+        if not rows:
+            break
+        yield from rows
+
+
+def _after_id_clause(after_id) -> Tuple[str, List]:
+    # keyset condition for "comes after event <after_id> in log order", where
+    # log order is (timestamp, id) so events with equal timestamps are stable
+    if after_id is None:
+        return ("", [])
+    return (
+        " AND (timestamp, id) > "
+        "(SELECT timestamp, id FROM events WHERE id = ?)",
+        [after_id],
+    )
+
+
+def iter_events_as_dicts(
+    after_id: Optional[int] = None, batch_size: int = DEFAULT_BATCH_SIZE
+) -> Iterator[Dict]:
+    after_sql, after_params = _after_id_clause(after_id)
+    sql = f"SELECT * FROM events WHERE 1{after_sql} ORDER BY timestamp, id"
+    colnames = [name for name, _ in COLUMN_INFO]
+    for row in _iter_rows(sql, after_params, batch_size):
+        yield _row_as_dict(colnames, row)
+
+
+def get_events_as_dicts() -> List[Dict]:
+    return list(iter_events_as_dicts())
 
 
 def _as_event(row):
@@ -58,23 +118,120 @@ def _as_event(row):
     )
 
 
+def iter_events(
+    after_id: Optional[int] = None, batch_size: int = DEFAULT_BATCH_SIZE
+) -> Iterator[Event]:
+    """Stream the event log in log order, optionally starting after the event
+    with id `after_id`, holding at most `batch_size` rows in memory."""
+    after_sql, after_params = _after_id_clause(after_id)
+    sql = f"SELECT * FROM events WHERE 1{after_sql} ORDER BY timestamp, id"
+    for row in _iter_rows(sql, after_params, batch_size):
+        yield _as_event(row)
+
+
 def get_events() -> List[Event]:
+    return list(iter_events())
+
+
+def count_events(after_id: Optional[int] = None) -> int:
+    after_sql, after_params = _after_id_clause(after_id)
     c = conn.cursor()
-    result = c.execute("SELECT * FROM events ORDER BY timestamp")
-    return [_as_event(row) for row in result.fetchall()]
+    c.execute(f"SELECT COUNT(*) FROM events WHERE 1{after_sql}", after_params)
+    return c.fetchone()[0]
 
 
-def get_events_by_type(event_types, entity_id=None):
+def get_last_event_id() -> int:
+    """Id of the latest stored event (0 for an empty log). Ids only grow
+    (until the log is cleared), so this is a version of the event log that
+    all processes see."""
     c = conn.cursor()
-    sql = "SELECT * FROM events WHERE event_name IN ({names}){entity_id_maybe} ORDER BY timestamp".format(
+    (last_id,) = c.execute("SELECT MAX(id) FROM events").fetchone()
+    return last_id or 0
+
+
+def iter_events_since(
+    event_id: int, batch_size: int = DEFAULT_BATCH_SIZE
+) -> Iterator[Event]:
+    """Events stored after the event with id `event_id`, in storage order."""
+    sql = "SELECT * FROM events WHERE id > ? ORDER BY id"
+    for row in _iter_rows(sql, [event_id], batch_size):
+        yield _as_event(row)
+
+
+def get_event(event_id: int) -> Optional[Event]:
+    c = conn.cursor()
+    row = c.execute("SELECT * FROM events WHERE id = ?", [event_id]).fetchone()
+    return _as_event(row) if row is not None else None
+
+
+class EventLogFollower(ABC):
+    """Base of the per-process caches kept in sync with the event log (the
+    EntityZoo, the indexes in lama.fuzzy_indexes, the quote and date
+    indexes, the annotation references of the query blocks). sync() applies
+    the events stored since the last sync, also those stored by other
+    processes, or rebuilds the cache if that's not possible."""
+
+    def __init__(self):
+        self._event_log_version = None  # last event reflected in the cache
+
+    @abstractmethod
+    def _rebuild(self) -> None:
+        """Build the cache from MongoDB, i.e. from the whole log."""
+
+    @abstractmethod
+    def _apply(self, event: Event) -> bool:
+        """Apply the event, False if the cache has to be rebuilt instead."""
+
+    def _resume(self, last_event_id: int) -> Optional[int]:
+        """Start from a saved state instead of rebuilding; the id of the
+        last event it reflects, None if there is none."""
+        return None
+
+    def sync(self) -> None:
+        last_event_id = get_last_event_id()
+        version = self._event_log_version
+        if version == last_event_id:
+            return
+        if version is None or last_event_id < version:  # log was replaced
+            version = self._resume(last_event_id)
+            if version is None:
+                self._rebuild()
+                self._event_log_version = last_event_id
+                return
+        for event in iter_events_since(version):
+            if event.id > last_event_id:
+                break  # next time
+            if not self._apply(event):
+                self._rebuild()
+                break
+        self._event_log_version = last_event_id
+
+
+def iter_events_by_type(
+    event_types,
+    entity_id=None,
+    after_id: Optional[int] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> Iterator[Event]:
+    after_sql, after_params = _after_id_clause(after_id)
+    sql = "SELECT * FROM events WHERE event_name IN ({names}){entity_id_maybe}{after_sql} ORDER BY timestamp, id".format(
         names=", ".join("?" for _ in event_types),
         entity_id_maybe=(
             " AND subject_id = ?" if entity_id is not None else ""
         ),
+        after_sql=after_sql,
     )
-    params = [*event_types, entity_id] if entity_id is not None else event_types
-    result = c.execute(sql, params)
-    return [_as_event(row) for row in result.fetchall()]
+    params = [
+        *event_types,
+        *([entity_id] if entity_id is not None else []),
+        *after_params,
+    ]
+    for row in _iter_rows(sql, params, batch_size):
+        yield _as_event(row)
+
+
+def get_events_by_type(event_types, entity_id=None):
+    return list(iter_events_by_type(event_types, entity_id))
 
 
 def _dump_json(data):
@@ -88,11 +245,14 @@ def _dump_json(data):
             return json_util.dumps(data, ensure_ascii=False)
 
 
-def store(event: Event) -> None:
+def _insert_sql() -> str:
     columns = ", ".join(name for name, _ in COLUMN_INFO[1:])  # without id
     qmarks = ", ".join("?" for _ in range(len(COLUMN_INFO[1:])))
-    sql = f"INSERT INTO events ({columns}) VALUES ({qmarks})"
-    values = (
+    return f"INSERT INTO events ({columns}) VALUES ({qmarks})"
+
+
+def _event_values(event: Event) -> Tuple:
+    return (
         event.timestamp,
         event.event_name,
         event.version,
@@ -101,9 +261,14 @@ def store(event: Event) -> None:
         _dump_json(event.data),
         _dump_json(event.prev_data) if event.prev_data is not None else None,
     )
+
+
+def store(event: Event) -> int:
+    """Append the event to the log, returns its id."""
     c = conn.cursor()
-    c.execute(sql, values)
+    c.execute(_insert_sql(), _event_values(event))
     conn.commit()
+    return c.lastrowid
 
 
 def _serialize_data(event: Event) -> Tuple:
@@ -134,6 +299,15 @@ def replace_event_log(events: Iterable[Event]) -> None:
 
 
 def dump_events(filename: str):
-    events = get_events_as_dicts()
+    # written event by event, so the log never has to fit into memory
     with open(filename, "w", encoding="utf-8") as outfile:
-        json.dump(events, outfile, indent=2, ensure_ascii=False)
+        separator = "[\n  "
+        for event in iter_events_as_dicts():
+            outfile.write(separator)
+            outfile.write(
+                json.dumps(event, indent=2, ensure_ascii=False).replace(
+                    "\n", "\n  "
+                )
+            )
+            separator = ",\n  "
+        outfile.write("[]" if separator.startswith("[") else "\n]")
@@ -1,10 +1,221 @@
 """Fuzzy search"""
 
-from collections import defaultdict
+from array import array
+from collections import Counter, defaultdict, OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
+import numpy as np
 from rapidfuzz import fuzz, process
 
-from lama.util import basic_chars_only
+from lama.util import basic_chars_only, basic_chars_only_all
+
+
+class CandidateSet(NamedTuple):
+    strings: List[str]
+    positions: Optional[np.ndarray]  # in TrigramIndex.strings, None: all
+
+
+_NO_POSITIONS = np.zeros(0, dtype=np.intc)
+
+
+def _trigrams(s):
+    return {s[i : i + 3] for i in range(len(s) - 2)}
+
+
+def _substrings(s):
+    return {s[a:b] for a in range(len(s)) for b in range(a + 1, len(s) + 1)}
+
+
+class TrigramIndex:
+    """Trigram inverted index over (normalized, unique) strings, for
+    partial_ratio searches. A string scores 100 iff it contains the query
+    or is contained in it; those are found with the index, and if there are
+    enough of them, nothing has to be scored. Otherwise all candidates are
+    scored with process.cdist, using all cores. The result is the same as
+    process.extract(query, candidates, scorer=fuzz.partial_ratio).
+
+    The strings containing recent queries are kept, so a query extending
+    one of them (the next keystroke) only checks those strings.
+
+    Strings can be added and removed in place; a removed string keeps its
+    position (all() must not be used then). Ties are in position order,
+    unless rank (position -> sort key) is set."""
+
+    # number of remembered queries
+    CONTAINING_CACHE_SIZE = 256
+
+    def __init__(
+        self,
+        strings: List[str],
+        stats: Optional[Counter] = None,
+        postings: Optional[Dict[str, np.ndarray]] = None,
+    ):
+        """postings: trigram -> sorted positions, if already known (see
+        compacted)"""
+        self.strings = strings
+        self.stats = Counter() if stats is None else stats
+        self._containing_cache = OrderedDict()  # query -> positions
+        self._positions = {s: i for i, s in reversed(list(enumerate(strings)))}
+        self.rank: Optional[np.ndarray] = None
+        if postings is None:
+            positions = defaultdict(lambda: array("i"))
+            for i, s in enumerate(strings):
+                for trigram in _trigrams(s):
+                    positions[trigram].append(i)
+            postings = {
+                trigram: np.frombuffer(trigram_positions, dtype=np.intc)
+                for trigram, trigram_positions in positions.items()
+            }
+        self._postings = postings
+
+    @property
+    def postings(self) -> Dict[str, np.ndarray]:
+        return self._postings
+
+    def compacted(self) -> "TrigramIndex":
+        """The index without the positions of removed strings (for storing
+        it, without recomputing the trigrams)."""
+        live = np.array(sorted(self._positions.values()), dtype=np.intc)
+        return TrigramIndex(
+            [self.strings[i] for i in live.tolist()],
+            self.stats,
+            {
+                trigram: np.searchsorted(live, positions).astype(np.intc)
+                for trigram, positions in self._postings.items()
+                if len(positions) > 0
+            },
+        )
+
+    def add(self, s) -> int:
+        """Add a string (not in the index), returns its position."""
+        position = len(self.strings)
+        self.strings.append(s)
+        self._positions[s] = position
+        new_position = np.array([position], dtype=np.intc)
+        for trigram in _trigrams(s):
+            # still sorted, as position is the largest one
+            self._postings[trigram] = np.concatenate(
+                [self._postings.get(trigram, _NO_POSITIONS), new_position]
+            )
+        self._containing_cache.clear()
+        return position
+
+    def remove(self, s) -> None:
+        position = self._positions.pop(s)
+        for trigram in _trigrams(s):
+            postings = self._postings[trigram]
+            self._postings[trigram] = postings[postings != position]
+        self._containing_cache.clear()
+
+    def position(self, s) -> Optional[int]:
+        return self._positions.get(s)
+
+    def all(self) -> CandidateSet:
+        return CandidateSet(self.strings, None)
+
+    def subset(self, positions: List[int]) -> CandidateSet:
+        return CandidateSet(
+            [self.strings[i] for i in positions],
+            np.array(positions, dtype=np.intc),
+        )
+
+    def _containing(self, query) -> np.ndarray:
+        # positions of strings with all trigrams of query (len >= 3)
+        postings = sorted(
+            (self._postings.get(t, _NO_POSITIONS) for t in _trigrams(query)),
+            key=len,
+        )
+        result = postings[0]
+        for other in postings[1:]:
+            if len(result) == 0:
+                break
+            found = np.searchsorted(other, result)
+            found[found == len(other)] = 0
+            result = result[other[found] == result]
+        return result
+
+    def _cached_containing(self, query) -> List[int]:
+        # positions of the strings containing query (len >= 3)
+        cache = self._containing_cache
+        strings = self.strings
+        if query in cache:
+            cache.move_to_end(query)
+            return cache[query]
+        for end in range(len(query) - 1, 2, -1):
+            previous = cache.get(query[:end])
+            if previous is not None:
+                # every string containing query contains its prefix
+                self.stats["narrowed"] += 1
+                containing = [i for i in previous if query in strings[i]]
+                break
+        else:
+            containing = [
+                i
+                for i in self._containing(query).tolist()
+                if query in strings[i]
+            ]
+        cache[query] = containing
+        if len(cache) > self.CONTAINING_CACHE_SIZE:
+            cache.popitem(last=False)
+        return containing
+
+    def containing(self, query) -> List[str]:
+        """The strings containing query (len >= 3)."""
+        return [self.strings[i] for i in self._cached_containing(query)]
+
+    def _exact_matches(self, query, candidates: CandidateSet) -> List[int]:
+        # positions of the candidates scoring 100, in tie order
+        positions = self._positions
+        contained = [
+            positions[s] for s in _substrings(query) if s in positions
+        ]
+        matches = set(self._cached_containing(query))
+        matches.update(contained)
+        matches = np.array(sorted(matches), dtype=np.intc)
+        if candidates.positions is not None:
+            matches = matches[np.isin(matches, candidates.positions)]
+        if self.rank is not None:
+            matches = matches[np.argsort(self.rank[matches], kind="stable")]
+        return matches.tolist()
+
+    def extract(
+        self,
+        query: str,
+        candidates: CandidateSet,
+        limit: int,
+        score_cutoff: float,
+    ) -> List[Tuple[str, float]]:
+        """Best (string, score) pairs, ties in candidate order."""
+        if len(query) >= 3:
+            matches = self._exact_matches(query, candidates)
+            if len(matches) >= limit or score_cutoff >= 100:
+                return [(self.strings[i], 100.0) for i in matches[:limit]]
+        elif score_cutoff >= 100 and query != "":
+            # ("" is in every string, but only "" scores 100 for it)
+            # no trigrams, but only the first exact matches are needed
+            contained = {s for s in _substrings(query) if s in self._positions}
+            result = []
+            for s in candidates.strings:
+                if query in s or s in contained:
+                    result.append((s, 100.0))
+                    if len(result) == limit:
+                        break
+            return result
+        scores = process.cdist(
+            [query],
+            candidates.strings,
+            scorer=fuzz.partial_ratio,
+            processor=None,
+            score_cutoff=score_cutoff,
+            dtype=np.float64,
+            workers=-1,
+        )[0]
+        best = np.argsort(-scores, kind="stable")[:limit]
+        return [
+            (candidates.strings[i], float(scores[i]))
+            for i in best.tolist()
+            if scores[i] >= score_cutoff
+        ]
 
 
 def _default_sort(query, id_, match, score):
@@ -26,6 +237,135 @@ def _make_sort(func, query):
     return _inner_sort
 
 
+class FuzzyIndex:
+    """The normalized strings of a choices map (key -> string) and the keys
+    having each of them, for searching the same choices repeatedly. The
+    string of a key can be changed in place (see set)."""
+
+    def __init__(self, choices_map):
+        self._choices_index: Dict[str, List] = {}
+        self._normalized = {}  # key -> its string, normalized
+        normalized = basic_chars_only_all(choices_map.values())
+        for k, v in zip(choices_map.keys(), normalized):
+            self._choices_index.setdefault(v, []).append(k)
+            self._normalized[k] = v
+        self._choices = list(self._choices_index.keys())
+        # for repeated exact searches (a single one is faster without it)
+        self._trigram_index = None
+        self._removed_count = 0  # strings removed from the trigram index
+        self._exact_searches = 0
+
+    def set(self, key, string: Optional[str]) -> None:
+        """Change the string of a key (None: remove the key)."""
+        new = None if string is None else basic_chars_only(string)
+        old = self._normalized.get(key)
+        if new == old:
+            return
+        if old is not None:
+            del self._normalized[key]
+            keys = self._choices_index[old]
+            keys.remove(key)
+            if len(keys) == 0:
+                self._remove_choice(old)
+        if new is not None:
+            self._normalized[key] = new
+            if new not in self._choices_index:
+                self._add_choice(new)
+            self._choices_index[new].append(key)
+
+    def _add_choice(self, s):
+        self._choices_index[s] = []
+        self._choices = None
+        if self._trigram_index is not None:
+            self._trigram_index.add(s)
+
+    def _remove_choice(self, s):
+        del self._choices_index[s]
+        self._choices = None
+        if self._trigram_index is not None:
+            self._trigram_index.remove(s)
+            self._removed_count += 1
+
+    def _exact_trigram_matches(self, query, cutoff):
+        if self._trigram_index is None:
+            self._trigram_index = TrigramIndex(list(self._choices_index))
+            self._removed_count = 0
+        elif self._removed_count > len(self._choices_index):
+            self._trigram_index = self._trigram_index.compacted()
+            self._removed_count = 0
+        trigram_index = self._trigram_index
+        result = trigram_index.extract(
+            query,
+            trigram_index.all(),
+            limit=len(trigram_index.strings),
+            score_cutoff=cutoff,
+        )
+        if self._removed_count == 0:
+            return result
+        # removed strings keep their place, and can be added again
+        return [
+            (choice, score)
+            for choice, score in dict.fromkeys(result)
+            if choice in self._choices_index
+        ]
+
+    def _extract(self, query, limit, cutoff, scorer):
+        exact = (
+            scorer is fuzz.partial_ratio and limit is None and cutoff >= 100
+        )
+        if exact:
+            self._exact_searches += 1
+        if exact and self._exact_searches > 1:
+            # only exact matches, found with the trigram index
+            return self._exact_trigram_matches(query, cutoff)
+        if self._choices is None:
+            self._choices = list(self._choices_index.keys())
+        return [
+            (choice, score)
+            for choice, score, _ in process.extract(
+                query,
+                self._choices,
+                limit=limit,
+                processor=None,
+                scorer=scorer,
+                score_cutoff=cutoff,
+            )
+        ]
+
+    def match(
+        self,
+        query,
+        limit=None,
+        cutoff=75,
+        sort_func=None,
+        use_partial_token_sort_ratio=False,
+        include_score=False,
+    ):
+        """See fuzzy_map."""
+        if sort_func is None:
+            sort_func = _default_sort
+        scorer = (
+            fuzz.partial_token_sort_ratio
+            if use_partial_token_sort_ratio
+            else fuzz.partial_ratio
+        )
+        query = basic_chars_only(query)
+        result = self._extract(query, limit, cutoff, scorer)
+        fuzz_result = (
+            (k, result_key, score)
+            for result_key, score in result
+            for k in self._choices_index[result_key]
+        )
+        return [
+            (k, score) if include_score else k
+            for k, _, score in sorted(
+                fuzz_result,
+                key=_make_sort(sort_func, query),
+                reverse=True,
+            )
+        ]
+
+
 def fuzzy_map(
     choices_map,
     query,
@@ -35,37 +375,11 @@ def fuzzy_map(
     use_partial_token_sort_ratio=False,
     include_score=False,
 ):
-    if sort_func is None:
-        sort_func = _default_sort
-    choices_index = defaultdict(list)
-    for k, v in choices_map.items():
-        choices_index[basic_chars_only(v)].append(k)
-    choices = list(choices_index.keys())
-    scorer = (
-        fuzz.partial_token_sort_ratio
-        if use_partial_token_sort_ratio
-        else fuzz.partial_ratio
-    )
-    query = basic_chars_only(query)
-    result = process.extract(
+    return FuzzyIndex(choices_map).match(
         query,
-        choices,
         limit=limit,
-        processor=None,
-        scorer=scorer,
-        score_cutoff=cutoff,
+        cutoff=cutoff,
+        sort_func=sort_func,
+        use_partial_token_sort_ratio=use_partial_token_sort_ratio,
+        include_score=include_score,
     )
-    fuzz_result = (
-        (k, result_key, score)
-        for result_key, score, _ in result
-        for k in choices_index[result_key]
-    )
-    result = [
-        (k, score) if include_score else k
-        for k, _, score in sorted(
-            fuzz_result,
-            key=_make_sort(sort_func, query),
-            reverse=True,
-        )
-    ]
-    return result
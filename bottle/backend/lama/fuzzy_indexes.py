@@ -0,0 +1,107 @@
+"""FuzzyIndex objects for the text filters of the clip and entity lists,
+patched with the labels of the events changing them. Like the EntityZoo,
+every process has its own and checks the event log for changes (also those
+made by other processes) before using them."""
+
+from lama.database import db
+import lama.eventstore as eventstore
+from lama.fuzzy import FuzzyIndex
+from lama.truth.commands_events import Events
+
+CLIP_LABEL_EVENTS = {
+    Events.ClipCreated,
+    Events.ClipUpdated,
+    Events.ClipDeleted,
+}
+ENTITY_LABEL_EVENTS = {
+    Events.EntityCreated,
+    Events.EntityUpdated,
+    Events.EntityDeleted,
+    Events.EntityRenamedMerged,
+}
+DELETED_EVENTS = {Events.ClipDeleted, Events.EntityDeleted}
+FIELD_EVENTS = {Events.FieldAdded, Events.FieldValueSet}
+
+
+def _changes(collection, events):
+    def _inner(event):
+        event_type = Events[event.event_name]
+        if event_type in FIELD_EVENTS:
+            return event.data["collection"] == collection
+        return event_type in events or event_type == Events.MongoStateLoaded
+
+    return _inner
+
+
+class VersionedIndex(eventstore.EventLogFollower):
+    """An index built with build(load()), changed by the new events of the
+    event log for which changes(event) is true: in place with
+    update(index, event) if given, or (if that returns False) rebuilt."""
+
+    def __init__(self, load, changes, build=FuzzyIndex, update=None):
+        super().__init__()
+        self._load = load
+        self._changes = changes
+        self._build = build
+        self._update = update
+        self._index = None
+
+    def _rebuild(self):
+        self._index = self._build(self._load())
+
+    def _apply(self, event):
+        if not self._changes(event):
+            return True
+        return self._update is not None and self._update(self._index, event)
+
+    def get(self):
+        self.sync()
+        return self._index
+
+
+def _label_title(clip):
+    # like labelTitle in lama.clips.get_clips
+    label = clip.get("label")
+    return label if label is not None else clip.get("title")
+
+
+def _clip_labels():
+    label_titles = (
+        (c["_id"], _label_title(c))
+        for c in db.clips.find({}, {"label": 1, "title": 1})
+    )
+    return {k: v for k, v in label_titles if v is not None}
+
+
+def _entity_labels():
+    return {e["_id"]: e["label"] for e in db.entities.find({}, {"label": 1})}
+
+
+def _label_updater(label, label_fields):
+    # sets the label of the event's document (a created or updated one has
+    # all its fields in the event data)
+    def _update(index, event):
+        event_type = Events[event.event_name]
+        if event_type in FIELD_EVENTS:
+            return event.data["field"] not in label_fields
+        if event_type in (Events.MongoStateLoaded, Events.EntityRenamedMerged):
+            return False  # changes many documents
+        if event_type in DELETED_EVENTS:
+            index.set(event.subject_id, None)
+        else:
+            index.set(event.subject_id, label(event.data))
+        return True
+
+    return _update
+
+
+clip_label_index = VersionedIndex(
+    _clip_labels,
+    _changes("clips", CLIP_LABEL_EVENTS),
+    update=_label_updater(_label_title, ["label", "title"]),
+)
+entity_label_index = VersionedIndex(
+    _entity_labels,
+    _changes("entities", ENTITY_LABEL_EVENTS),
+    update=_label_updater(lambda e: e.get("label"), ["label"]),
+)
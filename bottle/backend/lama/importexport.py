@@ -1,49 +1,52 @@
 """Import or export events from eventlog"""
 
 from datetime import datetime
-
-# from io import StringIO
+from io import BytesIO
 import json
-import re
-from typing import Iterable, List
+from typing import Iterable, Iterator, List
 
 from lxml import etree  # pip install lxml
 
-from lama.eventstore import get_events
+from lama.eventstore import iter_events
 from lama.types_errors import Event
 
 
-def events2xml(events: Iterable[Event]) -> str:
-    root = etree.Element("event_log")
-    for event in events:
-        event_el = etree.Element("event")
-        for i, f in enumerate(event._fields):
-            if f in ["data", "prev_data"]:
-                v = event[i]
-                if v is not None:
-                    el = etree.Element(f)
-                    el.text = etree.CDATA(
-                        json.dumps(v, indent=2, ensure_ascii=False)
-                    )
-                    event_el.append(el)
-            else:
-                event_el.set(f, str(event[i]))
-        root.append(event_el)
+def _event_element(event: Event):
+    event_el = etree.Element("event")
+    for i, f in enumerate(event._fields):
+        if f in ["data", "prev_data"]:
+            v = event[i]
+            if v is not None:
+                el = etree.SubElement(event_el, f)
+                el.text = etree.CDATA(
+                    json.dumps(v, indent=2, ensure_ascii=False)
+                )
+        else:
+            event_el.set(f, str(event[i]))
+    return event_el
 
-    xml = etree.tostring(root, pretty_print=True, encoding=str)
-    with_formatted_attributes = "\n".join(
-        (
-            re.sub(
-                r">$",
-                r"\n  >",
-                re.sub(r" (\w+\=\"[^\"]+\")", r"\n    \1", line),
-            )  # seriously? :)
-            if line.startswith("  <event ") and line.endswith('">')
-            else line
-        )
-        for line in xml.splitlines()
-    )
-    return with_formatted_attributes
+
+def events2xml(events: Iterable[Event]) -> Iterator[bytes]:
+    """The event log document (utf-8), written event by event, in chunks
+    (so the whole log is never in memory)."""
+    buffer = BytesIO()
+
+    def _take():
+        chunk = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return chunk
+
+    with etree.xmlfile(buffer, encoding="utf-8", buffered=False) as xf:
+        xf.write_declaration()
+        with xf.element("event_log"):
+            for event in events:
+                event_el = _event_element(event)
+                etree.indent(event_el, level=1)
+                xf.write("\n  ", event_el)
+                yield _take()
+            xf.write("\n")
+    yield _take()
 
 
 def xml2events(xml_tree_root) -> List[Event]:
@@ -77,15 +80,15 @@ def xml2events(xml_tree_root) -> List[Event]:
 
 
 def get_events_xml():
-    return events2xml(get_events())
+    return events2xml(iter_events())
 
 
 if __name__ == "__main__":
-    xml = get_events_xml()
     now = datetime.now().strftime("%Y%m%d%H%M%S")
     filename = f"dumps/eventlog_{now}.xml"
-    with open(filename, "w", encoding="utf-8") as f:
-        f.write(xml)
+    with open(filename, "wb") as f:
+        for chunk in get_events_xml():
+            f.write(chunk)
     # restored_events = xml2events(xml)
     # assert restored_events == events
     # print("OK")
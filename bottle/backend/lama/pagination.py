@@ -0,0 +1,161 @@
+"""Keyset pagination for the clip and entity lists: a page is selected in
+MongoDB with a predicate on the sort key of the page's neighbour (pageAfter,
+pageBefore) and $limit, instead of sorting everything in Python.
+
+The predicates assume a sort field holds one type of value besides null
+(missing and null sort first, like in MongoDB). Total counts are cached
+until the next event is stored."""
+
+from collections import OrderedDict
+import json
+import math
+from typing import Dict, List, Optional, Tuple
+
+from pymongo.collection import Collection
+
+from lama.database import ASC
+import lama.eventstore as eventstore
+
+# number of cached total counts
+COUNT_CACHE_SIZE = 256
+_count_cache = OrderedDict()  # (collection, filter steps) -> count
+_count_cache_version = None  # event log version of the cached counts
+
+
+def _sort_value(document: Dict, field: str):
+    value = document
+    for part in field.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def _comes_after(field, value, ordering) -> Optional[Dict]:
+    # None: nothing comes after value
+    if ordering == ASC:
+        if value is None:
+            return {field: {"$ne": None}}
+        return {field: {"$gt": value}}
+    if value is None:
+        return None
+    return {"$or": [{field: {"$lt": value}}, {field: None}]}
+
+
+def keyset_match(
+    sort_by: List[Tuple[str, int]], anchor: Dict, after: bool = True
+) -> Dict:
+    """$match stage for the documents after (or before) anchor in the order
+    of sort_by, which has to end with a unique field (_id)."""
+    alternatives = []
+    equal = {}
+    for field, ordering in sort_by:
+        value = _sort_value(anchor, field)
+        comes_after = _comes_after(
+            field, value, ordering if after else -ordering
+        )
+        if comes_after is not None:
+            alternatives.append({**equal, **comes_after})
+        equal[field] = value
+    return {"$match": {"$or": alternatives} if alternatives else {"_id": None}}
+
+
+def _count(collection: Collection, steps: List[Dict]) -> int:
+    result = list(collection.aggregate([*steps, {"$count": "count"}]))
+    return result[0]["count"] if len(result) > 0 else 0
+
+
+def _cached_total_count(collection: Collection, filter_steps: List[Dict]):
+    global _count_cache_version
+    version = eventstore.get_last_event_id()
+    if version != _count_cache_version:
+        _count_cache.clear()
+        _count_cache_version = version
+    key = (
+        collection.name,
+        json.dumps(filter_steps, sort_keys=True, default=str),
+    )
+    count = _count_cache.get(key)
+    if count is None:
+        count = _count(collection, filter_steps)
+        _count_cache[key] = count
+        if len(_count_cache) > COUNT_CACHE_SIZE:
+            _count_cache.popitem(last=False)
+    else:
+        _count_cache.move_to_end(key)
+    return count
+
+
+def get_page(
+    collection: Collection,
+    filter_steps: List[Dict],
+    sort_key_steps: List[Dict],
+    sort_by: List[Tuple[str, int]],
+    output_steps: List[Dict],
+    page_size: int,
+    page_after: Optional[str] = None,
+    page_before: Optional[str] = None,
+) -> Dict:
+    """The page after page_after, before page_before, or the first page,
+    with the same indexes as slicing the whole sorted list.
+
+    sort_key_steps add the computed fields sorted by, sort_by ends with
+    ("_id", 1), output_steps are applied to the documents of the page."""
+    steps = [*filter_steps, *sort_key_steps]
+    sorting_step = {"$sort": OrderedDict(sort_by)}
+    total_count = _cached_total_count(collection, filter_steps)
+    anchor_id = page_after if page_after is not None else page_before
+    if anchor_id is None:
+        anchor_index = None
+    else:
+        anchor = next(
+            collection.aggregate(
+                [
+                    *filter_steps,
+                    {"$match": {"_id": anchor_id}},
+                    *sort_key_steps,
+                ]
+            ),
+            None,
+        )
+        if anchor is None:
+            raise ValueError(f"id not found: {anchor_id}")
+        anchor_index = _count(
+            collection, [*steps, keyset_match(sort_by, anchor, after=False)]
+        )
+    if page_after is not None:
+        page_start_index = anchor_index + 1
+        page_steps = [keyset_match(sort_by, anchor), sorting_step]
+    elif page_before is not None and anchor_index > page_size:
+        page_start_index = anchor_index - page_size
+        page_steps = [
+            keyset_match(sort_by, anchor, after=False),
+            {
+                "$sort": OrderedDict(
+                    (field, -ordering) for field, ordering in sort_by
+                )
+            },
+        ]
+    else:
+        page_start_index = 0
+        page_steps = [sorting_step]
+    items = list(
+        collection.aggregate(
+            [*steps, *page_steps, {"$limit": page_size}, *output_steps]
+        )
+    )
+    if page_before is not None and anchor_index > page_size:
+        items.reverse()
+        page_end_index = anchor_index
+    elif page_before is not None:
+        page_end_index = page_size
+    else:
+        page_end_index = min(total_count, page_start_index + page_size)
+    return {
+        "items": items,
+        "pageSize": page_size,
+        "page": max(math.ceil(page_end_index / page_size) - 1, 0),
+        "totalCount": total_count,
+        "firstIndex": page_start_index,
+        "lastIndex": page_end_index - 1,
+    }
@@ -1,10 +1,18 @@
 """XXX: Get results from query blocks from db"""
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
+import json
+from typing import Dict, List
 
-from lama.clips import get_clips
+from lama.annotation_owners import OWNER_FIELDS, AnnotationOwnersMixin
+from lama.clips import get_clip_labels
 from lama.database import db
+from lama.events import ANNOTATION_EVENTS, ANNOTATIONS_DELETED_EVENTS
+import lama.eventstore as eventstore
+from lama.fuzzy_indexes import FIELD_EVENTS
+from lama.truth.commands_events import Events
 
 # from lama.query_entities import get_queried_entities
 from lama.query_entities_mongo import find_matching_entities
@@ -14,22 +22,112 @@ def _only_keys(d, keys):
     return {k: v for k in keys if (v := d.get(k)) is not None}
 
 
-def _get_missing_annot_ids(annotations, retrieved_annot_ids):
-    return list(
-        set(
-            annot_id
-            for annot_ids in (
-                a.get("constitutedBy", [])
-                + ([a["refersTo"]] if a.get("refersTo", "") else [])
-                for a in annotations
-            )
-            for annot_id in annot_ids
-            if annot_id not in retrieved_annot_ids
-        )
+def _referenced_annot_ids(annotation):
+    return annotation.get("constitutedBy", []) + (
+        [annotation["refersTo"]] if annotation.get("refersTo", "") else []
     )
 
 
-def get_block_result(data):
+# the annotation fields the references are kept for
+REFERENCE_FIELDS = ("constitutedBy", "refersTo", *OWNER_FIELDS)
+
+
+class AnnotationReferences(AnnotationOwnersMixin, eventstore.EventLogFollower):
+    """annotation id -> ids of the annotations it refers to / is constituted
+    by (for the annotations with any), updated with the annotation events."""
+
+    def __init__(self):
+        super().__init__()
+        self._references: Dict[str, List[str]] = {}
+        self._clear_owners()
+
+    def _remove(self, annotation_id: str):
+        self._references.pop(annotation_id, None)
+        self._set_owners(annotation_id, None)
+
+    def _set_annotation(self, annotation_id: str, annotation: Dict):
+        self._remove(annotation_id)
+        references = _referenced_annot_ids(annotation)
+        if references:
+            self._references[annotation_id] = references
+            self._set_owners(annotation_id, annotation)
+
+    def _rebuild(self):
+        self._references = {}
+        self._clear_owners()
+        for a in db.annotations.find(
+            {
+                "$or": [
+                    {"constitutedBy.0": {"$exists": True}},
+                    {"refersTo": {"$nin": [None, ""]}},
+                ]
+            },
+            REFERENCE_FIELDS,
+        ):
+            self._set_annotation(a["_id"], a)
+
+    def _apply(self, event) -> bool:
+        # False if the event can't be applied (rebuild instead)
+        event_type = Events[event.event_name]
+        if event_type in FIELD_EVENTS:
+            if (
+                event.data["collection"] != "annotations"
+                or event.data["field"] not in REFERENCE_FIELDS
+            ):
+                return True
+            if event_type == Events.FieldAdded:
+                return False  # set on all annotations
+            annotation = db.annotations.find_one(
+                {"_id": event.data["_id"]}, REFERENCE_FIELDS
+            )
+            self._set_annotation(event.data["_id"], annotation or {})
+        elif event_type == Events.MongoStateLoaded:
+            return False
+        elif event_type in ANNOTATIONS_DELETED_EVENTS:
+            self._remove_deleted(event)
+        elif event_type == Events.AnnotationDeleted:
+            self._remove(event.subject_id)
+        elif event_type in ANNOTATION_EVENTS:
+            self._set_annotation(event.subject_id, event.data)
+        return True
+
+    def get(self) -> Dict[str, List[str]]:
+        self.sync()
+        return self._references
+
+
+# for running the queries of the blocks concurrently (pymongo is thread-safe)
+QUERY_WORKERS = 4
+_executor = ThreadPoolExecutor(
+    max_workers=QUERY_WORKERS, thread_name_prefix="query-blocks"
+)
+
+annotation_references = AnnotationReferences()
+
+
+def _reference_depths(annot_ids, references):
+    # annotations (transitively) referenced by annot_ids, with the number of
+    # references from the nearest of annot_ids
+    depths = {annot_id: 0 for annot_id in annot_ids}
+    level = list(depths)
+    depth = 0
+    while len(level) > 0:
+        depth += 1
+        next_level = []
+        for annot_id in level:
+            for ref_id in references.get(annot_id, []):
+                if ref_id not in depths:
+                    depths[ref_id] = depth
+                    next_level.append(ref_id)
+        level = next_level
+    return depths
+
+
+def _query_key(query):
+    return json.dumps(query, sort_keys=True)
+
+
+def _matching_annots(data, entities_by_query):
     conj = data["entities"]["conj"]
     qbs = data["entities"]["qbs"]
     relations = data["annotations"]["relations"]
@@ -37,7 +135,7 @@ def get_block_result(data):
     absent_only = data["annotations"]["absentOnly"]
     entities_by_qb = {}
     for qb in qbs:
-        entities_by_qb[qb["id"]] = find_matching_entities(qb["query"])
+        entities_by_qb[qb["id"]] = entities_by_query[_query_key(qb["query"])]
     if conj == "all":
         conj_entities = reduce(
             set.intersection, map(set, entities_by_qb.values())
@@ -46,7 +144,7 @@ def get_block_result(data):
         conj_entities = set(
             e for result in entities_by_qb.values() for e in result
         )
-    matching_annots = list(
+    return list(
         db.annotations.find(
             {
                 "target": {"$in": list(conj_entities)},
@@ -60,47 +158,118 @@ def get_block_result(data):
             }
         )
     )
-    # make sure we also get referenced annotations
-    retrieved_annot_ids = set(a["_id"] for a in matching_annots)
-    additional_annots = []
-    extra_annot_ids = _get_missing_annot_ids(
-        matching_annots, retrieved_annot_ids
+
+
+def get_block_results(blocks):
+    """get_block_result for several blocks: the blocks' entity queries (each
+    distinct one once) and annotation queries run on a thread pool, the
+    referenced annotations, clips and elements of all blocks are fetched
+    together."""
+    references = annotation_references.get()  # synced in this thread
+    queries = {
+        _query_key(qb["query"]): qb["query"]
+        for data in blocks
+        for qb in data["entities"]["qbs"]
+    }
+    entities_by_query = dict(
+        zip(queries, _executor.map(find_matching_entities, queries.values()))
     )
-    while len(extra_annot_ids) > 0:
-        extra_annots = list(
-            db.annotations.find({"_id": {"$in": extra_annot_ids}})
-        )
-        additional_annots += extra_annots
-        retrieved_annot_ids = retrieved_annot_ids.union(
-            set(a["_id"] for a in extra_annots)
+    matching_annots_by_block = list(
+        _executor.map(
+            lambda data: _matching_annots(data, entities_by_query), blocks
         )
-        extra_annot_ids = _get_missing_annot_ids(
-            extra_annots, retrieved_annot_ids
+    )
+    # make sure we also get referenced annotations
+    depths_by_block = [
+        _reference_depths((a["_id"] for a in matching_annots), references)
+        for matching_annots in matching_annots_by_block
+    ]
+    additional_annots = {
+        a["_id"]: a
+        for a in db.annotations.find(
+            {
+                "_id": {
+                    "$in": list(
+                        set(
+                            annot_id
+                            for depths in depths_by_block
+                            for annot_id, depth in depths.items()
+                            if depth > 0
+                        )
+                    )
+                }
+            }
         )
-    clip_ids = set(a["clip"] for a in matching_annots)
+    }
+    clip_ids = set(
+        a["clip"]
+        for matching_annots in matching_annots_by_block
+        for a in matching_annots
+    )
     element_ids = set(
-        el for a in matching_annots if (el := a.get("element")) is not None
+        el
+        for matching_annots in matching_annots_by_block
+        for a in matching_annots
+        if (el := a.get("element")) is not None
     )
     clip_data = {
-        clip["_id"]: _only_keys(clip, ["labelTitle"])
-        for clip in get_clips(filter_clip_ids=list(clip_ids))
+        clip_id: _only_keys(clip, ["labelTitle"])
+        for clip_id, clip in get_clip_labels(list(clip_ids)).items()
     }
     element_data = {
         el["_id"]: _only_keys(el, ["type", "label"])
         for el in db.elements.find({"_id": {"$in": list(element_ids)}})
     }
+    return [
+        _block_result(
+            data,
+            matching_annots,
+            depths,
+            additional_annots,
+            clip_data,
+            element_data,
+        )
+        for data, matching_annots, depths in zip(
+            blocks, matching_annots_by_block, depths_by_block
+        )
+    ]
+
+
+def _block_result(
+    data, matching_annots, depths, additional_annots, clip_data, element_data
+):
+    referenced_annots = [
+        additional_annots[annot_id]
+        for annot_id, depth in depths.items()
+        if depth > 0 and annot_id in additional_annots
+    ]
     annotation_data = {
         **{a["_id"]: a for a in matching_annots},
-        **{a["_id"]: a for a in additional_annots},
+        **{a["_id"]: a for a in referenced_annots},
     }
-    result = {
+    annotation_depths = {
+        annot_id: depths[annot_id] for annot_id in annotation_data
+    }
+    return {
         "blockAnnotations": {data["id"]: [a["_id"] for a in matching_annots]},
+        "annotationDepths": {data["id"]: annotation_depths},
         "annotationData": annotation_data,
-        "clipData": clip_data,
-        "elementData": element_data,
+        "clipData": {
+            a["clip"]: clip_data[a["clip"]]
+            for a in matching_annots
+            if a["clip"] in clip_data
+        },
+        "elementData": {
+            el: element_data[el]
+            for a in matching_annots
+            if (el := a.get("element")) in element_data
+        },
         "intersectionByClip": None,
     }
-    return result
+
+
+def get_block_result(data):
+    return get_block_results([data])[0]
 
 
 def _grouped_by_clip_ids(annots):
@@ -115,6 +284,7 @@ def _merge_block_results(d1, d2):
         k: {**d1[k], **d2[k]}
         for k in [
             "blockAnnotations",
+            "annotationDepths",
             "annotationData",
             "clipData",
             "elementData",
@@ -0,0 +1,253 @@
+"""In-process inverted index over the (normalized) tokens of the annotation
+quotes, for the quote search.
+
+Query tokens match the terms they are, start or are contained in (and, like
+the partial scores of the quote search, the terms containing them with up
+to two characters cut off), which are found in a trigram index over the
+vocabulary. Documents are ranked with BM25, with a boost for query tokens
+found next to each other. The index follows the event log: annotation events
+are applied as they come, as are entity merges (which change the targets)
+and events deleting the annotations of a clip, element etc.; events changing
+annotation fields rebuild it."""
+
+from collections import defaultdict
+import math
+import threading
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from lama.annotation_owners import OWNER_FIELDS, AnnotationOwnersMixin
+from lama.database import db
+from lama.events import ANNOTATION_EVENTS, ANNOTATIONS_DELETED_EVENTS
+import lama.eventstore as eventstore
+from lama.fuzzy import TrigramIndex
+from lama.fuzzy_indexes import FIELD_EVENTS
+from lama.truth.commands_events import Events
+from lama.util import basic_chars_only, basic_chars_only_all
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+# weights of the terms a query token starts or is contained in
+PREFIX_WEIGHT = 0.8
+SUBSTRING_WEIGHT = 0.5
+# added per pair of neighbouring query tokens found next to each other
+PHRASE_BOOST = 1.0
+# query tokens cut off by up to this many characters (down to 3)
+MAX_CUT_OFF = 2
+# number of terms added since the vocabulary's trigram index was built
+# before it is rebuilt (they are searched one by one until then)
+MAX_NEW_TERMS = 1000
+
+
+class QuoteDocument(NamedTuple):
+    quote: str  # normalized
+    target: Optional[str]
+    length: int  # number of tokens
+    terms: Tuple[str, ...]
+
+
+def query_tokens(query: str) -> List[str]:
+    """The tokens of a normalized query that are searched for."""
+    tokens = query.split()
+    return [t for t in tokens if len(t) > 2] or tokens
+
+
+def _token_variants(token: str):
+    # (variant, weight), the token and the token cut off
+    yield token, 1.0
+    for end in range(len(token) - 1, len(token) - MAX_CUT_OFF - 1, -1):
+        if end < 3:
+            break
+        yield token[:end], end / len(token)
+
+
+class QuoteIndex(AnnotationOwnersMixin, eventstore.EventLogFollower):
+    def __init__(self):
+        super().__init__()
+        # request threads search while another one syncs
+        self._lock = threading.RLock()
+        self._docs: Dict[str, QuoteDocument] = {}
+        self._postings = {}  # term -> {annotation id: [positions]}
+        self._total_length = 0
+        self._vocabulary_index = None  # TrigramIndex of the terms
+        self._new_terms = []  # not in _vocabulary_index yet
+        self._clear_owners()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def _clear(self):
+        self._docs.clear()
+        self._postings.clear()
+        self._total_length = 0
+        self._vocabulary_index = None
+        self._new_terms = []
+        self._clear_owners()
+
+    def _add(self, annotation_id: str, quote: str, target=None):
+        positions = defaultdict(list)
+        tokens = quote.split()
+        for position, token in enumerate(tokens):
+            positions[token].append(position)
+        for term, term_positions in positions.items():
+            if term not in self._postings:
+                self._postings[term] = {}
+                self._new_terms.append(term)
+            self._postings[term][annotation_id] = term_positions
+        self._docs[annotation_id] = QuoteDocument(
+            quote, target, len(tokens), tuple(positions)
+        )
+        self._total_length += len(tokens)
+
+    def _remove(self, annotation_id: str):
+        doc = self._docs.pop(annotation_id, None)
+        if doc is None:
+            return
+        self._set_owners(annotation_id, None)
+        for term in doc.terms:
+            term_postings = self._postings[term]
+            term_postings.pop(annotation_id, None)
+            if len(term_postings) == 0:
+                # its string stays in the vocabulary until that is rebuilt
+                del self._postings[term]
+        self._total_length -= doc.length
+
+    def _add_annotations(self, annotations: Iterable[Dict]):
+        annotations = [a for a in annotations if a.get("quotes")]
+        quotes = basic_chars_only_all(a["quotes"] for a in annotations)
+        for annotation, quote in zip(annotations, quotes):
+            self._add(annotation["_id"], quote, annotation.get("target"))
+            self._set_owners(annotation["_id"], annotation)
+
+    def _rebuild(self):
+        self._clear()
+        self._add_annotations(
+            db.annotations.find(
+                {"quotes": {"$exists": True}},
+                ("quotes", "target", *OWNER_FIELDS),
+            )
+        )
+        self._vocabulary_index = TrigramIndex(self._new_terms)
+        self._new_terms = []
+
+    def _retarget(self, old: str, new: str):
+        # like handle_rename_merge_entity does with the annotations
+        for annotation_id, doc in self._docs.items():
+            if doc.target == old:
+                self._docs[annotation_id] = doc._replace(target=new)
+
+    def _apply(self, event) -> bool:
+        # False if the event can't be applied (rebuild instead)
+        event_type = Events[event.event_name]
+        if event_type in FIELD_EVENTS:
+            return event.data["collection"] != "annotations"
+        if event_type == Events.MongoStateLoaded:
+            return False
+        if event_type == Events.EntityRenamedMerged:
+            self._retarget(event.data["old"], event.data["new"])
+        if event_type in ANNOTATIONS_DELETED_EVENTS:
+            self._remove_deleted(event)
+        elif event_type in ANNOTATION_EVENTS:
+            self._remove(event.subject_id)
+            if event_type != Events.AnnotationDeleted:
+                annotation = {**event.data, "_id": event.subject_id}
+                self._add_annotations([annotation])
+        return True
+
+    def sync(self):
+        with self._lock:
+            super().sync()
+
+    def _terms_containing(self, variant: str) -> List[str]:
+        if len(self._new_terms) > MAX_NEW_TERMS:
+            # without the terms no longer in any quote
+            self._vocabulary_index = TrigramIndex(list(self._postings))
+            self._new_terms = []
+        terms = [
+            *self._vocabulary_index.containing(variant),
+            *(t for t in self._new_terms if variant in t),
+        ]
+        # a removed term can be in both, or added again
+        return [t for t in dict.fromkeys(terms) if t in self._postings]
+
+    def _matching_terms(self, token: str) -> Dict[str, float]:
+        # term -> weight
+        if len(token) < 3:
+            return {token: 1.0} if token in self._postings else {}
+        weights = {}
+        for variant, variant_weight in _token_variants(token):
+            for term in self._terms_containing(variant):
+                if term == token:
+                    weight = 1.0
+                elif term.startswith(variant):
+                    weight = PREFIX_WEIGHT * variant_weight
+                else:
+                    weight = SUBSTRING_WEIGHT * variant_weight
+                weights[term] = max(weight, weights.get(term, 0))
+        return weights
+
+    def _bm25(self, term_postings, doc_id, idf, average_length) -> float:
+        frequency = len(term_postings[doc_id])
+        length_norm = 1 - BM25_B + BM25_B * (
+            self._docs[doc_id].length / average_length
+        )
+        return idf * (
+            frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * length_norm)
+        )
+
+    def search(
+        self, query: str, target_ids: Optional[Iterable[str]] = None
+    ) -> List[Tuple[str, float]]:
+        """(annotation id, score) pairs of the quotes matching any token of
+        query, best first; only annotations of target_ids if given."""
+        with self._lock:
+            self.sync()
+            return self._search(query, target_ids)
+
+    def _search(self, query, target_ids):
+        targets = set(target_ids) if target_ids is not None else None
+        n_docs = len(self._docs)
+        if n_docs == 0:
+            return []
+        average_length = max(self._total_length / n_docs, 1)
+        scores = defaultdict(float)
+        # per query token: annotation id -> positions of the matched terms
+        matched_positions = []
+        for token in query_tokens(basic_chars_only(query)):
+            token_scores = {}
+            positions = defaultdict(set)
+            for term, weight in self._matching_terms(token).items():
+                term_postings = self._postings[term]
+                df = len(term_postings)
+                idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                for doc_id, term_positions in term_postings.items():
+                    if targets is not None:
+                        if self._docs[doc_id].target not in targets:
+                            continue
+                    score = weight * self._bm25(
+                        term_postings, doc_id, idf, average_length
+                    )
+                    token_scores[doc_id] = max(
+                        score, token_scores.get(doc_id, 0)
+                    )
+                    positions[doc_id].update(term_positions)
+            for doc_id, score in token_scores.items():
+                scores[doc_id] += score
+            matched_positions.append(positions)
+        for previous, current in zip(matched_positions, matched_positions[1:]):
+            for doc_id, doc_positions in current.items():
+                previous_positions = previous.get(doc_id)
+                if previous_positions and any(
+                    p - 1 in previous_positions for p in doc_positions
+                ):
+                    scores[doc_id] += PHRASE_BOOST
+        return sorted(scores.items(), key=lambda pair: pair[1], reverse=True)
+
+    def quote(self, annotation_id: str) -> str:
+        """The normalized quote of an indexed annotation ("" if another
+        thread's sync removed it since the search)."""
+        with self._lock:
+            doc = self._docs.get(annotation_id)
+        return doc.quote if doc is not None else ""
+
+
+quote_index = QuoteIndex()
@@ -0,0 +1,211 @@
+"""Replaying the event log with buffered bulk writes.
+
+During a sequential replay every handler talks to MongoDB on its own, which
+for the common create/update/delete events means several round trips per
+event. BulkReplayer instead lets those handlers write into a BulkWriteBuffer,
+which sends the writes as ordered, per-collection bulk_write batches. Reads by
+id are answered from the documents the buffer has already written or read
+(read-your-writes), so those handlers behave exactly as in a sequential
+replay. Every other event handler queries or updates MongoDB by other fields,
+so the buffer is flushed before it runs and bypassed while it runs.
+
+Usage:
+
+    with BulkReplayer() as replayer:
+        for event in eventstore.iter_events():
+            replayer.handle(event)
+    update_derived_data()
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+from copy import deepcopy
+from typing import Dict, Union
+
+from pymongo import DeleteOne, InsertOne, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from lama.clips import update_all_clip_annotation_fields
+from lama.database import db, set_write_buffer
+from lama.entity_postings import rebuild_entity_postings
+from lama.entity_usage_count import update_all_usage_counts
+from lama.errors import ReplayError
+from lama.events import handle_event
+from lama.truth.commands_events import Events
+from lama.types_errors import Event
+
+# events whose handlers only use the id based document functions in
+# lama.database (everything else is a barrier, see module docstring)
+BUFFERED_EVENTS = {
+    Events.EntityCreated,
+    Events.EntityUpdated,
+    Events.EntityDeleted,
+    Events.EntityRelationAdded,  # triple store only
+    Events.ClipCreated,
+    Events.ClipUpdated,
+    Events.AnnotationCreated,
+    Events.AnnotationUpdated,
+    Events.AnnotationDeleted,
+    Events.ElementCreated,
+    Events.ElementUpdated,
+    Events.LayerCreated,
+    Events.LayerUpdated,
+    Events.SegmentCreated,
+    Events.SegmentUpdated,
+    Events.SegmentAnnotsUpdated,  # reads the segment by id
+}
+
+MAX_PENDING_OPS = 1000
+MAX_CACHED_DOCUMENTS = 100000
+
+
+class BulkWriteBuffer:
+    def __init__(self):
+        self._ops = defaultdict(list)  # collection name -> pending ops
+        self._op_events = defaultdict(list)  # the event of each pending op
+        self._pending_count = 0
+        self.current_event = None  # the event being handled
+        # (collection name, id) -> current document, None if deleted
+        self._docs: Dict = {}
+        # documents with pending $set ops, but not in _docs
+        self._patched = set()
+
+    @property
+    def pending_count(self) -> int:
+        return self._pending_count
+
+    def _add_op(self, collection_name, op) -> None:
+        self._ops[collection_name].append(op)
+        self._op_events[collection_name].append(self.current_event)
+        self._pending_count += 1
+
+    def _remember(self, collection_name, id_, document) -> None:
+        self._docs[(collection_name, id_)] = document
+        self._patched.discard((collection_name, id_))
+
+    def find_by_id(self, collection_name: str, id_: str) -> Union[Dict, None]:
+        key = (collection_name, id_)
+        if key in self._docs:
+            return deepcopy(self._docs[key])
+        if key in self._patched:
+            self.flush()
+        document = db[collection_name].find_one({"_id": id_})
+        if document is not None:
+            self._remember(collection_name, id_, document)
+            return deepcopy(document)
+        return None
+
+    def insert(self, collection_name: str, document: Dict) -> None:
+        key = (collection_name, document["_id"])
+        if self._docs.get(key) is not None:
+            raise DuplicateKeyError(f"duplicate key {key}")
+        stored = deepcopy(document)
+        self._add_op(collection_name, InsertOne(stored))
+        self._remember(collection_name, document["_id"], stored)
+
+    def replace(self, collection_name: str, document: Dict) -> bool:
+        key = (collection_name, document["_id"])
+        if key not in self._docs:
+            # not seen yet, so the result needs MongoDB's state
+            self.find_by_id(collection_name, document["_id"])
+        if self._docs.get(key) is None:
+            return False
+        stored = deepcopy(document)
+        self._add_op(
+            collection_name, ReplaceOne({"_id": document["_id"]}, stored)
+        )
+        self._remember(collection_name, document["_id"], stored)
+        return True
+
+    def set_fields(self, collection_name: str, id_: str, fields: Dict) -> None:
+        key = (collection_name, id_)
+        self._add_op(collection_name, UpdateOne({"_id": id_}, {"$set": fields}))
+        if key in self._docs:
+            if self._docs[key] is not None:
+                self._docs[key].update(deepcopy(fields))
+        else:
+            self._patched.add(key)
+
+    def delete(self, collection_name: str, id_: str) -> None:
+        self._add_op(collection_name, DeleteOne({"_id": id_}))
+        self._remember(collection_name, id_, None)
+
+    def _write(self, collection_name, ops) -> None:
+        try:
+            db[collection_name].bulk_write(ops, ordered=True)
+        except BulkWriteError as e:
+            # e.g. a duplicate id that is only in MongoDB, not in _docs
+            error = e.details["writeErrors"][0]
+            event = self._op_events[collection_name][error["index"]]
+            raise ReplayError(
+                f"event {event.id} ({event.event_name} {event.subject_id}): "
+                f"{error.get('errmsg')}"
+            ) from e
+
+    def flush(self) -> None:
+        for collection_name, ops in self._ops.items():
+            if len(ops) > 0:
+                self._write(collection_name, ops)
+        self._ops.clear()
+        self._op_events.clear()
+        self._pending_count = 0
+        self._patched.clear()
+        if len(self._docs) > MAX_CACHED_DOCUMENTS:
+            self.forget()
+
+    def forget(self) -> None:
+        """Drop all cached documents (there must be no pending ops)."""
+        self._docs.clear()
+
+
+class BulkReplayer:
+    def __init__(self, max_pending_ops=MAX_PENDING_OPS):
+        self._buffer = BulkWriteBuffer()
+        self._max_pending_ops = max_pending_ops
+
+    def __enter__(self):
+        set_write_buffer(self._buffer)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self._buffer.flush()
+        finally:
+            set_write_buffer(None)
+
+    @contextmanager
+    def paused(self):
+        """Bring MongoDB up to date and bypass the buffer meanwhile, e.g. for
+        writing a snapshot (the cached documents are dropped, as they could
+        be changed meanwhile)."""
+        self._buffer.flush()
+        self._buffer.forget()
+        set_write_buffer(None)
+        try:
+            yield
+        finally:
+            set_write_buffer(self._buffer)
+
+    def handle(self, event: Event) -> None:
+        self._buffer.current_event = event
+        if Events[event.event_name] in BUFFERED_EVENTS:
+            handle_event(event, is_replaying=True)
+            if self._buffer.pending_count >= self._max_pending_ops:
+                self._buffer.flush()
+            return
+        # barrier: MongoDB has to be up to date, and the handler's own writes
+        # (e.g. update_many) would make the cached documents stale
+        with self.paused():
+            handle_event(event, is_replaying=True)
+
+
+def update_derived_data() -> None:
+    """Set the data the handlers leave alone while replaying (is_replaying):
+    entity usage counts, clip annotation fields and entity postings."""
+    print("Setting entity usage counts...")
+    update_all_usage_counts()
+    print("Setting clip annotation fields...")
+    update_all_clip_annotation_fields()
+    print("Building entity postings...")
+    rebuild_entity_postings()
@@ -3,7 +3,6 @@
 import argparse
 import json
 import logging
-import math
 import os
 from datetime import datetime, timezone
 
@@ -30,7 +29,7 @@ from lama.database import (
 from lama.entities import (
     get_entity_by_id,
     get_entities_by_id,
-    get_entities,
+    get_entities_page,
     make_entity_stats_csv,
 )
 from lama.importexport import get_events_xml
@@ -38,23 +37,28 @@ from lama.entity_relations import get_entity_relations
 from lama.clips import (
     get_clip_by_id,
     get_basic_clip_by_id,
-    get_clips,
+    get_clips_page,
     get_favorite_clip_ids,
 )
-from lama.fuzzy import fuzzy_map
+from lama.fuzzy_indexes import clip_label_index, entity_label_index
 from lama.query import (
     get_clips_containing_entities,
     get_clips_excluding_entities,
     get_clips_with_date,
 )
 from lama.entity_zoo import EntityZoo
+from lama.entity_usage_count import start_usage_count_verifier
 
 from lama.query_entities_mongo import find_matching_entities
-from lama.query_blocks import get_block_result, get_intersection_by_clip
+from lama.query_blocks import (
+    get_block_result,
+    get_block_results,
+    get_intersection_by_clip,
+)
 
 from lama.graph import get_graph_data_clip, get_graph_data_entity
 
-from lama.text_search import quote_search
+from lama.text_search import quote_search, quote_search_stream
 
 from lama.errors import (
     IdNotFoundError,
@@ -308,13 +312,6 @@ CLIP_SORT_FIELDS = {
 }
 
 
-def _find_index(items_with_id, item_id):
-    for i, x in enumerate(items_with_id):
-        if x["_id"] == item_id:
-            return i
-    raise ValueError(f"id not found: {item_id}")
-
-
 def _handle_pagination_params():
     try:
         page_size = int(request.query.get("pageSize", 16))
@@ -322,27 +319,13 @@ def _handle_pagination_params():
         page_before = request.query.get("pageBefore")
     except ValueError:  # invalid page size
         abort(400, "pageSize must be an integer")
+    if page_size < 1:
+        abort(400, "pageSize must be at least 1")
     if page_after is not None and page_before is not None:
         abort(400, "can only specify one of pageBefore and pageAfter")
     return (page_size, page_after, page_before)
 
 
-# new pagination logic using ids
-def _get_pagination(items, page_size, last_id=None, first_id=None):
-    if last_id is not None:
-        page_start_index = _find_index(items, last_id) + 1
-        page_end_index = min(len(items), page_start_index + page_size)
-    elif first_id is not None:
-        page_end_index = max(_find_index(items, first_id), page_size)
-        page_start_index = max(page_end_index - page_size, 0)
-    else:
-        page_start_index = 0
-        page_end_index = min(len(items), page_size)
-    page_number = max(math.ceil(page_end_index / page_size) - 1, 0)
-    paginated_slice = items[page_start_index:page_end_index]
-    return (paginated_slice, page_start_index, page_end_index, page_number)
-
-
 def _handle_sort_params(allowed_fields):
     sort_by_q = request.query.get("sortBy", "")
     # sort_pairs = [
@@ -391,6 +374,7 @@ def get_my_favorite_clips(user_id):
 # entitiesAll=(0|1)
 # match=<text>
 # matchDate=<edtf-date as String>
+# matchDateOverlap=(0|1)
 # favoritesOnly=(0|1)
 @route("/clips", "GET")
 def get_the_clips():
@@ -411,6 +395,10 @@ def get_the_clips():
     match_all_q = request.query.get("entitiesAll")
     text_match_q = request.query.getunicode("match")
     date_match_q = request.query.get("matchDate")
+    date_overlap_q = request.query.get("matchDateOverlap", "0")
+    if date_overlap_q not in ("0", "1"):
+        abort(400, "matchDateOverlap must be 0 or 1")
+    date_overlap = date_overlap_q == "1"
     # get the data
     entity_ids = [eid for eid in entity_ids_q.split(",") if eid]
     entity_filter_active = len(entity_ids) > 0
@@ -437,60 +425,55 @@ def get_the_clips():
     entity_filter_clip_ids = matching_clip_ids if entity_filter_active else None
     favorite_clip_ids = get_favorite_clip_ids(get_user_id())
     favorite_filter_clip_ids = favorite_clip_ids if favorites_only else None
-    filter_clip_ids = None
-
-    if entity_filter_clip_ids is not None and favorite_filter_clip_ids is None:
-        filter_clip_ids = entity_filter_clip_ids
-    elif (
-        entity_filter_clip_ids is None and favorite_filter_clip_ids is not None
-    ):
-        filter_clip_ids = favorite_filter_clip_ids
-    elif (
-        entity_filter_clip_ids is not None
-        and favorite_filter_clip_ids is not None
-    ):
-        filter_clip_ids = list(
-            set.intersection(
-                set(entity_filter_clip_ids), set(favorite_filter_clip_ids)
-            )
-        )
-    clips = get_clips(
-        favorite_ids=favorite_clip_ids,
-        sort_by=sort_by,
-        filter_created_by=created_by_q,
-        filter_clip_ids=filter_clip_ids,
-    )
-
-    result = clips
-
     # text filter
+    text_filter_clip_ids = None
     if text_match_q:
         query = text_match_q
-        choices_map = {c["_id"]: c["labelTitle"] for c in clips}
         cutoff = 100
-        matching_clip_ids = set(fuzzy_map(choices_map, query, cutoff=cutoff))
-        result = [c for c in result if c["_id"] in matching_clip_ids]
-
+        text_filter_clip_ids = clip_label_index.get().match(
+            query, cutoff=cutoff
+        )
     # date filter
+    date_filter_clip_ids = None
     if date_match_q:
-        date_matching_clip_ids = get_clips_with_date(date_match_q)
-        result = [c for c in result if c["_id"] in date_matching_clip_ids]
-
-    # pagination
-    (
-        paginated_slice,
-        page_start_index,
-        page_end_index,
-        page_number,
-    ) = _get_pagination(result, page_size, page_after, page_before)
-    # done
+        try:
+            date_filter_clip_ids = get_clips_with_date(
+                date_match_q, date_overlap
+            )
+        except ValueError as e:
+            abort(400, str(e))
+
+    filter_clip_ids = None
+    for clip_ids in [
+        entity_filter_clip_ids,
+        favorite_filter_clip_ids,
+        text_filter_clip_ids,
+        date_filter_clip_ids,
+    ]:
+        if clip_ids is not None:
+            filter_clip_ids = (
+                set(clip_ids)
+                if filter_clip_ids is None
+                else filter_clip_ids.intersection(clip_ids)
+            )
+    page = get_clips_page(
+        page_size,
+        page_after,
+        page_before,
+        favorite_ids=favorite_clip_ids,
+        sort_by=sort_by,
+        filter_created_by=created_by_q,
+        filter_clip_ids=(
+            sorted(filter_clip_ids) if filter_clip_ids is not None else None
+        ),
+    )
     return {
-        "clips": paginated_slice,
-        "pageSize": page_size,
-        "page": page_number,
-        "totalCount": len(result),
-        "firstIndex": page_start_index,
-        "lastIndex": page_end_index - 1,
+        "clips": page["items"],
+        "pageSize": page["pageSize"],
+        "page": page["page"],
+        "totalCount": page["totalCount"],
+        "firstIndex": page["firstIndex"],
+        "lastIndex": page["lastIndex"],
     }
 
 
@@ -628,37 +611,33 @@ def get_the_entities():
     ] or None
     match_all_q = request.query.get("entitiesAll")
     match_all = match_all_q == "1"
-    entities = get_entities(
+    # text filter
+    text_match_q = request.query.getunicode("match")
+    matching_entity_ids = None
+    if text_match_q:
+        query = text_match_q
+        cutoff = 100
+        matching_entity_ids = sorted(
+            entity_label_index.get().match(query, cutoff=cutoff)
+        )
+    page = get_entities_page(
+        page_size,
+        page_after,
+        page_before,
         filter_cats=cats,
         filter_types=types,
         sort_by=sort_by,
         filter_associated_with=assoc_entities_filter,
         match_all=match_all,
+        filter_entity_ids=matching_entity_ids,
     )
-    # text filter
-    text_match_q = request.query.getunicode("match")
-    if text_match_q:
-        query = text_match_q
-        choices_map = {e["_id"]: e["label"] for e in entities}
-        cutoff = 100
-        matching_entity_ids = set(fuzzy_map(choices_map, query, cutoff=cutoff))
-        result = [e for e in entities if e["_id"] in matching_entity_ids]
-    else:
-        result = entities
-    # pagination
-    (
-        paginated_slice,
-        page_start_index,
-        page_end_index,
-        page_number,
-    ) = _get_pagination(result, page_size, page_after, page_before)
     return {
-        "entities": paginated_slice,
-        "pageSize": page_size,
-        "page": page_number,
-        "totalCount": len(result),
-        "firstIndex": page_start_index,
-        "lastIndex": page_end_index - 1,
+        "entities": page["items"],
+        "pageSize": page["pageSize"],
+        "page": page["page"],
+        "totalCount": page["totalCount"],
+        "firstIndex": page["firstIndex"],
+        "lastIndex": page["lastIndex"],
     }
 
 
@@ -701,6 +680,18 @@ def get_entities_autocomplete():
     return {"matches": result, "totalCount": len(result)}
 
 
+@route("/entities/match/stats", "GET")
+def get_entities_autocomplete_stats():
+    """Get the autocomplete cache counters (of the answering worker)
+    Method: GET
+    Produces: application/json
+    Parameters: -
+    Request body: -
+    Response: hits, misses, hitRate, narrowed, size, version
+    """
+    return EntityZoo.get_instance().get_cache_stats()
+
+
 # params:
 # type... comma-separated entity types
 @route("/entities/suggest", "GET")
@@ -1004,7 +995,7 @@ def do_query_intersection():
     Request body: block results
     Response: Results of the intersected query
     """
-    block_results = [get_block_result(b) for b in request.json["blocks"]]
+    block_results = get_block_results(request.json["blocks"])
     return get_intersection_by_clip(block_results)
 
 
@@ -1034,20 +1025,39 @@ def do_graph_data_entity(entity_id):
     return get_graph_data_entity(entity_id, types)
 
 
+# q=<text>
+# personIds=<entityId>(,<entityId>)*
+# pageSize=<number> (default: 16)
+# pageAfter=<annotation id>
+# format=(json|ndjson)
 @route("/search/quotes", "GET")
 def do_search_quotes():
     """Search through quotes
     Method: GET
-    Produces: application/json
-    Parameters: -
+    Produces: application/json (application/x-ndjson with format=ndjson)
+    Parameters: "q": search text; "personIds": comma-separated entity ids; "pageSize", "pageAfter": annotation id; "format": json or ndjson
     Request body: -
-    Response: Quotes, where search string matched
+    Response: Quotes, where search string matched, and pagination information; ndjson: the pagination information, then one line per quote with its clip and element
     """
     q = request.query.getunicode("q", "")
     person_ids = [
         p for p in request.query.get("personIds", "").split(",") if p
     ] or None
-    return quote_search(q, person_ids)
+    page_after = request.query.get("pageAfter")
+    try:
+        page_size = int(request.query.get("pageSize", 16))
+    except ValueError:
+        abort(400, "pageSize must be an integer")
+    if page_size < 1:
+        abort(400, "pageSize must be at least 1")
+    try:
+        if request.query.get("format") == "ndjson":
+            items = quote_search_stream(q, person_ids, page_size, page_after)
+            response.content_type = "application/x-ndjson"
+            return (json.dumps(item) + "\n" for item in items)
+        return quote_search(q, person_ids, page_size, page_after)
+    except ValueError as e:
+        abort(400, str(e))
 
 
 # announcement = ""
@@ -1376,8 +1386,8 @@ def get_events_export():
     Request body: -
     Response: Events in xml
     """
-    response.content_type = "application/xml"
-    return get_events_xml()
+    response.content_type = "application/xml; charset=utf-8"
+    return get_events_xml()  # streamed
 
 
 # defaults: read for GET, write for everything else
@@ -1388,6 +1398,7 @@ PRIVILEGES_OVERRIDES = {
     ("/announce", "POST"): P.a,
     ("/clients", "GET"): P.a,
     ("/entities/byId", "POST"): P.r,
+    ("/entities/match/stats", "GET"): P.a,
     ("/query/block", "POST"): P.r,
     ("/query/entities", "POST"): P.r,
     ("/query/intersection", "POST"): P.r,
@@ -1549,6 +1560,13 @@ def main():
         action="store_true",
         help="enable CORS for localhost",
     )
+    parser.add_argument(
+        "--verify-usage-counts",
+        type=float,
+        default=3600,
+        metavar="SECONDS",
+        help="interval for recounting entity usage counts (0 to disable)",
+    )
     args = parser.parse_args()
 
     if args.cors:
@@ -1556,6 +1574,8 @@ def main():
         LOCALHOST_CORS = True
 
     init_db()
+    if args.verify_usage_counts > 0:
+        start_usage_count_verifier(args.verify_usage_counts)
     ensure_secret(COOKIE_SECRET)
     ensure_secret(JWT_SECRET)
     if args.dev:
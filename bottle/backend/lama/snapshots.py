@@ -0,0 +1,149 @@
+"""Snapshots of the MongoDB projection, tagged with the last event that was
+applied, so a rebuild only has to replay the events after that.
+
+Snapshots are written by scripts/reset_from_eventlog.py (i.e. while nothing
+else writes to MongoDB) and live in a "snapshots" directory next to the event
+log. Each file is gzipped JSON lines: a header line with the event info and
+the projection version of the event handlers, followed by one line per
+document of every collection, derived data included (so the events after it
+can be applied like the server does). Snapshots of another projection version
+or format are ignored."""
+
+import gzip
+import json
+import os
+import re
+from typing import Dict, Iterator, Optional, Tuple
+
+from bson import json_util
+
+from lama.database import db, init_db
+from lama.events import PROJECTION_VERSION
+import lama.eventstore as eventstore
+from lama.types_errors import Event
+from lama.util import get_timestamp
+
+snapshot_dir = os.path.join(
+    os.path.dirname(os.path.abspath(eventstore.db_path)), "snapshots"
+)
+KEEP_SNAPSHOTS = 3
+# 2: with db_state, id_routes, id_counters and entity_postings
+SNAPSHOT_FORMAT = 2
+INSERT_BATCH_SIZE = 1000
+
+_filename_re = re.compile(r"^mongo_(\d+)\.jsonl\.gz$")
+
+
+def _snapshot_path(event_id: int) -> str:
+    return os.path.join(snapshot_dir, f"mongo_{event_id}.jsonl.gz")
+
+
+def _snapshot_paths() -> Iterator[str]:
+    if not os.path.isdir(snapshot_dir):
+        return
+    for filename in os.listdir(snapshot_dir):
+        if _filename_re.match(filename):
+            yield os.path.join(snapshot_dir, filename)
+
+
+def _read_header(path: str) -> Dict:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.loads(f.readline())
+
+
+def write_snapshot(last_event: Event) -> str:
+    """Dump the current MongoDB state; it must reflect exactly the events up
+    to and including `last_event`, derived data included."""
+    os.makedirs(snapshot_dir, exist_ok=True)
+    path = _snapshot_path(last_event.id)
+    tmp_path = path + ".tmp"
+    header = {
+        "lastEventId": last_event.id,
+        "lastEventTimestamp": last_event.timestamp,
+        "projectionVersion": PROJECTION_VERSION,
+        "format": SNAPSHOT_FORMAT,
+        "created": get_timestamp(),
+    }
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        f.write(json.dumps(header) + "\n")
+        for coll in sorted(db.list_collection_names()):
+            for doc in db[coll].find({}):
+                line = json_util.dumps({"collection": coll, "document": doc})
+                f.write(line + "\n")
+    os.replace(tmp_path, path)  # never leave a half-written snapshot
+    _remove_old_snapshots()
+    return path
+
+
+def _is_current(header: Dict) -> bool:
+    # written by handlers producing the same projection, in this format
+    return (
+        header.get("projectionVersion") == PROJECTION_VERSION
+        and header.get("format") == SNAPSHOT_FORMAT
+    )
+
+
+def _is_valid(header: Dict) -> bool:
+    if not _is_current(header):
+        return False
+    # the snapshot belongs to this event log if its last event is still there
+    event = eventstore.get_event(header["lastEventId"])
+    return event is not None and event.timestamp == header["lastEventTimestamp"]
+
+
+def _log_position(header: Dict) -> Tuple[str, int]:
+    return (header["lastEventTimestamp"], header["lastEventId"])
+
+
+def find_latest_snapshot() -> Optional[Tuple[str, Dict]]:
+    """Path and header of the snapshot furthest along the event log."""
+    candidates = []
+    for path in _snapshot_paths():
+        try:
+            header = _read_header(path)
+            if not _is_current(header):
+                print(f"Ignoring snapshot {path} of an older version")
+            elif _is_valid(header):
+                candidates.append((path, header))
+        except (OSError, ValueError, KeyError):
+            print(f"Ignoring unreadable snapshot {path}")
+    if len(candidates) == 0:
+        return None
+    return max(candidates, key=lambda pair: _log_position(pair[1]))
+
+
+def load_snapshot(path: str) -> Dict:
+    """Replace the MongoDB state with the snapshot's; returns its header."""
+    init_db(reset=True)
+    db.db_state.delete_many({})  # replaced by the snapshot's
+    batches = {}
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline())
+        for line in f:
+            item = json_util.loads(line)
+            batch = batches.setdefault(item["collection"], [])
+            batch.append(item["document"])
+            if len(batch) >= INSERT_BATCH_SIZE:
+                db[item["collection"]].insert_many(batch)
+                batch.clear()
+    for coll, batch in batches.items():
+        if len(batch) > 0:
+            db[coll].insert_many(batch)
+    return header
+
+
+def _remove_old_snapshots() -> None:
+    headers = []
+    for path in _snapshot_paths():
+        try:
+            headers.append((path, _log_position(_read_header(path))))
+        except (OSError, ValueError, KeyError):
+            continue
+    by_position = sorted(headers, key=lambda pair: pair[1], reverse=True)
+    for path, _ in by_position[KEEP_SNAPSHOTS:]:
+        os.remove(path)
+
+
+def clear_snapshots() -> None:
+    for path in list(_snapshot_paths()):
+        os.remove(path)
@@ -1,14 +1,34 @@
 """Functions for searching quotes (and other text)"""
 
+from collections import OrderedDict
 import re
+import threading
+from typing import Dict, Iterator, List, Tuple
 
-from lama.clips import get_clips
+from rapidfuzz import fuzz
+
+from lama.clips import get_clip_labels
 from lama.database import db
-from lama.fuzzy import fuzzy_map
+import lama.eventstore as eventstore
+from lama.quote_index import quote_index
 from lama.util import basic_chars_only
 
+# number of best ranked quotes rescored with partial_token_sort_ratio
+FUZZY_RESCORE_LIMIT = 200
+# number of annotations hydrated at once when streaming results
+STREAM_CHUNK_SIZE = 100
+# element fields shown with the quotes
+ELEMENT_FIELDS = {"label": 1, "type": 1}
+# number of ranked results kept for requesting their next pages
+RANKED_CACHE_SIZE = 16
+
+# (query, person ids, event log version) -> ranked annotation ids
+_ranked_cache = OrderedDict()
+_ranked_cache_lock = threading.Lock()
+
 
 def _sort_func(query, id_, match, score):
+    # previous implementation of QuoteScorer (for scripts/bench_scoring.py)
     whole_query_score = len(re.findall(query, match))
     whole_word_score = 0
     whole_word_present_count = 0
@@ -50,99 +70,217 @@ def _sort_func(query, id_, match, score):
     return result
 
 
-def quote_search(query, person_ids=None):
-    if person_ids is None:
-        person_ids = []
+class QuoteScorer:
+    """Ranking key of the quotes for a query, both normalized with
+    basic_chars_only (so they consist of words separated by spaces):
+    occurrences of the query, share of the query tokens (longer than two
+    characters) that occur, their occurrences, and the lengths of the
+    tokens (or tokens cut off by up to two characters) found at the start
+    of a word, and anywhere. The query's tokens and their variants are
+    prepared once, the checks are substring searches."""
+
+    def __init__(self, query: str):
+        self.query = query
+        self.tokens = [w for w in query.split() if len(w) > 2]
+        # the token, then cut off, as long as more than two characters
+        self._variants = [
+            [w[:end] for end in range(len(w), max(len(w) - 3, 2), -1)]
+            for w in self.tokens
+        ]
+        self._word_starts = [
+            [(v, " " + v) for v in variants] for variants in self._variants
+        ]
+
+    def __call__(self, id_, match: str, score):
+        whole_query_score = match.count(self.query) if self.query else 0
+        whole_word_score = 0
+        whole_word_present_count = 0
+        partial_match_score = 0
+        starting_match_score = 0
+        for w, variants, word_starts in zip(
+            self.tokens, self._variants, self._word_starts
+        ):
+            find_count = match.count(w)
+            whole_word_score += find_count
+            whole_word_present_count += min(find_count, 1)
+            for v in variants:
+                if v in match:
+                    partial_match_score += len(v)
+                    break
+            for v, word_start in word_starts:
+                if match.startswith(v) or word_start in match:
+                    starting_match_score += len(v)
+                    break
+        all_query_tokens_score = (
+            whole_word_present_count / len(self.tokens) if self.tokens else 0
+        )
+        return (
+            whole_query_score,
+            all_query_tokens_score,
+            whole_word_score,
+            starting_match_score,
+            partial_match_score,
+            score,
+        )
+
+
+def _ranked_annotation_ids(query, person_ids) -> List[str]:
     person_filter = {"target": {"$in": person_ids}}
-    annots = []
-    if query:
-        text_results = [
-            (a["_id"], a["score"] * 100)
+    if not query:
+        return [
+            a["_id"]
             for a in db.annotations.find(
                 {
-                    "$text": {
-                        "$search": query,
-                    },
+                    "quotes": {"$exists": True},
                     **(person_filter if len(person_ids) > 0 else {}),
                 },
-                {"score": {"$meta": "textScore"}},
+                {"_id": 1},
             )
         ]
-        q_map = {
-            a["_id"]: a["quotes"]
-            for a in db.annotations.find(
-                {
-                    "quotes": {"$exists": True},
-                    **(person_filter if len(person_ids) > 0 else {}),
-                }
-            )
-        }
-        fuzzy_results = fuzzy_map(
-            q_map,
-            query,
-            cutoff=40,
-            sort_func=lambda _a, _b, _c, _d: 1,  # do nothing basically
-            use_partial_token_sort_ratio=True,
-            include_score=True,
+    # rank with the quote index, then rescore the best candidates
+    ranked = quote_index.search(
+        query, person_ids if len(person_ids) > 0 else None
+    )
+    q = basic_chars_only(query)
+    scorer = QuoteScorer(q)
+    fuzzy_scores = {
+        annot_id: fuzz.partial_token_sort_ratio(
+            q, quote_index.quote(annot_id), processor=None
         )
-        combined_results = [
-            *text_results,
-            *fuzzy_results,
-        ]
-        score_map = {annot_id: score for annot_id, score in combined_results}
-        annot_ids = list(set(pair[0] for pair in combined_results))
-        annots = list(db.annotations.find({"_id": {"$in": annot_ids}}))
-        q_map = {a["_id"]: basic_chars_only(a["quotes"]) for a in annots}
-        a_map = {a["_id"]: a for a in annots}
-        q = basic_chars_only(query)
-        annot_ids_with_scores = [
-            (
+        for annot_id, _ in ranked[:FUZZY_RESCORE_LIMIT]
+    }
+    annot_ids_with_scores = [
+        (
+            annot_id,
+            scorer(
                 annot_id,
-                _sort_func(q, annot_id, annot_quote, score_map[annot_id]),
-            )
-            for annot_id, annot_quote in q_map.items()
-        ]
-        filtered_annot_ids_with_scores = [
-            (annot_id, scores)
-            for annot_id, scores in annot_ids_with_scores
-            if any(x > 0 for x in scores[:-1])
-        ]
-        sorted_annot_ids = [
-            annot_id
-            for annot_id, _ in sorted(
-                filtered_annot_ids_with_scores,
-                key=lambda pair: pair[1],
-                reverse=True,
-            )
-        ]
-        annots = [a_map[x] for x in sorted_annot_ids]
-    else:
-        annots = list(
-            db.annotations.find(
-                {
-                    "quotes": {"$exists": True},
-                    **(person_filter if len(person_ids) > 0 else {}),
-                }
-            )
+                quote_index.quote(annot_id),
+                (fuzzy_scores.get(annot_id, 0), score),
+            ),
+        )
+        for annot_id, score in ranked
+    ]
+    filtered_annot_ids_with_scores = [
+        (annot_id, scores)
+        for annot_id, scores in annot_ids_with_scores
+        if any(x > 0 for x in scores[:-1])
+    ]
+    return [
+        annot_id
+        for annot_id, _ in sorted(
+            filtered_annot_ids_with_scores,
+            key=lambda pair: pair[1],
+            reverse=True,
         )
-    clip_ids = list(set(a["clip"] for a in annots))
-    clip_data = {
-        clip["_id"]: clip for clip in get_clips(filter_clip_ids=clip_ids)
+    ]
+
+
+def _cached_ranked_annotation_ids(query, person_ids) -> List[str]:
+    # the next pages of a search are requested before anything changes
+    key = (
+        query,
+        tuple(sorted(set(person_ids))),
+        eventstore.get_last_event_id(),
+    )
+    with _ranked_cache_lock:
+        if key in _ranked_cache:
+            _ranked_cache.move_to_end(key)
+            return _ranked_cache[key]
+    annot_ids = _ranked_annotation_ids(query, person_ids)
+    with _ranked_cache_lock:
+        _ranked_cache[key] = annot_ids
+        if len(_ranked_cache) > RANKED_CACHE_SIZE:
+            _ranked_cache.popitem(last=False)
+    return annot_ids
+
+
+def _page(annot_ids, page_size, page_after) -> Tuple[List[str], Dict]:
+    # the page after the annotation page_after, and pagination info
+    if page_size is not None and page_size < 1:
+        raise ValueError("pageSize must be at least 1")
+    start = 0
+    if page_after is not None:
+        try:
+            start = annot_ids.index(page_after) + 1
+        except ValueError:
+            raise ValueError(f"id not found: {page_after}")
+    end = len(annot_ids) if page_size is None else start + page_size
+    page_ids = annot_ids[start:end]
+    return page_ids, {
+        "pageSize": page_size,
+        "totalCount": len(annot_ids),
+        "firstIndex": start,
+        "lastIndex": start + len(page_ids) - 1,
+        "nextPageAfter": (
+            page_ids[-1] if page_ids and end < len(annot_ids) else None
+        ),
+    }
+
+
+def _hydrate(annot_ids) -> Tuple[Dict, Dict, Dict]:
+    # annotations, and the clip and element fields shown with them
+    a_map = {
+        a["_id"]: a for a in db.annotations.find({"_id": {"$in": annot_ids}})
     }
+    annots = [a_map[x] for x in annot_ids if x in a_map]
+    clip_data = get_clip_labels(list(set(a["clip"] for a in annots)))
     element_ids = set(
         el for a in annots if (el := a.get("element")) is not None
     )
     element_data = {
         el["_id"]: el
-        for el in db.elements.find({"_id": {"$in": list(element_ids)}})
+        for el in db.elements.find(
+            {"_id": {"$in": list(element_ids)}}, ELEMENT_FIELDS
+        )
     }
+    return {a["_id"]: a for a in annots}, clip_data, element_data
+
+
+def quote_search(query, person_ids=None, page_size=None, page_after=None):
+    """Quotes matching query (all quotes if empty), best first; the page
+    after the annotation page_after if page_size is given."""
+    annot_ids, pagination = _page(
+        _cached_ranked_annotation_ids(query, person_ids or []),
+        page_size,
+        page_after,
+    )
+    annotation_data, clip_data, element_data = _hydrate(annot_ids)
     return {
-        "annotationIds": [a["_id"] for a in annots],
-        "annotationData": {a["_id"]: a for a in annots},
+        "annotationIds": [x for x in annot_ids if x in annotation_data],
+        "annotationData": annotation_data,
         "clipData": clip_data,
         "elementData": element_data,
+        **pagination,
     }
 
 
+def quote_search_stream(
+    query, person_ids=None, page_size=None, page_after=None
+) -> Iterator[Dict]:
+    """quote_search as a header with the pagination info followed by one
+    item per annotation (with its clip and element), hydrated in chunks.
+    Ranks before returning, so errors are raised by the call."""
+    annot_ids, pagination = _page(
+        _cached_ranked_annotation_ids(query, person_ids or []),
+        page_size,
+        page_after,
+    )
+
+    def _items():
+        yield pagination
+        for start in range(0, len(annot_ids), STREAM_CHUNK_SIZE):
+            annotation_data, clip_data, element_data = _hydrate(
+                annot_ids[start : start + STREAM_CHUNK_SIZE]
+            )
+            for annot in annotation_data.values():
+                yield {
+                    "annotation": annot,
+                    "clip": clip_data.get(annot["clip"]),
+                    "element": element_data.get(annot.get("element")),
+                }
+
+    return _items()
+
+
 if __name__ == "__main__":
     print(quote_search("austropop danzer fendrich", []))
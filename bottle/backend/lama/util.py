@@ -1,7 +1,9 @@
 """Different utility functions"""
 
 from datetime import datetime, timezone
+from functools import lru_cache
 import re
+from typing import Iterable, List
 
 from unidecode import unidecode
 
@@ -29,7 +31,49 @@ def sorted_enums(es):
 BASIC_CHARS_PAT = re.compile(r"[^a-z0-9 ]")
 
 
-def basic_chars_only(s):
+def _basic_chars_only(s):
     return re.sub(
         BASIC_CHARS_PAT, "", unidecode(replace_umlauts_etc(s.lower()))
     )
+
+
+def _basic_chars(codepoint):
+    return re.sub(BASIC_CHARS_PAT, "", unidecode(chr(codepoint)))
+
+
+class _BasicCharsTable(dict):
+    """str.translate table doing what unidecode and BASIC_CHARS_PAT do to
+    a single character (both work character by character). Filled for
+    Latin-1, other characters are added on first use."""
+
+    def __missing__(self, codepoint):
+        self[codepoint] = _basic_chars(codepoint)
+        return self[codepoint]
+
+
+_BASIC_CHARS_TABLE = _BasicCharsTable((c, _basic_chars(c)) for c in range(256))
+# keeps the strings of a batch apart (removed by the other table)
+_BATCH_SEPARATOR = "\x00"
+_BATCH_TABLE = _BasicCharsTable(_BASIC_CHARS_TABLE)
+_BATCH_TABLE[ord(_BATCH_SEPARATOR)] = _BATCH_SEPARATOR
+
+
+def _translate(s, table):
+    # the umlauts first: "a\u0308" (combining diaeresis) is two characters
+    return replace_umlauts_etc(s.lower()).translate(table)
+
+
+@lru_cache(maxsize=65536)
+def basic_chars_only(s):
+    return _translate(s, _BASIC_CHARS_TABLE)
+
+
+def basic_chars_only_all(strings: Iterable[str]) -> List[str]:
+    """basic_chars_only for many strings at once (without caching them)."""
+    strings = list(strings)
+    if len(strings) == 0:
+        return []
+    if any(_BATCH_SEPARATOR in s for s in strings):
+        return [_translate(s, _BASIC_CHARS_TABLE) for s in strings]
+    joined = _BATCH_SEPARATOR.join(strings)
+    return _translate(joined, _BATCH_TABLE).split(_BATCH_SEPARATOR)
@@ -0,0 +1,229 @@
+"""Tests run against mongomock and a temporary event log (set up before
+lama is imported, as lama.database connects on import)."""
+
+import os
+import tempfile
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+import pymongo  # noqa: E402
+
+pymongo.MongoClient = mongomock.MongoClient
+
+# what lama.database uses, but mongomock doesn't support
+_create_index = mongomock.collection.Collection.create_index
+_aggregate = mongomock.collection.Collection.aggregate
+
+
+def _create_index_without_text(self, key_or_list=None, *args, **kwargs):
+    keys = kwargs.pop("keys", key_or_list)
+    kwargs.pop("collation", None)
+    if isinstance(keys, list) and any(kind == "text" for _, kind in keys):
+        return kwargs.get("name", "text")  # not used by the tests
+    return _create_index(self, keys, *args, **kwargs)
+
+
+def _aggregate_in_memory(self, pipeline, *args, **kwargs):
+    kwargs.pop("allowDiskUse", None)
+    return _aggregate(self, pipeline, *args, **kwargs)
+
+
+mongomock.collection.Collection.create_index = _create_index_without_text
+mongomock.collection.Collection.aggregate = _aggregate_in_memory
+
+_tmp_dir = tempfile.mkdtemp(prefix="lama-tests-")
+os.environ["LAMA_DB_PATH"] = os.path.join(_tmp_dir, "lama.db")
+os.environ["LAMA_USERSTORE_PATH"] = os.path.join(_tmp_dir, "lama_users.db")
+os.environ["LAMA_LOG_PATH"] = os.path.join(_tmp_dir, "debug.log")
+
+from lama.types_errors import Event  # noqa: E402
+
+
+def _event(name, subject_id, data, prev_data=None, version=1):
+    return Event(
+        None, None, name, version, "user", subject_id, data, prev_data
+    )
+
+
+def _entity(type_, label):
+    return {
+        "type": type_,
+        "label": label,
+        "description": "",
+        "authorityURIs": [],
+        "additionalTags": [],
+    }
+
+
+def _clip(n, **fields):
+    return {
+        "type": "Clip",
+        "title": f"Clip {n}",
+        "url": f"http://example.com/{n}",
+        "platform": "_Platform_1",
+        "collections": ["_Collection_1"],
+        "language": ["_Language_1"],
+        "clipType": [],
+        "fileType": "a",
+        "duration": 10,
+        **fields,
+    }
+
+
+def _sample_events():
+    yield _event("EntityCreated", "_Platform_1", _entity("Platform", "ORF"))
+    yield _event(
+        "EntityCreated", "_Collection_1", _entity("Collection", "Coll")
+    )
+    yield _event("EntityCreated", "_Language_1", _entity("Language", "De"))
+    yield _event("EntityCreated", "_Person_1", _entity("Person", "Anna"))
+    yield _event("EntityCreated", "_Person_2", _entity("Person", "Berta"))
+    for n in range(3):
+        clip_id = f"_Clip_{n}"
+        yield _event("ClipCreated", clip_id, _clip(n))
+        yield _event(
+            "ElementCreated",
+            f"_Music_{n}",
+            {
+                "type": "Music",
+                "clip": clip_id,
+                "label": "m",
+                "description": "",
+                "timecodes": [[2, 3], [0, 1]],
+            },
+            version=2,
+        )
+        yield _event(
+            "SegmentCreated",
+            f"_Segment_{n}",
+            {
+                "type": "Segment",
+                "clip": clip_id,
+                "label": "s",
+                "description": "",
+                "timecodes": [[0, 1]],
+                "segmentContains": [],
+            },
+            version=2,
+        )
+        yield _event(
+            "LayerCreated",
+            f"_MusicLayer_{n}",
+            {
+                "type": "MusicLayer",
+                "clip": clip_id,
+                "element": f"_Music_{n}",
+                "label": "l",
+                "description": "",
+                "timecodes": [[0, 1]],
+            },
+            version=2,
+        )
+        for a in range(4):
+            annotation_id = f"_Annotation_{n}_{a}"
+            annotation = {
+                "type": "Annotation",
+                "clip": clip_id,
+                "relation": "RPerson" if a % 2 else "RAssociatedDate",
+                "target": f"_Person_{a % 2 + 1}",
+                "date": f"195{a}",
+                "quotes": "Wien ist schön",
+            }
+            if a == 2:
+                annotation["layer"] = f"_MusicLayer_{n}"
+                annotation["constitutedBy"] = [f"_Annotation_{n}_0"]
+            if a == 3:
+                annotation["element"] = f"_Music_{n}"
+                annotation["refersTo"] = f"_Annotation_{n}_0"
+            yield _event("AnnotationCreated", annotation_id, annotation)
+        updated = {
+            **annotation,
+            "_id": annotation_id,
+            "target": "_Person_1",
+            "refersTo": f"_Annotation_{n}_1",
+        }
+        yield _event(
+            "AnnotationUpdated",
+            annotation_id,
+            updated,
+            {**annotation, "_id": annotation_id},
+        )
+        yield _event(
+            "SegmentAnnotsUpdated",
+            f"_Segment_{n}",
+            {
+                "segment": f"_Segment_{n}",
+                "annotations": [f"_Annotation_{n}_0"],
+            },
+        )
+    yield _event(
+        "AnnotationDeleted",
+        "_Annotation_0_1",
+        {"_id": "_Annotation_0_1"},
+    )
+    yield _event(
+        "ClipUpdated",
+        "_Clip_0",
+        {
+            **_clip(0, title="Neu"),
+            "_id": "_Clip_0",
+            "created": "x",
+            "createdBy": "user",
+        },
+    )
+    yield _event(
+        "EntityUpdated",
+        "_Person_2",
+        {
+            **_entity("Person", "Berta B"),
+            "_id": "_Person_2",
+            "created": "x",
+            "createdBy": "user",
+        },
+    )
+    yield _event("LayerDeleted", "_MusicLayer_0", {"_id": "_MusicLayer_0"})
+    yield _event("ElementDeleted", "_Music_1", {"_id": "_Music_1"})
+    yield _event("ClipDeleted", "_Clip_2", {"_id": "_Clip_2"})
+    yield _event(
+        "EntityRenamedMerged",
+        "_Person_1",
+        {"old": "_Person_1", "new": "_Person_2"},
+    )
+    yield _event("SegmentDeleted", "_Segment_0", {"_id": "_Segment_0"})
+
+
+@pytest.fixture(scope="session")
+def sample_events():
+    """A short history: entities, clips with elements, segments and
+    annotations (with dates, quotes and references), updates, deletes and
+    a merge."""
+    return list(_sample_events())
+
+
+@pytest.fixture
+def apply_event():
+    """Starts from an empty database and event log; applies an event like
+    the server does (handled, then stored)."""
+    from lama.database import get_document_by_id, init_db
+    from lama.events import handle_event
+    import lama.eventstore as eventstore
+    from lama.util import get_timestamp
+
+    init_db(reset=True)
+    eventstore.replace_event_log([])
+
+    def _apply(event):
+        # with the previous data, as in lama.commands.event_from_command
+        name = event.event_name
+        if event.prev_data is None and name.endswith(("Updated", "Deleted")):
+            prev_data = get_document_by_id(event.subject_id)
+            if name == "SegmentAnnotsUpdated":
+                prev_data = prev_data["segmentContains"]
+            event = event._replace(prev_data=prev_data)
+        event = event._replace(timestamp=get_timestamp())
+        handle_event(event)
+        eventstore.store(event)
+
+    return _apply
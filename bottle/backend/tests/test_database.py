@@ -0,0 +1,39 @@
+from lama.database import (
+    allocate_id_suffix,
+    db,
+    get_collection_name,
+    get_document_by_id,
+    id_exists,
+    init_db,
+    register_ids,
+)
+
+
+def test_locate_ids_of_any_collection():
+    init_db(reset=True)
+    db.entities.insert_one({"_id": "_Person_anna", "type": "Person"})
+    db.entities.insert_one({"_id": "imported-1", "type": "Person"})
+    register_ids(["imported-1"], "entities")
+    db.users.insert_one({"_id": "anna", "favoriteClips": []})
+    assert get_collection_name("_Person_anna") == "entities"
+    assert get_collection_name("imported-1") == "entities"
+    assert get_collection_name("anna") == "users"
+    assert get_document_by_id("anna")["favoriteClips"] == []
+    # not the bookkeeping of the ids
+    assert not id_exists("nobody")
+    db.id_counters.insert_one({"_id": "_Person_berta", "next": 1})
+    assert not id_exists("_Person_berta")
+
+
+def test_id_suffixes_follow_the_existing_ids():
+    init_db(reset=True)
+    db.entities.insert_one({"_id": "_Person_anna", "type": "Person"})
+    db.entities.insert_one({"_id": "_Person_anna_2", "type": "Person"})
+    db.entities.insert_one({"_id": "_Person_anna-b_7", "type": "Person"})
+    assert allocate_id_suffix("_Person_anna") == 3
+    assert allocate_id_suffix("_Person_anna") == 4
+    # e.g. imported into another collection
+    db.elements.insert_one({"_id": "_Person_berta_5", "type": "Music"})
+    register_ids(["_Person_berta_5"], "elements")
+    assert allocate_id_suffix("_Person_berta") == 6
+    assert allocate_id_suffix("_Person_carla") == 0
@@ -0,0 +1,25 @@
+from lama.date_index import DateIndex
+
+CONTAINED = ["195", "1950", "1952", "-"]
+OVERLAPPED = ["1950", "1949/1951", "1952-06", "195X", "1953/.."]
+
+
+def _state(index):
+    index.sync()
+    return {
+        "dates": dict(index._dates),
+        "containing": [sorted(index.containing(d)) for d in CONTAINED],
+        "overlapping": [sorted(index.overlapping(d)) for d in OVERLAPPED],
+    }
+
+
+def test_events_apply_like_a_rebuild(sample_events, apply_event):
+    index = DateIndex()
+    index.sync()
+    rebuilds = []
+    index._rebuild = lambda: rebuilds.append(1)
+    for event in sample_events:
+        apply_event(event)
+        assert _state(index) == _state(DateIndex()), event.event_name
+    assert len(index) > 0
+    assert rebuilds == []
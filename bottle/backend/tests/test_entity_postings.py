@@ -0,0 +1,18 @@
+from lama.database import db
+from lama.entity_postings import rebuild_entity_postings
+
+
+def _postings():
+    return {
+        (p["entity"], p["clip"]): p["count"]
+        for p in db.entity_postings.find({})
+    }
+
+
+def test_posting_deltas_match_a_rebuild(sample_events, apply_event):
+    for event in sample_events:
+        apply_event(event)
+        postings = _postings()
+        rebuild_entity_postings()  # the same, so the next events go on
+        assert postings == _postings(), event.event_name
+    assert len(postings) > 0
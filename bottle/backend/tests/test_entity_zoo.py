@@ -0,0 +1,74 @@
+import pytest
+
+import lama.entity_zoo as entity_zoo
+from lama.entity_zoo import EntityZoo, Singleton
+
+QUERIES = ["anna", "berta", "orf", "de", "b"]
+
+
+@pytest.fixture
+def new_zoo(monkeypatch):
+    """Makes another EntityZoo, built from MongoDB (not the index file)."""
+    monkeypatch.setattr(entity_zoo, "read_index", lambda: None)
+
+    def _new_zoo():
+        monkeypatch.setattr(Singleton, "_instances", {})
+        return EntityZoo.get_instance()
+
+    return _new_zoo
+
+
+def _state(zoo):
+    # ties of equal usage counts may be ordered differently
+    return {
+        "entities": sorted(
+            (e["_id"], e.get("usageCount", 0)) for e in zoo.get_entities()
+        ),
+        "matches": [
+            sorted(
+                (e["_id"], e.get("usageCount", 0))
+                for e in zoo.fuzzy_match_entities(query, types, cats_only)
+            )
+            for query in QUERIES
+            for types in (None, ["Person"], ["Platform", "Language"])
+            for cats_only in (False, True)
+        ],
+    }
+
+
+def test_updates_match_a_rebuild(sample_events, apply_event, new_zoo):
+    zoo = new_zoo()
+    _state(zoo)  # builds the fuzzy lookup structures
+    rebuilds = []
+    zoo._rebuild = lambda: rebuilds.append(1)
+    for event in sample_events:
+        apply_event(event)
+        assert _state(zoo) == _state(new_zoo()), event.event_name
+    assert rebuilds == []
+
+
+def _match_ids(zoo, query):
+    return [e["_id"] for e in zoo.fuzzy_match_entities(query)]
+
+
+def _stats_delta(zoo, before):
+    after = zoo.get_cache_stats()
+    return after["hits"] - before["hits"], after["misses"] - before["misses"]
+
+
+def test_label_changes_forget_only_affected_matches(
+    sample_events, apply_event, new_zoo
+):
+    for event in sample_events[:5]:  # the entities
+        apply_event(event)
+    zoo = new_zoo()
+    for query in QUERIES:
+        zoo.fuzzy_match_entities(query)
+    apply_event(
+        next(e for e in sample_events if e.event_name == "EntityUpdated")
+    )  # Berta -> Berta B
+    stats = zoo.get_cache_stats()
+    for query in QUERIES:
+        assert _match_ids(zoo, query) == _match_ids(new_zoo(), query)
+    # "anna", "orf" and "de" can't match "berta b" and stay cached
+    assert _stats_delta(zoo, stats) == (3, 2)
@@ -0,0 +1,25 @@
+import pytest
+from rapidfuzz import fuzz, process
+
+from lama.fuzzy import TrigramIndex
+
+STRINGS = ["wien", "", "wiener walzer", "ab", "graz", "wie"]
+
+
+@pytest.mark.parametrize("query", ["", "w", "wi", "wie", "wien", "wienn"])
+@pytest.mark.parametrize("cutoff", [66, 100])
+def test_extract_is_process_extract(query, cutoff):
+    index = TrigramIndex(list(STRINGS))
+    expected = [
+        (s, score)
+        for s, score, _ in process.extract(
+            query,
+            STRINGS,
+            scorer=fuzz.partial_ratio,
+            processor=None,
+            limit=len(STRINGS),
+            score_cutoff=cutoff,
+        )
+    ]
+    result = index.extract(query, index.all(), len(STRINGS), cutoff)
+    assert result == expected
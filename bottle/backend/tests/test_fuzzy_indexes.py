@@ -0,0 +1,54 @@
+from lama.fuzzy_indexes import (
+    clip_label_index,
+    entity_label_index,
+    VersionedIndex,
+)
+
+QUERIES = ["clip", "clip 1", "neu", "b", "berta b", "ann", "de", ""]
+
+
+def _copy(versioned_index):
+    return VersionedIndex(
+        versioned_index._load,
+        versioned_index._changes,
+        update=versioned_index._update,
+    )
+
+
+def _state(versioned_index):
+    index = versioned_index.get()
+    return [
+        sorted(index.match(query, cutoff=100))
+        for query in QUERIES
+        for _ in range(2)  # the second time with the trigram index
+    ]
+
+
+def _count_rebuilds(versioned_index, rebuilds):
+    rebuild = versioned_index._rebuild
+
+    def _rebuild():
+        rebuilds.append(1)
+        rebuild()
+
+    versioned_index._rebuild = _rebuild
+
+
+def test_events_apply_like_a_rebuild(sample_events, apply_event):
+    clip_labels = _copy(clip_label_index)
+    entity_labels = _copy(entity_label_index)
+    clip_rebuilds, entity_rebuilds = [], []
+    for versioned_index, rebuilds in [
+        (clip_labels, clip_rebuilds),
+        (entity_labels, entity_rebuilds),
+    ]:
+        _state(versioned_index)
+        _count_rebuilds(versioned_index, rebuilds)
+    for event in sample_events:
+        apply_event(event)
+        for versioned_index in [clip_labels, entity_labels]:
+            assert _state(versioned_index) == _state(
+                _copy(versioned_index)
+            ), event.event_name
+    assert clip_rebuilds == []
+    assert entity_rebuilds == [1]  # merging entities
@@ -0,0 +1,52 @@
+from lama.clips import get_clips_page
+from lama.database import ASC, DESC
+from lama.entities import get_entities_page
+
+CLIP_SORTS = [
+    [],
+    [("labelTitle", ASC)],
+    [("annotationCount", DESC)],
+    [("updatedAny", DESC), ("duration", ASC)],
+]
+ENTITY_SORTS = [
+    [],
+    [("label", ASC)],
+    [("usageCount", DESC)],
+    [("updated", DESC), ("description", ASC)],  # by type: not in mongomock
+]
+PAGE_SIZE = 2
+
+
+def _ids(page):
+    return [item["_id"] for item in page["items"]]
+
+
+def _check_pages(get_page, sort_by):
+    # the keyset pages are slices of the whole sorted list
+    ids = _ids(get_page(1000, sort_by=sort_by))
+    paged = []
+    page_after = None
+    while True:
+        page = get_page(PAGE_SIZE, page_after, sort_by=sort_by)
+        assert page["totalCount"] == len(ids)
+        start = page["firstIndex"]
+        assert _ids(page) == ids[start : page["lastIndex"] + 1]
+        paged.extend(_ids(page))
+        if page["lastIndex"] + 1 >= len(ids):
+            break
+        page_after = paged[-1]
+    assert paged == ids
+    for i, anchor in enumerate(ids):
+        page = get_page(PAGE_SIZE, page_before=anchor, sort_by=sort_by)
+        expected = ids[i - PAGE_SIZE : i] if i > PAGE_SIZE else ids[:PAGE_SIZE]
+        assert _ids(page) == expected
+        assert page["firstIndex"] == ids.index(expected[0])
+
+
+def test_pages_follow_the_events(sample_events, apply_event):
+    for event in sample_events:
+        apply_event(event)
+        for sort_by in CLIP_SORTS:
+            _check_pages(get_clips_page, sort_by)
+        for sort_by in ENTITY_SORTS:
+            _check_pages(get_entities_page, sort_by)
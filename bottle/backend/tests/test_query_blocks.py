@@ -0,0 +1,15 @@
+from lama.query_blocks import AnnotationReferences
+
+
+def test_events_apply_like_a_rebuild(sample_events, apply_event):
+    references = AnnotationReferences()
+    references.sync()
+    rebuilds = []
+    references._rebuild = lambda: rebuilds.append(1)
+    for event in sample_events:
+        apply_event(event)
+        expected = AnnotationReferences().get()
+        assert references.get() == expected, event.event_name
+        assert references._owner_keys.keys() == expected.keys()
+    assert len(references.get()) > 0
+    assert rebuilds == []
@@ -0,0 +1,121 @@
+import pytest
+
+from lama.database import init_db
+from lama.events import handle_event
+import lama.eventstore as eventstore
+from lama.quote_index import QuoteIndex
+from lama.types_errors import Event
+from lama.util import get_timestamp
+
+
+def _run(name, subject_id, data, prev_data=None, version=1):
+    event = Event(
+        None,
+        get_timestamp(),
+        name,
+        version,
+        "user",
+        subject_id,
+        data,
+        prev_data,
+    )
+    handle_event(event)
+    eventstore.store(event)
+
+
+def _entity(type_, label):
+    return {
+        "type": type_,
+        "label": label,
+        "description": "",
+        "authorityURIs": [],
+        "additionalTags": [],
+    }
+
+
+@pytest.fixture
+def clip():
+    init_db(reset=True)
+    eventstore.replace_event_log([])
+    _run("EntityCreated", "_Person_1", _entity("Person", "Anna"))
+    _run("EntityCreated", "_Person_2", _entity("Person", "Berta"))
+    _run(
+        "ClipCreated",
+        "_Clip_1",
+        {
+            "type": "Clip",
+            "title": "Clip",
+            "url": "http://example.com/1",
+            "collections": [],
+            "language": [],
+            "clipType": [],
+            "fileType": "a",
+            "duration": 10,
+        },
+    )
+    return "_Clip_1"
+
+
+def _annotation(clip, target, quotes):
+    return {
+        "type": "Annotation",
+        "clip": clip,
+        "relation": "RPerson",
+        "target": target,
+        "quotes": quotes,
+    }
+
+
+def _ids(results):
+    return sorted(annotation_id for annotation_id, _ in results)
+
+
+def test_merge_retargets_the_quotes(clip, monkeypatch):
+    _run(
+        "AnnotationCreated",
+        "_Annotation_1",
+        _annotation(clip, "_Person_1", "Wien ist schön"),
+    )
+    _run(
+        "AnnotationCreated",
+        "_Annotation_2",
+        _annotation(clip, "_Person_2", "der Walzer aus Wien"),
+    )
+    index = QuoteIndex()
+    assert _ids(index.search("wien", ["_Person_2"])) == ["_Annotation_2"]
+    rebuilds = []
+    monkeypatch.setattr(index, "_rebuild", lambda: rebuilds.append(1))
+    _run(
+        "EntityRenamedMerged",
+        "_Person_1",
+        {"old": "_Person_1", "new": "_Person_2"},
+    )
+    merged = index.search("wien", ["_Person_2"])
+    assert _ids(merged) == ["_Annotation_1", "_Annotation_2"]
+    assert index.search("wien", ["_Person_1"]) == []
+    assert rebuilds == []
+    assert merged == QuoteIndex().search("wien", ["_Person_2"])
+
+
+def _state(index):
+    index.sync()
+    return {
+        "docs": dict(index._docs),
+        "results": [
+            sorted((i, round(score, 9)) for i, score in index.search(q, p))
+            for q in ("wien", "schön", "ist wien", "wein")
+            for p in (None, ["_Person_2"])
+        ],
+    }
+
+
+def test_events_apply_like_a_rebuild(sample_events, apply_event):
+    index = QuoteIndex()
+    index.sync()
+    rebuilds = []
+    index._rebuild = lambda: rebuilds.append(1)
+    for event in sample_events:
+        apply_event(event)
+        assert _state(index) == _state(QuoteIndex()), event.event_name
+    assert len(index) > 0
+    assert rebuilds == []
@@ -0,0 +1,98 @@
+from bson import json_util
+import pytest
+
+from lama.database import db, init_db
+from lama.events import handle_event
+import lama.eventstore as eventstore
+from lama.errors import ReplayError
+from lama.replay import BulkReplayer
+import lama.snapshots as snapshots
+
+
+def _timestamp(n):
+    return f"2021-01-01T00:{n // 60:02d}:{n % 60:02d}+00:00"
+
+
+@pytest.fixture(scope="module")
+def event_log(sample_events):
+    eventstore.replace_event_log([])
+    for n, event in enumerate(sample_events):
+        eventstore.store(event._replace(timestamp=_timestamp(n)))
+    return list(eventstore.iter_events())
+
+
+def _dump():
+    return {
+        coll: [
+            json_util.dumps(doc) for doc in db[coll].find({}).sort("_id", 1)
+        ]
+        for coll in sorted(db.list_collection_names())
+        # contains the initialization timestamp, and ObjectIds
+        if coll not in ["db_state", "entity_postings"]
+    }
+
+
+def _dump_with_postings():
+    postings = sorted(
+        (p["entity"], p["clip"], p["count"])
+        for p in db.entity_postings.find({})
+    )
+    return {**_dump(), "entity_postings": postings}
+
+
+def _replay_sequential(events):
+    init_db(reset=True)
+    for event in events:
+        handle_event(event, is_replaying=True)
+    return _dump()
+
+
+def _replay_bulk(events, max_pending_ops=1000):
+    init_db(reset=True)
+    with BulkReplayer(max_pending_ops) as replayer:
+        for event in events:
+            replayer.handle(event)
+    return _dump()
+
+
+def test_bulk_replay_matches_sequential_replay(event_log):
+    expected = _replay_sequential(event_log)
+    assert len(expected["annotations"]) > 0
+    assert _replay_bulk(event_log) == expected
+
+
+def test_bulk_replay_with_small_batches(event_log):
+    expected = _replay_sequential(event_log)
+    assert _replay_bulk(event_log, max_pending_ops=3) == expected
+
+
+def test_bulk_write_error_names_the_event(event_log):
+    _replay_sequential(event_log)
+    # the clip is in MongoDB, but not among the buffer's documents
+    duplicate = next(e for e in event_log if e.event_name == "ClipCreated")
+    with pytest.raises(ReplayError, match=f"event {duplicate.id} "):
+        with BulkReplayer() as replayer:
+            replayer.handle(duplicate)
+
+
+
+def test_events_after_a_snapshot_apply_like_all_events(
+    sample_events, apply_event, tmp_path, monkeypatch
+):
+    # (the usage counts can't be recomputed with mongomock, so the derived
+    # data is kept up to date like the server does)
+    monkeypatch.setattr(snapshots, "snapshot_dir", str(tmp_path))
+    for event in sample_events:  # stored with their previous data
+        apply_event(event)
+    expected = _dump_with_postings()
+    events = list(eventstore.iter_events())
+    for n in [1, len(events) // 2, len(events) - 1]:
+        init_db(reset=True)
+        for event in events[:n]:
+            handle_event(event)
+        path = snapshots.write_snapshot(events[n - 1])
+        snapshots.load_snapshot(path)
+        assert db.db_state.count_documents({}) == 1
+        for event in events[n:]:
+            handle_event(event)
+        assert _dump_with_postings() == expected, n
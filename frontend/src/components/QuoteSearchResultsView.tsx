@@ -64,10 +64,10 @@ const useStyles = makeStyles(theme =>
   }),
 );
 
-const COUNT = 50;
-
 interface Props {
   resultData: SearchResult | null;
+  loading?: boolean;
+  onShowMore?: () => void;
 }
 
 interface ResultCountInfoProps {
@@ -90,25 +90,23 @@ const ResultCountInfo: React.FC<ResultCountInfoProps> = ({
   );
 };
 
-export const QuoteSearchResultsView: React.FC<Props> = ({ resultData }) => {
+export const QuoteSearchResultsView: React.FC<Props> = ({
+  resultData,
+  loading = false,
+  onShowMore,
+}) => {
   const classes = useStyles();
   const dispatch = useDispatch();
-  const [showCount, setShowCount] = React.useState(COUNT);
-  React.useEffect(
-    function () {
-      setShowCount(COUNT);
-    },
-    [resultData],
-  );
   if (!resultData) {
     return null;
   }
-  const resultCount = resultData.annotationIds.length;
+  // the results are requested page by page
+  const showCount = resultData.annotationIds.length;
+  const resultCount = resultData.totalCount;
   return (
     <div>
       <ResultCountInfo showCount={showCount} resultCount={resultCount} />
       {resultData.annotationIds
-        .slice(0, showCount)
         .map(annotId => resultData.annotationData[annotId])
         .map(annot => (
           <Paper key={annot._id} className={classes.quoteContainer}>
@@ -164,12 +162,11 @@ export const QuoteSearchResultsView: React.FC<Props> = ({ resultData }) => {
       {resultCount > 0 && (
         <ResultCountInfo showCount={showCount} resultCount={resultCount} />
       )}
-      {resultCount > showCount && (
+      {resultData.nextPageAfter && onShowMore && (
         <Button
           className={classes.button}
-          onClick={function () {
-            setShowCount(prev => prev + COUNT);
-          }}
+          disabled={loading}
+          onClick={onShowMore}
         >
           Show more
         </Button>
@@ -23,6 +23,12 @@ import { getQuoteSearch, SearchResult } from '../services/api';
 
 import { EmptyObject } from '../types';
 
+// quotes requested at a time
+const PAGE_SIZE = 50;
+
+// results with the search they belong to (for requesting more of them)
+type ShownResults = SearchResult & { query: string; personIds: string[] };
+
 const useStyles = makeStyles(theme =>
   createStyles({
     root: {
@@ -75,15 +81,50 @@ export const SearchLand: React.FC<EmptyObject> = () => {
   const [searchStr, setSearchStr] = React.useState('');
   const [personIds, setPersonIds] = React.useState<string[]>([]);
   const [loading, setLoading] = React.useState(false);
-  const [searchResults, setSearchResults] = React.useState<SearchResult | null>(
+  const [searchResults, setSearchResults] = React.useState<ShownResults | null>(
     null,
   );
   const handleSearch = function () {
     (async function () {
       try {
         setLoading(true);
-        const result = await getQuoteSearch(searchStr, personIds);
-        setSearchResults(result);
+        const result = await getQuoteSearch(searchStr, personIds, PAGE_SIZE);
+        setSearchResults({ ...result, query: searchStr, personIds });
+      } catch (err) {
+        // eslint-disable-next-line no-console
+        console.log(err);
+      } finally {
+        setLoading(false);
+      }
+    })();
+  };
+  const handleShowMore = function () {
+    if (!searchResults || !searchResults.nextPageAfter) {
+      return;
+    }
+    const previous = searchResults;
+    (async function () {
+      try {
+        setLoading(true);
+        // the search of the shown results, not the one in the inputs
+        const result = await getQuoteSearch(
+          previous.query,
+          previous.personIds,
+          PAGE_SIZE,
+          previous.nextPageAfter ?? undefined,
+        );
+        setSearchResults({
+          ...result,
+          query: previous.query,
+          personIds: previous.personIds,
+          annotationIds: [...previous.annotationIds, ...result.annotationIds],
+          annotationData: {
+            ...previous.annotationData,
+            ...result.annotationData,
+          },
+          clipData: { ...previous.clipData, ...result.clipData },
+          elementData: { ...previous.elementData, ...result.elementData },
+        });
       } catch (err) {
         // eslint-disable-next-line no-console
         console.log(err);
@@ -134,7 +175,11 @@ export const SearchLand: React.FC<EmptyObject> = () => {
       {searchResults && (
         <div className={classes.results}>
           <div>
-            <QuoteSearchResultsView resultData={searchResults} />
+            <QuoteSearchResultsView
+              resultData={searchResults}
+              loading={loading}
+              onShowMore={handleShowMore}
+            />
           </div>
         </div>
       )}
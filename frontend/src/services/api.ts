@@ -364,17 +364,26 @@ export async function getGraphDataEntity(
 export type SearchResult = {
   annotationIds: string[];
   annotationData: Record<string, Annotation>;
-  clipData: Record<string, ClipBasicResp>;
-  elementData: Record<string, ClipElement>;
+  clipData: Record<string, Pick<ClipBasicResp, '_id' | 'labelTitle'>>;
+  elementData: Record<string, Pick<ClipElement, '_id' | 'label' | 'type'>>;
+  pageSize: number;
+  totalCount: number;
+  firstIndex: number;
+  lastIndex: number;
+  nextPageAfter: string | null;
 };
 
 export async function getQuoteSearch(
   query: string,
   personIds: string[] = [],
+  pageSize?: number,
+  pageAfter?: string,
 ): Promise<SearchResult> {
   return request('GET', 'search/quotes', undefined, {
     q: query,
     personIds: personIds.join(','),
+    pageSize,
+    pageAfter,
   });
 }
 
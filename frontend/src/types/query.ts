@@ -60,6 +60,8 @@ type BlockAnnotations = Record<string, string[]>; // block id to annotation ids
 
 export interface QueryResultData {
   blockAnnotations: BlockAnnotations;
+  // block id to annotation id to number of references from a block result
+  annotationDepths?: Record<string, Record<string, number>>;
   annotationData: Record<string, Annotation>;
   clipData: Record<string, Pick<ClipBasicResp, 'labelTitle'>>;
   elementData: Record<string, Pick<ClipElement, 'label' | 'type'>>;
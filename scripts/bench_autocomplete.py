@@ -0,0 +1,123 @@
+"""Benchmark: autocomplete (EntityZoo.fuzzy_match_entities) latency.
+
+Usage: python scripts/bench_autocomplete.py [number of queries]
+
+Builds the entity cache from synthetic entities (10k, 100k, 1M; MongoDB and
+the configured lama.db are not used) and reports p50/p99 latency of the
+trigram index + cdist scoring, compared with scoring every label with
+process.extract.
+"""
+
+import os
+import random
+import sys
+import tempfile
+from collections import OrderedDict
+from timeit import default_timer as timer
+
+_tmp_dir = tempfile.TemporaryDirectory()
+os.environ["LAMA_DB_PATH"] = os.path.join(_tmp_dir.name, "bench.db")
+
+from rapidfuzz import fuzz, process  # noqa: E402
+
+from lama.entity_zoo import EntityZoo  # noqa: E402
+from lama.util import basic_chars_only  # noqa: E402
+
+SIZES = [10_000, 100_000, 1_000_000]
+TYPES = ["Person", "Place", "Topic", "PieceOfMusic", "Organization"]
+SYLLABLES = [
+    "wien", "an", "na", "ma", "ri", "ös", "ter", "reich", "haus", "berg",
+    "stra", "ße", "ka", "rl", "jo", "han", "ner", "sin", "fo", "nie",
+    "wal", "zer", "lied", "oper", "mül", "ler", "hu", "ber", "graz", "linz",
+]  # fmt: skip
+
+
+def _label(rng):
+    words = [
+        "".join(rng.choices(SYLLABLES, k=rng.randint(1, 4)))
+        for _ in range(rng.randint(1, 3))
+    ]
+    return " ".join(words).title()
+
+
+def _make_zoo(n, rng):
+    zoo = object.__new__(EntityZoo)  # not the process wide instance
+    zoo.__init__()
+    entities = sorted(
+        (
+            {
+                "_id": f"_{t}_{i}",
+                "type": t,
+                "label": _label(rng),
+                "usageCount": int(rng.paretovariate(1.5)),
+            }
+            for i in range(n)
+            for t in [rng.choice(TYPES)]
+        ),
+        key=lambda e: e["usageCount"],
+        reverse=True,
+    )
+    zoo._entities_map = OrderedDict((e["_id"], e) for e in entities)
+    zoo._event_log_version = 0  # the temporary event log is empty
+    return zoo
+
+
+def _queries(zoo, n_queries, rng):
+    labels = [e["label"] for e in zoo._entities_map.values()]
+    queries = []
+    for _ in range(n_queries):
+        label = rng.choice(labels)
+        start = rng.randrange(len(label))
+        query = label[start : start + rng.randint(1, 10)]
+        if rng.random() < 0.3 and len(query) > 3:  # typo
+            i = rng.randrange(len(query))
+            query = query[:i] + rng.choice("aeiou") + query[i + 1 :]
+        types = [rng.choice(TYPES)] if rng.random() < 0.3 else None
+        queries.append((query, types))
+    return queries
+
+
+def _percentiles(latencies):
+    latencies = sorted(latencies)
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    return f"p50 {p50 * 1000:8.2f} ms   p99 {p99 * 1000:8.2f} ms"
+
+
+def _extract_all(zoo, query, types):
+    # the previous implementation: score every (filtered) label
+    choices = zoo._fuzzy_choices(types, False).strings
+    cutoff = 100 if len(query) < 3 else 66
+    return process.extract(
+        basic_chars_only(query),
+        choices,
+        limit=50,
+        processor=None,
+        scorer=fuzz.partial_ratio,
+        score_cutoff=cutoff,
+    )
+
+
+def main():
+    n_queries = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rng = random.Random(1)
+    for size in SIZES:
+        zoo = _make_zoo(size, rng)
+        start = timer()
+        zoo.fuzzy_match_entities("warmup")  # builds the lookup structures
+        print(f"{size} entities, index built in {timer() - start:.1f}s")
+        queries = _queries(zoo, n_queries, rng)
+        for name, func in [
+            ("trigram index", zoo.fuzzy_match_entities),
+            ("extract all", lambda q, types: _extract_all(zoo, q, types)),
+        ]:
+            latencies = []
+            for query, types in queries:
+                start = timer()
+                func(query, types=types)
+                latencies.append(timer() - start)
+            print(f"  {name:14} {_percentiles(latencies)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Benchmark: events per second for per-event commits vs. commits of
+batches of events (what grouping concurrent writes would gain).
+
+Usage: python scripts/bench_eventstore.py [number of events] [batch size]
+
+Uses a temporary event log, the configured lama.db is not touched.
+"""
+
+import os
+import sys
+import tempfile
+from timeit import default_timer as timer
+
+_tmp_dir = tempfile.TemporaryDirectory()
+os.environ["LAMA_DB_PATH"] = os.path.join(_tmp_dir.name, "bench.db")
+
+import lama.eventstore as eventstore  # noqa: E402
+from lama.types_errors import Event  # noqa: E402
+from lama.util import get_timestamp  # noqa: E402
+
+
+def _make_event(i):
+    return Event(
+        None,
+        get_timestamp(),
+        "AnnotationUpdated",
+        1,
+        "bench",
+        f"_Annotation_{i}",
+        {"_id": f"_Annotation_{i}", "quotes": "lorem ipsum " * 20},
+        {"_id": f"_Annotation_{i}", "quotes": "dolor sit amet " * 20},
+    )
+
+
+def _store_batch(events):
+    # one transaction (one fsync) for all the events
+    with eventstore.conn:
+        eventstore.conn.executemany(
+            eventstore._insert_sql(), map(eventstore._event_values, events)
+        )
+
+
+def _run(store_all, n_events):
+    events = [_make_event(i) for i in range(n_events)]
+    eventstore.clear_events()
+    start = timer()
+    store_all(events)
+    elapsed = timer() - start
+    (count,) = eventstore.conn.execute("SELECT COUNT(*) FROM events").fetchone()
+    assert count == n_events, (count, n_events)
+    return n_events / elapsed
+
+
+def main():
+    n_events = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    print(f"{n_events} events, batches of {batch_size}")
+    per_event = _run(
+        lambda events: [eventstore.store(e) for e in events], n_events
+    )
+    print(f"per-event commit: {per_event:10.0f} events/s")
+    batched = _run(
+        lambda events: [
+            _store_batch(events[i : i + batch_size])
+            for i in range(0, len(events), batch_size)
+        ],
+        n_events,
+    )
+    print(f"batched commit:   {batched:10.0f} events/s")
+    print(f"speedup:          {batched / per_event:10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
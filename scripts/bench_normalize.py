@@ -0,0 +1,80 @@
+"""Benchmark: basic_chars_only normalization over the labels in MongoDB.
+
+Usage: python scripts/bench_normalize.py [repetitions]
+
+Normalizes all entity labels, clip labels and titles and annotation quotes
+with the previous implementation (str.replace chain, unidecode, regex), the
+translation table (one call per string, uncached), the batch API and the
+memoized function (second pass, i.e. all cached), and checks that all of
+them agree.
+"""
+
+import sys
+from timeit import default_timer as timer
+
+from lama.database import db
+from lama.util import (
+    _basic_chars_only,
+    basic_chars_only,
+    basic_chars_only_all,
+)
+
+
+def _corpus():
+    return {
+        "entity labels": [
+            e["label"] for e in db.entities.find({}, {"label": 1})
+        ],
+        "clip labels/titles": [
+            s
+            for c in db.clips.find({}, {"label": 1, "title": 1})
+            for s in (c.get("label"), c.get("title"))
+            if isinstance(s, str)
+        ],
+        "annotation quotes": [
+            a["quotes"]
+            for a in db.annotations.find(
+                {"quotes": {"$type": "string"}}, {"quotes": 1}
+            )
+        ],
+    }
+
+
+def _time(func, strings, repetitions):
+    best = None
+    for _ in range(repetitions):
+        start = timer()
+        result = func(strings)
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    uncached = basic_chars_only.__wrapped__
+    for name, strings in _corpus().items():
+        n_chars = sum(len(s) for s in strings)
+        print(f"{name}: {len(strings)} strings, {n_chars} characters")
+        if len(strings) == 0:
+            continue
+        basic_chars_only.cache_clear()
+        basic_chars_only_all(strings)  # fill the table for non Latin-1
+        timings = [
+            ("previous", lambda ss: [_basic_chars_only(s) for s in ss]),
+            ("table", lambda ss: [uncached(s) for s in ss]),
+            ("batch", basic_chars_only_all),
+            ("memoized", lambda ss: [basic_chars_only(s) for s in ss]),
+        ]
+        expected = None
+        for label, func in timings:
+            elapsed, result = _time(func, strings, repetitions)
+            if expected is None:
+                expected = result
+            elif result != expected:
+                print(f"  {label} differs from the previous implementation!")
+            print(f"  {label:10} {elapsed * 1000:9.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
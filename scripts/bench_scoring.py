@@ -0,0 +1,83 @@
+"""Benchmark: ranking quote search candidates with QuoteScorer.
+
+Usage: python scripts/bench_scoring.py [query ...]
+
+Scores 10000 candidates (the normalized annotation quotes in MongoDB,
+repeated as needed) for each query with the previous implementation
+(_sort_func, regexes per candidate) and QuoteScorer, and checks that both
+give the same scores.
+"""
+
+from itertools import cycle, islice
+import sys
+from timeit import default_timer as timer
+
+from lama.database import db
+from lama.text_search import QuoteScorer, _sort_func
+from lama.util import basic_chars_only, basic_chars_only_all
+
+N_CANDIDATES = 10000
+REPETITIONS = 5
+DEFAULT_QUERIES = ["wien", "land der berge", "oesterreich heimat grosser"]
+
+
+def _candidates():
+    quotes = basic_chars_only_all(
+        a["quotes"]
+        for a in db.annotations.find(
+            {"quotes": {"$type": "string"}}, {"quotes": 1}
+        )
+    )
+    return list(islice(cycle(quotes), N_CANDIDATES))
+
+
+def _time(func, candidates):
+    best = None
+    for _ in range(REPETITIONS):
+        start = timer()
+        result = func(candidates)
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def _previous(q):
+    def _score_all(candidates):
+        return [
+            _sort_func(q, i, match, 0) for i, match in enumerate(candidates)
+        ]
+
+    return _score_all
+
+
+def _scorer(q):
+    def _score_all(candidates):
+        scorer = QuoteScorer(q)  # once per request
+        return [scorer(i, match, 0) for i, match in enumerate(candidates)]
+
+    return _score_all
+
+
+def main():
+    queries = sys.argv[1:] or DEFAULT_QUERIES
+    candidates = _candidates()
+    if len(candidates) == 0:
+        print("no quotes found")
+        return
+    print(f"{len(candidates)} candidates")
+    for query in queries:
+        q = basic_chars_only(query)
+        print(f'"{q}"')
+        if not QuoteScorer(q).tokens:
+            print("  no token longer than two characters, skipped")
+            continue
+        previous, expected = _time(_previous(q), candidates)
+        elapsed, result = _time(_scorer(q), candidates)
+        if result != expected:
+            print("  QuoteScorer differs from the previous implementation!")
+        print(f"  previous {previous * 1000:9.1f} ms")
+        print(f"  scorer   {elapsed * 1000:9.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
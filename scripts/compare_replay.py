@@ -0,0 +1,74 @@
+"""Check that the bulk-write replay produces exactly the same mongo data as
+replaying the event log event by event.
+
+Usage: python scripts/compare_replay.py
+
+Replays the whole event log twice (this replaces the current mongo data!),
+and compares the serialized collections (documents sorted by id).
+"""
+
+import difflib
+import sys
+from timeit import default_timer as timer
+
+from bson import json_util
+
+from lama.database import db, init_db
+from lama.events import handle_event
+import lama.eventstore as eventstore
+from lama.replay import BulkReplayer
+
+
+def _serialized_collections():
+    return {
+        coll: [
+            json_util.dumps(doc, ensure_ascii=False)
+            for doc in db[coll].find({}).sort([("_id", 1)])
+        ]
+        for coll in sorted(db.list_collection_names())
+        if coll != "db_state"  # contains the initialization timestamp
+    }
+
+
+def _replay_sequential():
+    for event in eventstore.iter_events():
+        handle_event(event, is_replaying=True)
+
+
+def _replay_bulk():
+    with BulkReplayer() as replayer:
+        for event in eventstore.iter_events():
+            replayer.handle(event)
+
+
+def _timed_replay(replay):
+    init_db(True)
+    start = timer()
+    replay()
+    print(f"{replay.__name__}: {timer() - start:.1f}s")
+    return _serialized_collections()
+
+
+def main():
+    sequential = _timed_replay(_replay_sequential)
+    bulk = _timed_replay(_replay_bulk)
+    if sequential == bulk:
+        print("OK: identical results")
+        return
+    for coll in sorted(set(sequential) | set(bulk)):
+        diff = list(
+            difflib.unified_diff(
+                sequential.get(coll, []),
+                bulk.get(coll, []),
+                fromfile=f"sequential/{coll}",
+                tofile=f"bulk/{coll}",
+                lineterm="",
+            )
+        )
+        if diff:
+            print(*diff[:50], sep="\n")
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,53 @@
+import argparse
+from contextlib import nullcontext
 import json
 import os
-import sys
 
 from lama.database import db, init_db
 from lama.events import handle_event
 import lama.eventstore as eventstore
 from lama.importexport import xml2events
-from lama.entity_usage_count import update_all_usage_counts
+from lama.replay import BulkReplayer, update_derived_data
+import lama.snapshots as snapshots
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description="Rebuild the mongo data from the event log."
+    )
+    parser.add_argument(
+        "filename",
+        nargs="?",
+        help="exported XML event log to replace the current event log with",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="ignore snapshots and replay the whole event log",
+    )
+    parser.add_argument(
+        "--snapshot-every",
+        type=int,
+        default=0,
+        metavar="N",
+        help="additionally write a snapshot after every N replayed events",
+    )
+    parser.add_argument(
+        "--sequential",
+        action="store_true",
+        help="replay events one by one instead of using bulk writes",
+    )
+    parser.add_argument(
+        "--no-snapshot",
+        action="store_true",
+        help="do not write a snapshot after replaying",
+    )
+    return parser.parse_args()
 
 
 def main():
-    filename = None
-    if len(sys.argv) > 1:
-        filename = sys.argv[1]
+    args = _parse_args()
+    filename = args.filename
     if filename is not None:
         print(f"Replacing event log with contents of {filename}...")
         from lxml import etree
@@ -21,13 +56,59 @@ def main():
         root = etree.parse(filename, parser)
         events = xml2events(root)
         eventstore.replace_event_log(events)
-    init_db(True)
-    print("Replaying event log...")
-    for event in eventstore.get_events():
-        handle_event(event, is_replaying=True)
-    print("Setting entity usage counts...")
-    update_all_usage_counts()
+        snapshots.clear_snapshots()  # they belong to the old event log
+    total_count = eventstore.count_events()
+    latest_snapshot = None if args.full else snapshots.find_latest_snapshot()
+    last_event = None
+    if latest_snapshot is not None:
+        path, header = latest_snapshot
+        print(f"Loading snapshot {path}...")
+        snapshots.load_snapshot(path)
+        last_event = eventstore.get_event(header["lastEventId"])
+        # the events after it are applied like the server does, keeping the
+        # derived data of the snapshot up to date
+        print("Applying the events after the snapshot...")
+    else:
+        init_db(True)
+        print("Replaying event log...")
+    is_replaying = latest_snapshot is None
+    applied_count = 0
+    replayer = (
+        BulkReplayer() if is_replaying and not args.sequential else None
+    )
+    with replayer or nullcontext():
+        for event in eventstore.iter_events(
+            after_id=last_event.id if last_event is not None else None
+        ):
+            if replayer is not None:
+                replayer.handle(event)
+            else:
+                handle_event(event, is_replaying=is_replaying)
+            last_event = event
+            applied_count += 1
+            if (
+                args.snapshot_every
+                and applied_count % args.snapshot_every == 0
+            ):
+                paused = replayer.paused() if replayer else nullcontext()
+                with paused:
+                    if is_replaying:
+                        update_derived_data()
+                    snapshots.write_snapshot(last_event)
+    print(
+        f"Skipped {total_count - applied_count} events (snapshot),"
+        f" applied {applied_count} events."
+    )
+    if is_replaying:
+        update_derived_data()
     print("Setting entity attributes...")
+    _set_entity_attributes()
+    if last_event is not None and applied_count > 0 and not args.no_snapshot:
+        print("Writing snapshot...")
+        print(snapshots.write_snapshot(last_event))
+
+
+def _set_entity_attributes():
     if not os.path.isfile("cats_relations_mapping.json"):
         return
     with open("cats_relations_mapping.json", encoding="utf-8") as f: